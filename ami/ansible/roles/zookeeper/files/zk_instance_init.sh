@@ -8,11 +8,23 @@ set -ex
 INSTANCE_ID=`curl "http://169.254.169.254/latest/meta-data/instance-id"`
 INSTANCE_NAME="zookeeper-$INSTANCE_ID"
 
+# Sleeps with exponential backoff and decorrelated jitter: each delay is
+# drawn between 1 second and three times the previous one, capped to 30.
+# The instances of a group that boot together thus spread their calls out.
+backoff() {
+    DELAY=$(( 1 + RANDOM % (DELAY * 3) ))
+    if [ $DELAY -gt 30 ]; then
+        DELAY=30
+    fi
+    sleep $DELAY
+}
+
 # Wait for instance in `running` status
 STATE=""
+DELAY=1
 while [ "$STATE" != "running" ]; do
     echo "Waiting for running status"
-    sleep 5
+    backoff
     OUT=$(aws ec2 describe-instances \
                     --region $REGION \
                     --instance-ids $INSTANCE_ID \
@@ -29,9 +41,10 @@ echo "127.0.0.1 localhost $INSTANCE_NAME" > /etc/hosts
 # Set EC2 Instance Name
 # Doing it in a while loop because sometimes the tag is either overwritten or doesn't get created.
 TAG_VALUE=""
+DELAY=1
 while [ "$TAG_VALUE" != "$INSTANCE_NAME" ]; do
     echo "Setting EC2 Instance Name Tag"
-    sleep 5
+    backoff
     TAG_VALUE=$(aws ec2 describe-tags \
                     --filters "Name=resource-id,Values=$INSTANCE_ID" "Name=key,Values=Name" \
                     --region=$REGION \
@@ -46,9 +59,10 @@ done
 # Wait for aws:autoscaling:groupName tag to be set
 # Sometimes the tag isn't set directly by EC2
 TAG_VALUE=
+DELAY=1
 while [ "x$TAG_VALUE" == "x" ]; do
     echo "Waiting for aws:autoscaling:groupName to be set"
-    sleep 5
+    backoff
     TAG_VALUE=$(aws ec2 describe-tags \
                     --filters "Name=resource-id,Values=$INSTANCE_ID" "Name=key,Values=aws:autoscaling:groupName" \
                     --region=$REGION \
@@ -6,14 +6,18 @@ import boto3
 import botocore
 
 from troposphere import (
-    Parameter, Output, Ref, Select, Tags, Template, GetAZs
+    Parameter, Output, Ref, Select, Tags, Template, GetAZs, If, Equals
 )
-from troposphere import Base64, Join, Retain
+from troposphere import Retain
 from troposphere.ec2 import (
     SecurityGroup, SecurityGroupRule, SecurityGroupIngress
 )
 from troposphere.autoscaling import LaunchConfiguration, AutoScalingGroup, Tag
-from troposphere.policies import AutoScalingRollingUpdate, UpdatePolicy
+from troposphere.autoscaling import BlockDeviceMapping, EBSBlockDevice
+from troposphere.autoscaling import LifecycleHookSpecification
+from troposphere.policies import (
+    AutoScalingRollingUpdate, UpdatePolicy, CreationPolicy, ResourceSignal
+)
 from troposphere.logs import LogGroup, Destination
 
 
@@ -104,6 +108,45 @@ instance_role = template.add_parameter(Parameter(
     Description="The role the Zookeeper EC2 instance would assume",
 ))
 
+txlog_volume_type = template.add_parameter(Parameter(
+    "TxLogVolumeType",
+    Default="gp3",
+    Type="String",
+    AllowedValues=["gp3", "io2"],
+    Description="EBS volume type of the dedicated transaction log volume",
+))
+
+txlog_volume_size = template.add_parameter(Parameter(
+    "TxLogVolumeSize",
+    Default="20",
+    Type="Number",
+    Description="Size in GiB of the dedicated transaction log volume",
+))
+
+txlog_volume_iops = template.add_parameter(Parameter(
+    "TxLogVolumeIops",
+    Default="3000",
+    Type="Number",
+    Description="Provisioned IOPS of the dedicated transaction log volume",
+))
+
+txlog_volume_throughput = template.add_parameter(Parameter(
+    "TxLogVolumeThroughput",
+    Default="125",
+    Type="Number",
+    Description="Throughput in MiB/s of the transaction log volume (gp3 only)",
+))
+
+
+### Conditions
+
+
+template.add_condition(
+    "TxLogVolumeIsGp3",
+    Equals(Ref(txlog_volume_type), "gp3")
+)
+
+
 ### Resources
 
 
@@ -144,13 +187,27 @@ launch_config = template.add_resource(LaunchConfiguration(
     SecurityGroups=[Ref(security_group)],
     ImageId=Ref(ami_id),
     IamInstanceProfile=Ref(instance_role),
-    UserData=Base64(Join('', [
-        "#!/bin/bash\n",
-        "cfn-signal -e 0",
-        " --resource ZkAutoscalingGroup",
-        " --stack ", Ref("AWS::StackName"),
-        " --region ", Ref("AWS::Region"), "\n"
-    ])),
+    # No UserData signal: zk-bootstrap sends the resource signal once the
+    # instance is a synced member of the ensemble (--cfn-signal).
+    # Dedicated volume for the transaction log (dataLogDir) so that
+    # snapshot writes do not delay the fsync of commits.
+    # It is formatted and mounted by zk-bootstrap.
+    BlockDeviceMappings=[
+        BlockDeviceMapping(
+            DeviceName="/dev/sdf",
+            Ebs=EBSBlockDevice(
+                VolumeType=Ref(txlog_volume_type),
+                VolumeSize=Ref(txlog_volume_size),
+                Iops=Ref(txlog_volume_iops),
+                Throughput=If(
+                    "TxLogVolumeIsGp3",
+                    Ref(txlog_volume_throughput),
+                    Ref("AWS::NoValue")
+                ),
+                DeleteOnTermination=True
+            )
+        )
+    ],
 ))
 
 
@@ -172,9 +229,25 @@ autoscaling_group = template.add_resource(AutoScalingGroup(
         Tag("Cluster", "zookeeper", True),
         Tag("Name", "zookeeper", True)
     ],
+    # Terminating instances wait for zk-agent to remove them from the
+    # ensemble, and hand the leadership over, before they are terminated.
+    LifecycleHookSpecificationList=[
+        LifecycleHookSpecification(
+            LifecycleHookName="zookeeper-terminating",
+            LifecycleTransition="autoscaling:EC2_INSTANCE_TERMINATING",
+            HeartbeatTimeout=300,
+            DefaultResult="CONTINUE"
+        )
+    ],
+    CreationPolicy=CreationPolicy(
+        ResourceSignal=ResourceSignal(
+            Count=Ref(num_hosts),
+            Timeout='PT20M'
+        )
+    ),
     UpdatePolicy=UpdatePolicy(
         AutoScalingRollingUpdate=AutoScalingRollingUpdate(
-            PauseTime='PT5M',
+            PauseTime='PT20M',
             MinInstancesInService="1",
             MaxBatchSize='1',
             WaitOnResourceSignals=True
@@ -267,7 +340,11 @@ def create_or_update_stack(stack_name,
                            environment,
                            ami,
                            instance_type,
-                           instance_role):
+                           instance_role,
+                           txlog_volume_type,
+                           txlog_volume_size,
+                           txlog_volume_iops,
+                           txlog_volume_throughput):
     ''' Creates or updates the stack with required parameters '''
 
     # Generate the template
@@ -290,7 +367,12 @@ def create_or_update_stack(stack_name,
         {'ParameterKey': 'Environment', 'ParameterValue': environment},
         {'ParameterKey': 'AmiId', 'ParameterValue': ami},
         {'ParameterKey': 'InstanceType', 'ParameterValue': instance_type},
-        {'ParameterKey': 'InstanceRole', 'ParameterValue': instance_role}
+        {'ParameterKey': 'InstanceRole', 'ParameterValue': instance_role},
+        {'ParameterKey': 'TxLogVolumeType', 'ParameterValue': txlog_volume_type},
+        {'ParameterKey': 'TxLogVolumeSize', 'ParameterValue': txlog_volume_size},
+        {'ParameterKey': 'TxLogVolumeIops', 'ParameterValue': txlog_volume_iops},
+        {'ParameterKey': 'TxLogVolumeThroughput',
+         'ParameterValue': txlog_volume_throughput}
     ]
 
     # Create or Update the stack
@@ -377,6 +459,38 @@ def _parse_args():
         metavar=("<InstanceRole>"),
         help='The instance role to use for Zookeeper instances.'
     )
+    parser.add_argument(
+        '--txlogvolumetype',
+        type=str,
+        nargs=1,
+        default=['gp3'],
+        metavar=("<VolumeType>"),
+        help='EBS volume type (gp3 or io2) of the transaction log volume.'
+    )
+    parser.add_argument(
+        '--txlogvolumesize',
+        type=str,
+        nargs=1,
+        default=['20'],
+        metavar=("<GiB>"),
+        help='Size of the transaction log volume.'
+    )
+    parser.add_argument(
+        '--txlogvolumeiops',
+        type=str,
+        nargs=1,
+        default=['3000'],
+        metavar=("<IOPS>"),
+        help='Provisioned IOPS of the transaction log volume.'
+    )
+    parser.add_argument(
+        '--txlogvolumethroughput',
+        type=str,
+        nargs=1,
+        default=['125'],
+        metavar=("<MiB/s>"),
+        help='Throughput of the transaction log volume, gp3 only.'
+    )
     return parser
 
 
@@ -394,7 +508,11 @@ def main():
                               --environment <ENVIRONMENT> \
                               --ami <AMI> \
                               --instancetype <INSTANCETYPE> \
-                              --instancerole <INSTANCEROLE>
+                              --instancerole <INSTANCEROLE> \
+                              [--txlogvolumetype <gp3|io2>] \
+                              [--txlogvolumesize <GiB>] \
+                              [--txlogvolumeiops <IOPS>] \
+                              [--txlogvolumethroughput <MiB/s>]
 
     '''
     parser = _parse_args()
@@ -414,6 +532,10 @@ def main():
         ami = args['ami'][0]
         instancetype = args['instancetype'][0]
         instance_role = args['instancerole'][0]
+        txlog_volume_type = args['txlogvolumetype'][0]
+        txlog_volume_size = args['txlogvolumesize'][0]
+        txlog_volume_iops = args['txlogvolumeiops'][0]
+        txlog_volume_throughput = args['txlogvolumethroughput'][0]
 
     except:
         parser.print_help()
@@ -430,7 +552,11 @@ def main():
         environment,
         ami,
         instancetype,
-        instance_role
+        instance_role,
+        txlog_volume_type,
+        txlog_volume_size,
+        txlog_volume_iops,
+        txlog_volume_throughput
     )
 
 
@@ -12,14 +12,19 @@ setup(
     packages=['zkutils'],
     include_package_data=True,
     scripts = [
+        'scripts/zk-agent',
         'scripts/zk-bootstrap',
+        'scripts/zk-drift',
         'scripts/zk-recovery',
-        'scripts/zk-remove-terminated'
+        'scripts/zk-remove-terminated',
+        'scripts/zk-roll',
+        'scripts/zk-status'
     ],
     install_requires=[
         'boto',
         'botocore',
         'boto3',
+        'kazoo',
         'requests',
         'nose',
         'mock',
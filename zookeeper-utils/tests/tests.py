@@ -1,9 +1,21 @@
+import os
+import shutil
 import logging
+import tempfile
 
 import nose.tools as nt
+import requests
 from mock import patch, ANY, Mock
 
-from zkutils import zk, aws
+from zkutils import zk, admin, aws, cache, client, config, disk, drift
+from zkutils import ensemble
+from zkutils import joins, lifecycle
+from zkutils import membership, monitor
+from zkutils import metrics, placement, purge
+from zkutils import roles
+from zkutils import reconcile, registry, retry, roll, standby, state, status
+from zkutils import tuning
+from zkutils import utils
 
 
 class TestZkRemoveTerminated(object):
@@ -64,9 +76,9 @@ class TestZkBootstrap(object):
     @patch('zkutils.zk._cmd_check_ensemble')
     @patch('zkutils.zk._cmd_start_zookeeper')
     @patch('zkutils.zk._cmd_delete_old_state')
-    @patch('zkutils.zk._cmd_reset_config')
+    @patch('zkutils.zk._reset_static_config')
     def test_fresh_bootstrap_is_successful(self,
-                                     mock_cmd_reset_config,
+                                     mock_reset_static_config,
                                      mock_cmd_delete_old_state,
                                      mock_cmd_start_zookeeper,
                                      mock_cmd_check_ensemble,
@@ -87,7 +99,7 @@ class TestZkBootstrap(object):
             {
                 'InstanceId': 'i-abc11%s' % i,
                 'NetworkInterfaces': [{'PrivateIpAddress': '127.0.0.%s' % i}],
-                'Tags': [{'Key': zk.ZK_ID_TAG, 'Value': str(i)}]
+                'Tags': [{'Key': ensemble.ZK_ID_TAG, 'Value': str(i)}]
             } for i in range(1, self.num_instances+1, 1)
         ]
         mock_running_instances[0]['InstanceId'] = self.test_instance_id
@@ -112,13 +124,15 @@ class TestZkBootstrap(object):
     @patch('zkutils.zk._cmd_check_ensemble')
     @patch('zkutils.zk._cmd_start_zookeeper')
     @patch('zkutils.zk._cmd_delete_old_state')
-    @patch('zkutils.zk._cmd_reset_config')
-    @patch('zkutils.zk._cmd_get_zookeeper_configuration')
-    @patch('zkutils.zk._cmd_add_zookeeper_id')
+    @patch('zkutils.zk._reset_static_config')
+    @patch('zkutils.ensemble._cmd_get_zookeeper_configuration')
+    @patch('zkutils.ensemble._cmd_reconfig')
+    @patch('zkutils.joins.join')
     def test_reconfigured_bootstrap_is_successful(self,
-                                     mock_cmd_add_zookeeper_id,
+                                     mock_join,
+                                     mock_cmd_reconfig,
                                      mock_cmd_get_zookeeper_configuration,
-                                     mock_cmd_reset_config,
+                                     mock_reset_static_config,
                                      mock_cmd_delete_old_state,
                                      mock_cmd_start_zookeeper,
                                      mock_cmd_check_ensemble,
@@ -130,6 +144,7 @@ class TestZkBootstrap(object):
                                      mock_get_tag,
                                      mock_instance_id):
         mock_cmd_check_ensemble.return_value = 'follower' # Reconfig req.
+        mock_join.return_value = False # No answer from the leader
         mock_instance_id.return_value = self.test_instance_id
         mock_get_tag.return_value = '1'
         mock_cmd_get_zookeeper_configuration.return_value = ''
@@ -142,7 +157,7 @@ class TestZkBootstrap(object):
             {
                 'InstanceId': 'i-abc11%s' % i,
                 'NetworkInterfaces': [{'PrivateIpAddress': '127.0.0.%s' % i}],
-                'Tags': [{'Key': zk.ZK_ID_TAG, 'Value': str(i)}]
+                'Tags': [{'Key': ensemble.ZK_ID_TAG, 'Value': str(i)}]
             } for i in range(1, self.num_instances+1, 1)
         ]
         mock_running_instances[0]['InstanceId'] = self.test_instance_id
@@ -153,7 +168,1330 @@ class TestZkBootstrap(object):
                         'testconf',
                         'testdata',
                         'test-log-group')
-        nt.assert_equals(mock_cmd_add_zookeeper_id.call_count, 1)
+        nt.assert_equals(mock_cmd_reconfig.call_count, 1)
         nt.assert_equals(mock_cmd_start_zookeeper.call_count, 1)
         nt.assert_equals(mock_set_tag.call_count, 1)
         nt.assert_equals(bootstrap_type, zk.BOOTSTRAP_TYPE_RECONFIGURED)
+
+
+class TestZkPurge(object):
+    ''' Tests that purging of snapshots and logs works '''
+
+    def test_purge_keeps_logs_needed_by_retained_snapshots(self):
+        snapshots = [(i, 'snapshot.%x' % i) for i in (10, 20, 30, 40, 50)]
+        logs = [(i, 'log.%x' % i) for i in (1, 15, 25, 35, 45)]
+        purgeable = purge.get_purgeable_files(snapshots, logs, 3)
+        nt.assert_equals(purgeable, ['snapshot.a', 'snapshot.14', 'log.1', 'log.f'])
+
+    def test_purge_never_keeps_less_than_minimum(self):
+        snapshots = [(i, 'snapshot.%x' % i) for i in (10, 20, 30)]
+        purgeable = purge.get_purgeable_files(snapshots, [], 1)
+        nt.assert_equals(purgeable, [])
+
+    def test_purge_speeds_up_under_disk_pressure(self):
+        nt.assert_equals(purge.get_schedule(0.5, 10, 3600), (10, 3600))
+        nt.assert_equals(purge.get_schedule(0.2, 10, 3600), (5, 600))
+        nt.assert_equals(purge.get_schedule(0.05, 10, 3600), (3, 60))
+
+
+class TestSaveToFile(object):
+    ''' Tests that files are saved atomically with a bounded history '''
+
+    def setup(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.test_dir, 'zoo.cfg.dynamic')
+
+    def teardown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_unchanged_content_is_not_written(self):
+        nt.assert_true(utils.save_to_file(self.filename, 'server.1'))
+        nt.assert_false(utils.save_to_file(self.filename, 'server.1'))
+        nt.assert_equals(os.listdir(self.test_dir), ['zoo.cfg.dynamic'])
+
+    def test_history_is_rotated_and_bounded(self):
+        for i in range(5):
+            utils.save_to_file(self.filename, 'server.%s' % i, history=2)
+        with open(self.filename) as fread:
+            nt.assert_equals(fread.read(), 'server.4')
+        with open(self.filename + '.bk.1') as fread:
+            nt.assert_equals(fread.read(), 'server.3')
+        with open(self.filename + '.bk.2') as fread:
+            nt.assert_equals(fread.read(), 'server.2')
+        nt.assert_equals(len(os.listdir(self.test_dir)), 3)
+
+
+class TestZkConfig(object):
+    ''' Tests that the static and dynamic configs are parsed and diffed '''
+
+    def test_static_config_keeps_comments_and_order(self):
+        content = '# zoo.cfg\ntickTime=2000\ndynamicConfigFile=/a\n'
+        static_config = config.StaticConfig.parse(content)
+        nt.assert_equals(static_config.serialize(), content)
+        static_config.update({'dynamicConfigFile': '/b', 'snapCount': 1000})
+        nt.assert_equals(static_config.serialize(),
+            '# zoo.cfg\ntickTime=2000\ndynamicConfigFile=/b\nsnapCount=1000\n')
+
+    def test_server_line_roundtrip(self):
+        line = 'server.3=10.0.0.3:2888:3888:observer;0.0.0.0:2181'
+        server = config.Server.parse(line)
+        nt.assert_equals(server.id, '3')
+        nt.assert_equals(server.role, config.ROLE_OBSERVER)
+        nt.assert_equals(str(server), line)
+
+    def test_dynamic_config_diff_is_minimal(self):
+        old = config.DynamicConfig.parse('\n'.join([
+            'server.1=10.0.0.1:2888:3888:participant;2181',
+            'server.2=10.0.0.2:2888:3888:participant;2181',
+            'server.3=10.0.0.3:2888:3888:observer;2181',
+            'version=100000003'
+        ]))
+        nt.assert_equals(old.version, '100000003')
+        new = old.copy()
+        new.remove('1')
+        new.add(old.get('3').with_role(config.ROLE_PARTICIPANT))
+        new.add(config.Server('4', '10.0.0.4'))
+        joining, leaving = old.diff(new)
+        nt.assert_equals([s.id for s in joining], ['3', '4'])
+        nt.assert_equals(leaving, ['1'])
+
+
+class TestZkTuning(object):
+    ''' Tests that performance profiles are generated from the hardware '''
+
+    def test_profile_is_selected_by_memory(self):
+        hardware = {'cpus': 8, 'memory_mb': 31000, 'disk': tuning.DISK_EBS}
+        name, settings, jvm = tuning.generate(hardware)
+        nt.assert_equals(name, 'large')
+        nt.assert_equals(jvm['heap_mb'], 8192)
+        nt.assert_equals(jvm['gc'], tuning.GC_G1)
+        nt.assert_equals(settings['syncLimit'], 5)
+
+    def test_overrides_win_over_profile(self):
+        hardware = {'cpus': 1, 'memory_mb': 1900, 'disk': tuning.DISK_HDD}
+        overrides = {'profile': 'medium', 'jvm.heap_mb': '512',
+                     'maxClientCnxns': '10'}
+        name, settings, jvm = tuning.generate(hardware, overrides)
+        nt.assert_equals(name, 'medium')
+        nt.assert_equals(settings['maxClientCnxns'], '10')
+        nt.assert_equals(settings['syncLimit'], 10)
+        nt.assert_equals(jvm['gc'], tuning.GC_SERIAL)
+        nt.assert_true('-Xmx512m' in tuning.render_java_env(jvm))
+
+
+class TestZkDisk(object):
+    ''' Tests that a dedicated transaction log disk is detected '''
+
+    @patch('zkutils.tuning.get_device_type')
+    @patch('zkutils.disk._cmd_list_block_devices')
+    def test_unused_instance_store_is_preferred(self,
+                                                mock_list_block_devices,
+                                                mock_get_device_type):
+        mock_list_block_devices.return_value = '\n'.join([
+            '/dev/nvme0n1  disk  ',
+            '/dev/nvme0n1p1 /dev/nvme0n1 part ext4 /',
+            '/dev/nvme1n1  disk  ',
+            '/dev/nvme2n1  disk  ',
+            '/dev/nvme3n1  disk ext4 /mnt'
+        ])
+        mock_get_device_type.side_effect = lambda path: {
+            '/sys/block/nvme1n1': tuning.DISK_EBS,
+            '/sys/block/nvme2n1': tuning.DISK_NVME
+        }[path]
+        nt.assert_equals(disk.get_unused_disks(),
+                         ['/dev/nvme1n1', '/dev/nvme2n1'])
+        nt.assert_equals(disk.find_data_log_device(), '/dev/nvme2n1')
+
+    @patch('zkutils.disk._cmd_set_owner')
+    @patch('zkutils.disk._cmd_mount')
+    @patch('zkutils.disk._cmd_format_device')
+    @patch('zkutils.disk.add_to_fstab')
+    @patch('zkutils.disk._cmd_list_block_devices')
+    def test_formatted_disk_is_mounted_on_resume(self,
+                                                 mock_list_block_devices,
+                                                 mock_add_to_fstab,
+                                                 mock_format_device,
+                                                 mock_mount,
+                                                 mock_set_owner):
+        # A bootstrap formatted nvme1n1, then failed before mounting it
+        mock_list_block_devices.return_value = '\n'.join([
+            '/dev/nvme0n1  disk  ',
+            '/dev/nvme0n1p1 /dev/nvme0n1 part ext4 / ',
+            '/dev/nvme1n1  disk ext4  zk-txlog',
+            '/dev/nvme2n1  disk  '
+        ])
+        data_log_dir = tempfile.mkdtemp()
+        try:
+            disk.prepare_data_log_dir(data_log_dir)
+        finally:
+            shutil.rmtree(data_log_dir)
+        nt.assert_equals(disk.get_unused_disks(), ['/dev/nvme2n1'])
+        nt.assert_false(mock_format_device.called)
+        mock_add_to_fstab.assert_called_once_with('/dev/nvme1n1', data_log_dir)
+        mock_mount.assert_called_once_with(data_log_dir)
+
+
+class TestZkRoles(object):
+    ''' Tests that voters are capped and extra members are observers '''
+
+    def setup(self):
+        self.servers = [
+            config.Server(str(i), '10.0.0.%s' % i) for i in range(1, 6)
+        ]
+
+    def test_fresh_ensemble_caps_voters(self):
+        servers = roles.assign_roles(self.servers, 3)
+        nt.assert_equals([s.role for s in servers], [
+            config.ROLE_PARTICIPANT] * 3 + [config.ROLE_OBSERVER] * 2)
+
+    def test_join_as_observer_when_voters_are_full(self):
+        dynamic_config = config.DynamicConfig(roles.assign_roles(
+            self.servers[:3], 3))
+        nt.assert_equals(roles.get_join_role(dynamic_config, 3),
+                         config.ROLE_OBSERVER)
+        nt.assert_equals(roles.get_join_role(dynamic_config, 5),
+                         config.ROLE_PARTICIPANT)
+
+    def test_observer_is_promoted_when_voter_is_lost(self):
+        dynamic_config = config.DynamicConfig(roles.assign_roles(
+            self.servers, 3))
+        dynamic_config.remove('2')
+        changes = roles.get_role_changes(dynamic_config, 3)
+        nt.assert_equals([(s.id, s.role) for s in changes],
+                         [('4', config.ROLE_PARTICIPANT)])
+
+
+class TestZkPlacement(object):
+    ''' Tests that voters are spread across availability zones '''
+
+    def setup(self):
+        self.servers = [
+            config.Server(str(i), '10.0.0.%s' % i) for i in range(1, 7)
+        ]
+        self.azs = {'1': 'a', '2': 'a', '3': 'a', '4': 'b', '5': 'b', '6': 'c'}
+
+    def test_voters_are_spread_by_rtt(self):
+        rtts = {'1': 0.3, '2': 0.1, '3': 0.2, '4': 0.5, '5': 0.4, '6': 0.9}
+        voters = placement.choose_voters(self.servers, 3, self.azs, rtts)
+        nt.assert_equals(sorted(voters), ['2', '5', '6'])
+
+    def test_rebalance_keeps_spread_voters(self):
+        dynamic_config = config.DynamicConfig(roles.assign_roles(
+            self.servers, 3, self.azs))
+        nt.assert_equals([s.id for s in dynamic_config.participants()],
+                         ['1', '4', '6'])
+        rtts = {'2': 0.1, '5': 0.1}
+        nt.assert_equals(placement.get_placement_changes(
+            dynamic_config, 3, self.azs, rtts), [])
+
+    def test_rebalance_moves_voters_out_of_crowded_zone(self):
+        dynamic_config = config.DynamicConfig(roles.assign_roles(
+            self.servers, 3))
+        changes = roles.get_role_changes(dynamic_config, 3, self.azs)
+        nt.assert_equals([(s.id, s.role) for s in changes], [
+            ('2', config.ROLE_OBSERVER),
+            ('3', config.ROLE_OBSERVER),
+            ('4', config.ROLE_PARTICIPANT),
+            ('6', config.ROLE_PARTICIPANT)
+        ])
+
+
+class TestZkRoll(object):
+    ''' Tests that rolling restarts keep the quorum '''
+
+    def status(self, mode, zxid):
+        return {'mode': mode, 'zxid': zxid}
+
+    def test_srvr_is_parsed(self):
+        status = monitor.parse_srvr('\n'.join([
+            'Zookeeper version: 3.5.3-beta',
+            'Latency min/avg/max: 0/1/12',
+            'Outstanding: 2',
+            'Zxid: 0x100000020',
+            'Mode: follower',
+            'Node count: 5'
+        ]))
+        nt.assert_equals(status['mode'], monitor.MODE_FOLLOWER)
+        nt.assert_equals(status['zxid'], 0x100000020)
+        nt.assert_equals(status['latency_max'], 12.0)
+        nt.assert_equals(status['outstanding'], 2)
+
+    def test_leader_is_rolled_last(self):
+        members = [roll.Member('i-%s' % i, str(i), '10.0.0.%s' % i)
+                   for i in range(1, 4)]
+        statuses = {
+            '10.0.0.1': self.status(monitor.MODE_LEADER, 1),
+            '10.0.0.2': self.status(monitor.MODE_FOLLOWER, 1),
+            '10.0.0.3': self.status(monitor.MODE_OBSERVER, 1)
+        }
+        order = roll.get_roll_order(members, statuses)
+        nt.assert_equals([m.zk_id for m in order], ['3', '2', '1'])
+
+    def test_lagging_or_down_member_is_not_healthy(self):
+        leader = self.status(monitor.MODE_LEADER, 0x100000064)
+        follower = self.status(monitor.MODE_FOLLOWER, 0x100000060)
+        nt.assert_true(roll.is_healthy(
+            {'a': leader, 'b': follower}, 10))
+        nt.assert_false(roll.is_healthy(
+            {'a': leader, 'b': follower}, 2))
+        nt.assert_false(roll.is_healthy(
+            {'a': leader, 'b': None}, 10))
+        nt.assert_false(roll.is_healthy(
+            {'a': leader, 'b': self.status(monitor.MODE_FOLLOWER, 0x64)}, 10))
+
+
+class TestZkReadiness(object):
+    ''' Tests that the CloudFormation signal waits for a synced node '''
+
+    @patch('zkutils.monitor.get_status')
+    @patch('zkutils.ensemble._cmd_get_zookeeper_configuration')
+    def test_follower_is_ready_once_caught_up(self,
+                                              mock_cmd_get_configuration,
+                                              mock_get_status):
+        mock_cmd_get_configuration.return_value = '\n'.join([
+            'server.1=10.0.0.1:2888:3888:participant;2181',
+            'server.2=10.0.0.2:2888:3888:participant;2181'
+        ])
+        statuses = {
+            'localhost': {'mode': 'follower', 'zxid': 0x100000001},
+            '10.0.0.1': {'mode': 'leader', 'zxid': 0x100000050},
+            '10.0.0.2': {'mode': 'follower', 'zxid': 0x100000001}
+        }
+        mock_get_status.side_effect = lambda ip: statuses[ip]
+        nt.assert_false(zk.is_ready('localhost', 10))
+        statuses['localhost']['zxid'] = 0x100000048
+        nt.assert_true(zk.is_ready('localhost', 10))
+
+    @patch('zkutils.monitor.get_status')
+    def test_node_without_quorum_is_not_ready(self, mock_get_status):
+        mock_get_status.side_effect = monitor.MonitorError('not serving')
+        nt.assert_false(zk.is_ready('localhost', 10))
+
+    @patch('zkutils.aws.signal_resource')
+    @patch('zkutils.zk.wait_until_ready')
+    def test_signal_is_recorded(self, mock_wait_until_ready,
+                                mock_signal_resource):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            state_file = os.path.join(tmp_dir, 'bootstrap.state')
+            state.save(state_file, {'phase': zk.PHASE_COMPLETED})
+            # Completed, but failed before signaling
+            nt.assert_false(zk.is_signaled(state_file))
+            mock_wait_until_ready.return_value = True
+            nt.assert_true(zk.signal_ready('eu-west-1', 'i-1',
+                                           state_file=state_file))
+            mock_signal_resource.assert_called_once_with(
+                'eu-west-1', 'i-1', True)
+            nt.assert_true(zk.is_signaled(state_file))
+            nt.assert_equals(state.load(state_file)['phase'],
+                             zk.PHASE_COMPLETED)
+        finally:
+            shutil.rmtree(tmp_dir)
+        nt.assert_false(zk.is_signaled(None))
+
+    @patch('zkutils.aws.signal_resource')
+    @patch('zkutils.zk.wait_until_ready')
+    def test_no_failure_signal_when_budget_runs_out(self,
+                                                    mock_wait_until_ready,
+                                                    mock_signal_resource):
+        mock_wait_until_ready.return_value = False
+        deadline = retry.Deadline(5)
+        nt.assert_raises(retry.DeadlineExceeded, zk.signal_ready,
+                         'eu-west-1', 'i-1', deadline=deadline)
+        nt.assert_true(mock_wait_until_ready.call_args[0][2] <= 5)
+        nt.assert_false(mock_signal_resource.called)
+        nt.assert_false(zk.signal_ready('eu-west-1', 'i-1', timeout=5,
+                                        deadline=retry.Deadline(60)))
+        mock_signal_resource.assert_called_once_with('eu-west-1', 'i-1', False)
+
+
+class TestZkReconcile(object):
+    ''' Tests that membership is reconciled in a single reconfig '''
+
+    def setup(self):
+        self.actual = config.DynamicConfig(roles.assign_roles([
+            config.Server(str(i), '10.0.0.%s' % i) for i in range(1, 5)
+        ], 3), '100000004')
+
+    def test_terminated_voter_is_replaced_without_full_capacity(self):
+        desired = {'1': '10.0.0.1', '3': '10.0.0.3', '4': '10.0.0.4'}
+        plan = reconcile.compute_plan(self.actual, desired,
+                                      desired.values(), 3)
+        nt.assert_equals(plan.leaving, ['2'])
+        nt.assert_equals([(s.id, s.role) for s in plan.joining],
+                         [('4', config.ROLE_PARTICIPANT)])
+        nt.assert_equals(plan.version, '100000004')
+
+    def test_replaced_instance_is_removed_until_running(self):
+        desired = {'1': '10.0.0.1', '2': '10.0.1.2',
+                   '3': '10.0.0.3', '4': '10.0.0.4'}
+        running_ips = ['10.0.0.1', '10.0.0.3', '10.0.0.4']
+        plan = reconcile.compute_plan(self.actual, desired, running_ips, 3)
+        nt.assert_equals(plan.leaving, ['2'])
+        plan = reconcile.compute_plan(self.actual, desired,
+                                      running_ips + ['10.0.1.2'], 3)
+        nt.assert_equals(plan.leaving, [])
+        nt.assert_equals([str(s) for s in plan.joining],
+                         ['server.2=10.0.1.2:2888:3888:participant;2181'])
+
+    def test_nothing_to_do(self):
+        desired = dict((s.id, s.ip) for s in self.actual.sorted_servers())
+        plan = reconcile.compute_plan(self.actual, desired,
+                                      desired.values(), 3)
+        nt.assert_true(plan.is_empty())
+
+    @patch('zkutils.ensemble._cmd_reconfig')
+    def test_plan_is_applied_as_one_versioned_reconfig(self,
+                                                       mock_cmd_reconfig):
+        plan = reconcile.Plan(self.actual.sorted_servers()[:1], ['2'],
+                              '100000004')
+        nt.assert_true(reconcile.apply_plan('localhost', plan))
+        mock_cmd_reconfig.assert_called_once_with(
+            'localhost', plan.joining, ['2'], '100000004')
+
+    @patch('zkutils.aws.get_log_streams')
+    def test_recent_log_streams_are_kept(self, mock_get_log_streams):
+        mock_get_log_streams.return_value = [
+            {'logStreamName': '1', 'creationTime': 0},
+            {'logStreamName': '2', 'creationTime': 0},
+            {'logStreamName': '3', 'creationTime': 9000 * 1000}
+        ]
+        stale = reconcile.get_stale_log_streams('eu-west-1', 'test', ['1'],
+                                                now=9100)
+        nt.assert_equals(stale, ['2'])
+
+
+class TestZkJoins(object):
+    ''' Tests that the joins of several servers are coalesced '''
+
+    def setup(self):
+        self.actual = config.DynamicConfig(roles.assign_roles([
+            config.Server(str(i), '10.0.0.%s' % i) for i in range(1, 4)
+        ], 3), '100000003')
+        self.requests = [
+            joins.JoinRequest(config.Server('4', '10.0.0.4'), ['2'], 3, 100),
+            joins.JoinRequest(config.Server('5', '10.0.0.5'), ['2'], 3, 102),
+            joins.JoinRequest(config.Server('2', '10.0.1.2'), [], 3, 103)
+        ]
+
+    def test_requests_are_due_after_the_window(self):
+        nt.assert_false(joins.is_due(self.requests, 5, now=104))
+        nt.assert_true(joins.is_due(self.requests, 5, now=105))
+        nt.assert_false(joins.is_due([], 5, now=105))
+
+    def test_joins_are_applied_in_one_batch(self):
+        plan = joins.compute_batch(self.actual, self.requests)
+        nt.assert_equals(plan.leaving, [])
+        nt.assert_equals([str(s) for s in plan.joining], [
+            'server.2=10.0.1.2:2888:3888:participant;2181',
+            'server.4=10.0.0.4:2888:3888:observer;2181',
+            'server.5=10.0.0.5:2888:3888:observer;2181'
+        ])
+        nt.assert_equals(plan.version, '100000003')
+
+    def test_terminated_ids_leave_in_the_same_batch(self):
+        plan = joins.compute_batch(self.actual, self.requests[:2])
+        nt.assert_equals(plan.leaving, ['2'])
+        nt.assert_equals([(s.id, s.role) for s in plan.joining], [
+            ('4', config.ROLE_PARTICIPANT), ('5', config.ROLE_OBSERVER)
+        ])
+
+    def test_request_round_trip(self):
+        request = joins.JoinRequest.parse(self.requests[0].serialize(), 100)
+        nt.assert_equals(request.server, self.requests[0].server)
+        nt.assert_equals(request.leaving, ['2'])
+        nt.assert_equals(request.created, 100)
+
+    def test_batch_is_retried_on_version_conflict(self):
+        zk_client = Mock()
+        zk_client.get_children.return_value = ['4']
+        zk_client.get.side_effect = [
+            (self.requests[0].serialize(), Mock(ctime=100000)),
+            (self.actual.serialize() + '\nversion=100000003', None)
+        ]
+        zk_client.reconfig.side_effect = joins.BadVersionError()
+        nt.assert_equals(joins.process_joins(zk_client, 5, now=200), [])
+        nt.assert_equals(zk_client.delete.call_count, 0)
+        zk_client.reconfig.assert_called_once_with(
+            joining='server.4=10.0.0.4:2888:3888:participant;2181',
+            leaving='2',
+            new_members=None,
+            from_config=0x100000003
+        )
+
+    @patch('zkutils.ensemble._cmd_reconfig')
+    @patch('zkutils.ensemble._cmd_get_zookeeper_configuration')
+    def test_join_is_retried_on_version_conflict(self,
+                                                 mock_cmd_get_configuration,
+                                                 mock_cmd_reconfig):
+        newer = self.actual.copy()
+        newer.remove('2')
+        mock_cmd_get_configuration.side_effect = [
+            self.actual.serialize() + '\nversion=100000003',
+            newer.serialize() + '\nversion=100000007'
+        ]
+        mock_cmd_reconfig.side_effect = [
+            utils.CommandError('', 'KeeperErrorCode = BadVersion'), None
+        ]
+        server = config.Server('4', '10.0.0.4')
+        plan = zk.join_ensemble('10.0.0.1', server, ['2'], 3)
+        nt.assert_equals(mock_cmd_reconfig.call_count, 2)
+        mock_cmd_reconfig.assert_called_with(
+            '10.0.0.1', [server.with_role(config.ROLE_PARTICIPANT)], [],
+            '100000007')
+        nt.assert_equals(plan.version, '100000007')
+
+    @patch('zkutils.client.connect')
+    @patch('zkutils.monitor.get_status')
+    def test_session_is_closed_with_leadership(self, mock_get_status,
+                                               mock_connect):
+        mock_get_status.side_effect = [
+            {'mode': 'leader', 'zxid': 0}, {'mode': 'follower', 'zxid': 0}
+        ]
+        func = Mock()
+        task = client.leader_task(func, '10.0.0.1')
+        nt.assert_equals(task(), client.LEADER_INTERVAL)
+        nt.assert_equals(task(), client.IDLE_INTERVAL)
+        func.assert_called_once_with(mock_connect.return_value)
+        mock_connect.return_value.stop.assert_called_once_with()
+        mock_connect.return_value.close.assert_called_once_with()
+
+
+class TestZkLifecycle(object):
+    ''' Tests that a terminating server leaves the ensemble gracefully '''
+
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.tmp_dir, 'state')
+        self.actual = config.DynamicConfig(roles.assign_roles([
+            config.Server(str(i), '10.0.0.%s' % i) for i in range(1, 5)
+        ], 3), '100000004')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @patch('zkutils.ensemble._cmd_reconfig')
+    @patch('zkutils.ensemble._cmd_get_zookeeper_configuration')
+    def test_voter_is_replaced_in_the_same_reconfig(self,
+                                                    mock_cmd_get_config,
+                                                    mock_cmd_reconfig):
+        mock_cmd_get_config.return_value = \
+            self.actual.serialize() + '\nversion=100000004'
+        plan = zk.leave_ensemble('10.0.0.2', '1', 3)
+        nt.assert_equals(plan.leaving, ['1'])
+        mock_cmd_reconfig.assert_called_once_with(
+            '10.0.0.2',
+            [self.actual.get('4').with_role(config.ROLE_PARTICIPANT)],
+            ['1'],
+            '100000004')
+
+    @patch('zkutils.aws.get_target_lifecycle_state')
+    @patch('zkutils.aws.complete_lifecycle_action')
+    @patch('zkutils.lifecycle.leave')
+    def test_termination_is_handled_once(self,
+                                         mock_leave,
+                                         mock_complete_lifecycle_action,
+                                         mock_get_target_state):
+        task = lifecycle.lifecycle_task('eu-west-1', 'i-abc111', '1',
+                                        'myAutoscalingGroup',
+                                        state_file=self.state_file)
+        utils.save_to_file(self.state_file, 'InService')
+        nt.assert_equals(task(), lifecycle.POLL_INTERVAL)
+        nt.assert_equals(mock_leave.call_count, 0)
+        utils.save_to_file(self.state_file, 'Terminated')
+        nt.assert_equals(task(), lifecycle.DONE_INTERVAL)
+        nt.assert_equals(task(), lifecycle.DONE_INTERVAL)
+        mock_leave.assert_called_once_with('1', 'localhost', 5)
+        mock_complete_lifecycle_action.assert_called_once_with(
+            'eu-west-1', 'myAutoscalingGroup', lifecycle.DEFAULT_HOOK_NAME,
+            'i-abc111')
+        nt.assert_equals(mock_get_target_state.call_count, 0)
+
+
+class TestZkStandby(object):
+    ''' Tests that a failed voter is replaced by a synced observer '''
+
+    def setup(self):
+        self.actual = config.DynamicConfig(roles.assign_roles([
+            config.Server(str(i), '10.0.0.%s' % i) for i in range(1, 6)
+        ], 3), '100000005')
+        self.statuses = {
+            '10.0.0.1': {'mode': 'leader', 'zxid': 0x100000050},
+            '10.0.0.2': None,
+            '10.0.0.3': {'mode': 'follower', 'zxid': 0x100000050},
+            '10.0.0.4': {'mode': 'observer', 'zxid': 0x100000010},
+            '10.0.0.5': {'mode': 'observer', 'zxid': 0x100000049}
+        }
+
+    def test_voter_fails_after_threshold(self):
+        tracker = standby.HealthTracker(2)
+        voters = self.actual.participants()
+        nt.assert_equals(tracker.update(voters, self.statuses), [])
+        nt.assert_equals(tracker.update(voters, self.statuses), ['2'])
+        self.statuses['10.0.0.2'] = {'mode': 'follower', 'zxid': 0}
+        nt.assert_equals(tracker.update(voters, self.statuses), [])
+        nt.assert_equals(tracker.failures, {})
+
+    def test_least_lagging_observer_is_promoted(self):
+        standbys = standby.choose_standbys(self.actual, self.statuses, 1)
+        nt.assert_equals([s.id for s in standbys], ['5'])
+        plan = standby.compute_failover(self.actual, ['2'], standbys)
+        nt.assert_equals(plan.leaving, [])
+        nt.assert_equals([(s.id, s.role) for s in plan.joining], [
+            ('2', config.ROLE_OBSERVER), ('5', config.ROLE_PARTICIPANT)
+        ])
+        nt.assert_equals(plan.version, '100000005')
+
+
+class TestZkRejoin(object):
+    ''' Tests that a rebooted member rejoins from its local state '''
+
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.id_file = os.path.join(self.tmp_dir, 'myid')
+        self.dynamic_file = os.path.join(self.tmp_dir, 'zoo.cfg.dynamic')
+        self.state_file = os.path.join(self.tmp_dir, 'bootstrap.state')
+        self.dynamic_config = config.DynamicConfig([
+            config.Server(str(i), '10.0.0.%s' % i) for i in range(1, 4)
+        ])
+        os.makedirs(os.path.join(self.tmp_dir, 'version-2'))
+        utils.save_to_file(os.path.join(self.tmp_dir, zk.EPOCH_FILE), '1')
+        utils.save_to_file(self.id_file, '1')
+        self.dynamic_config.save(self.dynamic_file)
+        state.save(self.state_file, {
+            'phase': zk.PHASE_COMPLETED,
+            'zookeeper_id': '1',
+            'zookeeper_ip': '10.0.0.1'
+        })
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _bootstrap(self):
+        return zk.do_bootstrap('eu-west-1', self.id_file, self.dynamic_file,
+                               self.tmp_dir, self.tmp_dir, 'test-log-group',
+                               state_file=self.state_file)
+
+    @patch('zkutils.aws.get_instance_id')
+    @patch('zkutils.monitor.get_statuses')
+    @patch('zkutils.ensemble._cmd_get_zookeeper_configuration')
+    @patch('zkutils.zk._cmd_start_zookeeper')
+    def test_member_rejoins_without_aws(self,
+                                        mock_cmd_start_zookeeper,
+                                        mock_cmd_get_configuration,
+                                        mock_get_statuses,
+                                        mock_instance_id):
+        mock_get_statuses.return_value = {
+            '10.0.0.2': None,
+            '10.0.0.3': {'mode': 'leader', 'zxid': 0}
+        }
+        mock_cmd_get_configuration.return_value = \
+            self.dynamic_config.serialize()
+        nt.assert_equals(self._bootstrap(), zk.BOOTSTRAP_TYPE_REJOINED)
+        mock_cmd_get_configuration.assert_called_once_with('10.0.0.3')
+        nt.assert_equals(mock_cmd_start_zookeeper.call_count, 1)
+        nt.assert_equals(mock_instance_id.call_count, 0)
+
+    @patch('zkutils.monitor.get_statuses')
+    @patch('zkutils.ensemble._cmd_get_zookeeper_configuration')
+    def test_removed_member_does_not_rejoin(self,
+                                            mock_cmd_get_configuration,
+                                            mock_get_statuses):
+        mock_get_statuses.return_value = {
+            '10.0.0.2': {'mode': 'leader', 'zxid': 0},
+            '10.0.0.3': None
+        }
+        self.dynamic_config.remove('1')
+        mock_cmd_get_configuration.return_value = \
+            self.dynamic_config.serialize()
+        nt.assert_false(zk.rejoin(self.state_file, self.id_file,
+                                  self.dynamic_file, self.tmp_dir,
+                                  self.tmp_dir))
+
+    @patch('zkutils.reconcile.get_desired_members')
+    @patch('zkutils.aws.get_autoscaling_group')
+    @patch('zkutils.aws.get_instance_id')
+    @patch('zkutils.monitor.is_running')
+    @patch('zkutils.monitor.get_statuses')
+    @patch('zkutils.zk._cmd_start_zookeeper')
+    def test_no_rejoin_when_peers_are_gone(self, mock_cmd_start_zookeeper,
+                                           mock_get_statuses,
+                                           mock_is_running,
+                                           mock_instance_id,
+                                           mock_get_asgroup,
+                                           mock_get_desired):
+        # The peers were replaced by a new ensemble at other ips
+        mock_get_statuses.return_value = {'10.0.0.2': None, '10.0.0.3': None}
+        mock_is_running.return_value = False
+        mock_get_asgroup.return_value = {'AutoScalingGroupName': 'zk'}
+        mock_get_desired.return_value = (
+            {'1': '10.0.0.1', '2': '10.0.1.2', '3': '10.0.1.3'}, {})
+        nt.assert_false(zk.rejoin(self.state_file, self.id_file,
+                                  self.dynamic_file, self.tmp_dir,
+                                  self.tmp_dir, 'eu-west-1'))
+        nt.assert_false(zk.rejoin(self.state_file, self.id_file,
+                                  self.dynamic_file, self.tmp_dir,
+                                  self.tmp_dir))
+        nt.assert_equals(mock_cmd_start_zookeeper.call_count, 0)
+
+    @patch('zkutils.reconcile.get_desired_members')
+    @patch('zkutils.aws.get_autoscaling_group')
+    @patch('zkutils.aws.get_instance_id')
+    @patch('zkutils.monitor.is_running')
+    @patch('zkutils.monitor.get_statuses')
+    @patch('zkutils.zk._cmd_start_zookeeper')
+    def test_rejoin_when_ensemble_reboots(self, mock_cmd_start_zookeeper,
+                                          mock_get_statuses,
+                                          mock_is_running,
+                                          mock_instance_id,
+                                          mock_get_asgroup,
+                                          mock_get_desired):
+        mock_get_statuses.return_value = {'10.0.0.2': None, '10.0.0.3': None}
+        mock_is_running.side_effect = lambda ip: ip == '10.0.0.2'
+        mock_get_asgroup.return_value = {'AutoScalingGroupName': 'zk'}
+        mock_get_desired.return_value = (
+            {'1': '10.0.0.1', '3': '10.0.0.3'}, {})
+        nt.assert_true(zk.rejoin(self.state_file, self.id_file,
+                                 self.dynamic_file, self.tmp_dir,
+                                 self.tmp_dir, 'eu-west-1'))
+        nt.assert_equals(mock_cmd_start_zookeeper.call_count, 1)
+
+    def test_no_rejoin_without_data(self):
+        os.remove(os.path.join(self.tmp_dir, zk.EPOCH_FILE))
+        nt.assert_false(zk.rejoin(self.state_file, self.id_file,
+                                  self.dynamic_file, self.tmp_dir,
+                                  self.tmp_dir))
+
+
+class TestZkBootstrapResume(object):
+    ''' Tests that a failed bootstrap resumes after its last phase '''
+
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.tmp_dir, 'bootstrap.state')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _bootstrap(self):
+        return zk.do_bootstrap('eu-west-1', 'testdata/myid',
+                               'testconf/zoo.cfg.dynamic', 'testconf',
+                               'testdata', 'test-log-group',
+                               state_file=self.state_file)
+
+    @patch('zkutils.tuning.apply_profile')
+    @patch('zkutils.aws.get_instance_id')
+    @patch('zkutils.zk.initialize')
+    @patch('zkutils.zk.start_server')
+    @patch('zkutils.zk.add_joining_server')
+    @patch('zkutils.monitor.is_running')
+    @patch('zkutils.zk._cmd_check_ensemble')
+    @patch('zkutils.aws.set_tag')
+    def test_join_is_resumed_without_restart(self,
+                                             mock_set_tag,
+                                             mock_cmd_check_ensemble,
+                                             mock_is_running,
+                                             mock_add_joining_server,
+                                             mock_start_server,
+                                             mock_initialize,
+                                             mock_instance_id,
+                                             mock_apply_profile):
+        mock_apply_profile.return_value = {'tickTime': '2000'}
+        mock_instance_id.return_value = 'i-abc111'
+        mock_initialize.return_value = '4'
+        mock_start_server.return_value = {
+            'bootstrap_type': zk.BOOTSTRAP_TYPE_RECONFIGURED,
+            'zookeeper_ip': '10.0.0.4',
+            'ensemble_ip': '10.0.0.1',
+            'other_ips': ['10.0.0.1', '10.0.0.2'],
+            'running_ids': ['1', '2', '4']
+        }
+        mock_add_joining_server.side_effect = [
+            utils.CommandError('', 'Connection refused'), None
+        ]
+        nt.assert_raises(utils.CommandError, self._bootstrap)
+        nt.assert_equals(state.load(self.state_file)['phase'],
+                         zk.PHASE_STARTED)
+
+        mock_is_running.return_value = True
+        mock_cmd_check_ensemble.return_value = 'Mode: follower'
+        nt.assert_equals(self._bootstrap(), zk.BOOTSTRAP_TYPE_RECONFIGURED)
+        nt.assert_equals(mock_apply_profile.call_count, 1)
+        nt.assert_equals(mock_initialize.call_count, 1)
+        nt.assert_equals(mock_start_server.call_count, 1)
+        mock_add_joining_server.assert_called_with(
+            'eu-west-1', '4', '10.0.0.4', ['1', '2', '4'], '10.0.0.1',
+            'test-log-group', roles.DEFAULT_MAX_VOTERS, ANY)
+        nt.assert_equals(state.load(self.state_file)['phase'],
+                         zk.PHASE_COMPLETED)
+
+
+class TestZkMembership(object):
+    ''' Tests that the dynamic file follows the live config '''
+
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dynamic_file = os.path.join(self.tmp_dir, 'zoo.cfg.dynamic')
+        self.view = membership.MembershipView()
+        self.data = '\n'.join([
+            'server.1=10.0.0.1:2888:3888:participant;2181',
+            'server.2=10.0.0.2:2888:3888:participant;2181',
+            'version=100000002'
+        ]).encode('utf-8')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_change_is_written_to_file_and_view(self):
+        membership.sync(self.data, self.dynamic_file, self.view)
+        nt.assert_equals(self.view.get().ids(), ['1', '2'])
+        nt.assert_equals(self.view.get().version, '100000002')
+        with open(self.dynamic_file) as fread:
+            nt.assert_equals(fread.read(), '\n'.join([
+                'server.1=10.0.0.1:2888:3888:participant;2181',
+                'server.2=10.0.0.2:2888:3888:participant;2181'
+            ]))
+
+    def test_config_without_servers_is_ignored(self):
+        nt.assert_equals(
+            membership.sync(b'', self.dynamic_file, self.view), None)
+        nt.assert_equals(self.view.get(), None)
+        nt.assert_false(os.path.exists(self.dynamic_file))
+
+    def test_view_is_read_before_the_session(self):
+        zk_client = Mock()
+        membership.sync(self.data, self.dynamic_file, self.view)
+        dynamic_config = membership.get_configuration(zk_client, self.view)
+        nt.assert_equals(dynamic_config.ids(), ['1', '2'])
+        nt.assert_equals(zk_client.get.call_count, 0)
+
+
+class TestZkRegistry(object):
+    ''' Tests that members whose registration went away are removed '''
+
+    def setup(self):
+        self.actual = config.DynamicConfig(roles.assign_roles([
+            config.Server(str(i), '10.0.0.%s' % i) for i in range(1, 5)
+        ], 3), '100000004')
+        self.now = [1000.0]
+        self.janitor = registry.Janitor('us-east-1', 'zk', 3,
+                                        clock=lambda: self.now[0])
+
+    def _depart(self, *server_ids):
+        for server_id in server_ids:
+            self.janitor.departed[server_id] = \
+                self.now[0] - registry.DEPARTED_GRACE_PERIOD
+            self.janitor.failures[server_id] = registry.REMOVAL_CHECKS - 1
+
+    def test_departures_are_tracked(self):
+        self.janitor.on_members(['1', '2', '3'])
+        nt.assert_equals(self.janitor.departed, {})
+        self.janitor.on_members(['1', '3'])
+        nt.assert_equals(self.janitor.departed, {'2': 1000.0})
+        self.janitor.on_members(['1', '2', '3'])
+        nt.assert_equals(self.janitor.departed, {})
+
+    @patch('zkutils.reconcile.get_desired_members')
+    @patch('zkutils.monitor.get_status')
+    def test_member_back_within_grace_period_is_kept(self, mock_get_status,
+                                                     mock_get_desired):
+        mock_get_status.side_effect = monitor.MonitorError('restarting')
+        self.janitor.on_members(['1', '2', '3', '4'])
+        self.janitor.on_members(['1', '3', '4'])
+        for _ in range(registry.REMOVAL_CHECKS + 1):
+            self.now[0] += registry.JANITOR_INTERVAL
+            nt.assert_equals(self.janitor.get_removable_ids(self.actual), [])
+        self.janitor.on_members(['1', '2', '3', '4'])
+        self.now[0] += registry.DEPARTED_GRACE_PERIOD
+        nt.assert_equals(self.janitor.get_removable_ids(self.actual), [])
+        nt.assert_equals(self.janitor.failures, {})
+        nt.assert_false(mock_get_desired.called)
+
+    @patch('zkutils.reconcile.get_desired_members')
+    @patch('zkutils.monitor.get_status')
+    def test_only_members_gone_are_removed(self, mock_get_status,
+                                           mock_get_desired):
+        def get_status(ip):
+            if ip in ('10.0.0.2', '10.0.0.4'):
+                raise monitor.MonitorError('not serving')
+            return {'mode': 'follower', 'zxid': 0}
+        mock_get_status.side_effect = get_status
+        # The instance of 4 is still running, e.g. rebooting
+        mock_get_desired.return_value = (
+            {'1': '10.0.0.1', '3': '10.0.0.3', '4': '10.0.0.4'}, {})
+        self._depart('2', '3', '4', '7')
+        nt.assert_equals(self.janitor.get_removable_ids(self.actual), ['2'])
+        nt.assert_equals(sorted(self.janitor.departed), ['2', '3', '4'])
+        nt.assert_equals(self.janitor.failures['3'], 0)
+        mock_get_desired.assert_called_once_with('us-east-1', 'zk')
+        # The running instance of 4 is not listed on every run
+        self.now[0] += registry.JANITOR_INTERVAL
+        nt.assert_equals(self.janitor.get_removable_ids(self.actual), ['2'])
+        nt.assert_equals(mock_get_desired.call_count, 2)
+        mock_get_desired.return_value = ({'1': '10.0.0.1'}, {})
+        self.now[0] += registry.JANITOR_INTERVAL
+        self.janitor.forget(['2'])
+        nt.assert_equals(self.janitor.get_removable_ids(self.actual), [])
+        nt.assert_equals(mock_get_desired.call_count, 2)
+        self.now[0] += registry.RUNNING_RECHECK_PERIOD
+        nt.assert_equals(self.janitor.get_removable_ids(self.actual), ['4'])
+        nt.assert_equals(mock_get_desired.call_count, 3)
+
+    @patch('zkutils.reconcile.get_desired_members')
+    @patch('zkutils.monitor.get_status')
+    def test_departed_voter_is_replaced(self, mock_get_status,
+                                        mock_get_desired):
+        mock_get_status.side_effect = monitor.MonitorError('not serving')
+        mock_get_desired.return_value = ({'1': '10.0.0.1'}, {})
+        zk_client = Mock()
+        zk_client.get.return_value = (
+            self.actual.serialize() + '\nversion=100000004', None)
+        self.janitor._client = zk_client
+        self._depart('2')
+        plan = self.janitor(zk_client)
+        nt.assert_equals(plan.leaving, ['2'])
+        zk_client.reconfig.assert_called_once_with(
+            joining='server.4=10.0.0.4:2888:3888:participant;2181',
+            leaving='2',
+            new_members=None,
+            from_config=0x100000004
+        )
+        nt.assert_equals(self.janitor.departed, {})
+
+    def test_registration_round_trip(self):
+        registration = registry.Registration(self.actual.get('1'), 'eu-west-1a')
+        parsed = registry.Registration.parse(registration.serialize())
+        nt.assert_equals(parsed.server, self.actual.get('1'))
+        nt.assert_equals(parsed.az, 'eu-west-1a')
+        nt.assert_equals(parsed.path, '/zkutils/members/1')
+
+
+class TestRetry(object):
+    ''' Tests the backoff, retries and deadlines of the waits '''
+
+    def test_delays_are_jittered_within_bounds(self):
+        backoff = retry.Backoff(1, 30, attempts=10)
+        delays = list(backoff.delays())
+        nt.assert_equals(len(delays), 9)
+        nt.assert_true(all(1 <= d <= 30 for d in delays))
+        nt.assert_true(len(set(delays)) > 1)
+
+    @patch('zkutils.retry.time.sleep')
+    def test_last_error_is_raised_after_attempts(self, mock_sleep):
+        func = Mock(side_effect=utils.CommandError('', 'failed'))
+        nt.assert_raises(utils.CommandError, retry.retry, func,
+                         retry.Backoff(1, 5, attempts=3), utils.CommandError)
+        nt.assert_equals(func.call_count, 3)
+        nt.assert_equals(mock_sleep.call_count, 2)
+
+    @patch('zkutils.retry.time.sleep')
+    def test_poll_returns_first_true_value(self, mock_sleep):
+        func = Mock(side_effect=[None, [], ['i-1']])
+        nt.assert_equals(retry.poll(func, retry.Backoff(1, 5)), ['i-1'])
+        nt.assert_equals(mock_sleep.call_count, 2)
+
+    @patch('zkutils.retry.time.sleep')
+    def test_poll_stops_at_deadline(self, mock_sleep):
+        deadline = retry.Deadline(10)
+        deadline.expires -= 11
+        nt.assert_raises(retry.DeadlineExceeded, retry.poll, Mock(),
+                         retry.Backoff(1, 5), deadline)
+        nt.assert_equals(mock_sleep.call_count, 0)
+        nt.assert_equals(deadline.limit(120), 0)
+
+
+class TestAwsRateLimit(object):
+    ''' Tests the client-side rate limiting of the AWS calls '''
+
+    def setup(self):
+        metrics.METRICS.reset()
+
+    def test_bucket_allows_burst_then_rate(self):
+        now = [100.0]
+        bucket = aws.TokenBucket(2, 3, clock=lambda: now[0])
+        nt.assert_equals([bucket.take() for _ in range(3)], [0, 0, 0])
+        nt.assert_almost_equals(bucket.take(), 0.5)
+        now[0] += 0.5
+        nt.assert_equals(bucket.take(), 0)
+        now[0] += 60
+        nt.assert_equals([bucket.take() for _ in range(3)], [0, 0, 0])
+        nt.assert_true(bucket.take() > 0)
+
+    def test_throttled_attempts_are_counted(self):
+        event_name = 'needs-retry.ec2.DescribeInstances'
+        throttled = (None, {'Error': {'Code': 'RequestLimitExceeded'}})
+        aws._on_retry('ec2', event_name, response=throttled, attempts=1)
+        aws._on_retry('ec2', event_name, response=(None, {}), attempts=2)
+        aws._on_retry('ec2', event_name, response=None, attempts=3)
+        nt.assert_equals(
+            metrics.METRICS.get('aws.ec2.DescribeInstances.throttled'), 1)
+
+    @patch('zkutils.aws.TokenBucket.acquire')
+    def test_sends_wait_for_the_bucket(self, mock_acquire):
+        mock_acquire.return_value = 0.25
+        bucket = aws.TokenBucket(1, 1)
+        aws._on_send('logs', bucket, 'before-send.logs.CreateLogStream')
+        nt.assert_equals(
+            metrics.METRICS.get('aws.logs.CreateLogStream.attempts'), 1)
+        nt.assert_equals(
+            metrics.METRICS.get_timing('aws.logs.rate_limited'),
+            (1, 0.25, 0.25))
+
+    @patch('zkutils.aws.boto3.client')
+    def test_clients_are_shared_and_adaptive(self, mock_client):
+        aws._clients.clear()
+        client = aws.get_client('ec2', 'eu-west-1')
+        nt.assert_true(aws.get_client('ec2', 'eu-west-1') is client)
+        mock_client.assert_called_once_with('ec2', 'eu-west-1',
+                                            config=aws.CLIENT_CONFIG)
+        nt.assert_equals(aws.CLIENT_CONFIG.retries['mode'], 'adaptive')
+        nt.assert_equals(client.meta.events.register.call_count, 5)
+        aws._clients.clear()
+
+    def test_calls_are_instrumented(self):
+        context = {}
+        aws._on_call('ec2', 'before-call.ec2.DescribeInstances', context)
+        context[aws.CALL_START] -= 0.3
+        aws._on_call_done('ec2', 'after-call.ec2.DescribeInstances', context,
+                          parsed={'ResponseMetadata': {'RetryAttempts': 2}},
+                          http_response=Mock(status_code=200))
+        aws._on_call('ec2', 'before-call.ec2.DescribeInstances', context)
+        aws._on_call_done('ec2', 'after-call-error.ec2.DescribeInstances',
+                          context, exception=Exception('timed out'))
+        name = 'aws.ec2.DescribeInstances'
+        nt.assert_equals(metrics.METRICS.get(name + '.calls'), 2)
+        nt.assert_equals(metrics.METRICS.get(name + '.retries'), 2)
+        nt.assert_equals(metrics.METRICS.get(name + '.errors'), 1)
+        nt.assert_equals(metrics.METRICS.get_timing(name + '.latency')[0], 2)
+        nt.assert_equals(
+            metrics.METRICS.get_percentile(name + '.latency', 99), 0.5)
+
+    def test_latency_histogram(self):
+        histogram = metrics.Metrics([0.1, 1, float('inf')])
+        for seconds in [0.05, 0.5, 0.7, 30]:
+            histogram.observe('latency', seconds)
+        nt.assert_equals(histogram.get_histogram('latency'),
+                         [(0.1, 1), (1, 2), (float('inf'), 1)])
+        nt.assert_equals(histogram.get_percentile('latency', 50), 1)
+        nt.assert_equals(histogram.get_percentile('latency', 99),
+                         float('inf'))
+        nt.assert_equals(histogram.get_percentile('other', 50), None)
+
+
+class TestCache(object):
+    ''' Tests the AWS listings cached between runs '''
+
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = cache.Cache('myAutoscalingGroup', self.tmp_dir)
+        self.actual = config.DynamicConfig(roles.assign_roles([
+            config.Server(str(i), '10.0.0.%s' % i) for i in range(1, 4)
+        ], 3), '100000003')
+        self.members = (
+            dict((s.id, s.ip) for s in self.actual.sorted_servers()), {}
+        )
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _age(self, key, seconds):
+        entry = state.load(self.cache.path(key))
+        entry['stored'] -= seconds
+        state.save(self.cache.path(key), entry)
+
+    def test_fresh_entry_is_not_loaded(self):
+        load = Mock(return_value={'1': '10.0.0.1'})
+        nt.assert_equals(self.cache.get('members', load, 60),
+                         {'1': '10.0.0.1'})
+        nt.assert_equals(self.cache.get('members', load, 60),
+                         {'1': '10.0.0.1'})
+        nt.assert_equals(load.call_count, 1)
+
+    def test_stale_entry_is_returned_while_revalidated(self):
+        self.cache.write('members', ['1'])
+        self._age('members', 90)
+        load = Mock(return_value=['1', '2'])
+        with patch('threading.Thread.start') as mock_start:
+            nt.assert_equals(self.cache.get('members', load, 60, 60), ['1'])
+        nt.assert_equals(mock_start.call_count, 1)
+        other = cache.Cache('myAutoscalingGroup', self.tmp_dir)
+        other.revalidate('members', load).join()
+        nt.assert_equals(self.cache.read('members')[0], ['1', '2'])
+
+    def test_expired_entry_is_loaded(self):
+        self.cache.write('members', ['1'])
+        self._age('members', 200)
+        load = Mock(return_value=['1', '2'])
+        nt.assert_equals(self.cache.get('members', load, 60, 60), ['1', '2'])
+
+    def test_unwritable_cache_still_loads(self):
+        unwritable = cache.Cache('group', '/proc/zkutils')
+        load = Mock(return_value=['1'])
+        nt.assert_equals(unwritable.get('members', load, 60), ['1'])
+        nt.assert_equals(unwritable.get('members', load, 60), ['1'])
+        nt.assert_equals(load.call_count, 2)
+
+    def test_membership_change_invalidates(self):
+        self.cache.write('members', ['1'])
+        self.cache.write('streams', [])
+        data = self.actual.serialize() + '\nversion=100000003'
+        dynamic_file = os.path.join(self.tmp_dir, 'zoo.cfg.dynamic')
+        membership.sync(data.encode('utf-8'), dynamic_file,
+                        membership.MembershipView(), self.cache)
+        nt.assert_equals(self.cache.read('members'), (None, None))
+        nt.assert_equals(self.cache.read('streams'), (None, None))
+
+    @patch('zkutils.reconcile.get_desired_members')
+    @patch('zkutils.reconcile.get_running_ips')
+    @patch('zkutils.ensemble._cmd_get_zookeeper_configuration')
+    @patch('zkutils.aws.get_log_streams')
+    def test_steady_state_makes_no_aws_calls(self,
+                                             mock_get_log_streams,
+                                             mock_cmd_get_configuration,
+                                             mock_get_running_ips,
+                                             mock_get_desired_members):
+        mock_get_desired_members.return_value = self.members
+        mock_get_running_ips.side_effect = lambda ips: list(ips)
+        mock_cmd_get_configuration.return_value = \
+            self.actual.serialize() + '\nversion=100000003'
+        mock_get_log_streams.return_value = [
+            {'logStreamName': str(i), 'creationTime': 0} for i in range(1, 4)
+        ]
+        for _ in range(3):
+            plan = reconcile.reconcile('eu-west-1', 'myAutoscalingGroup',
+                                       'localhost', 'test-log-group', 3,
+                                       self.cache)
+            nt.assert_true(plan.is_empty())
+        nt.assert_equals(mock_get_desired_members.call_count, 1)
+        nt.assert_equals(mock_get_log_streams.call_count, 1)
+
+    @patch('zkutils.reconcile.get_desired_members')
+    @patch('zkutils.reconcile.get_running_ips')
+    @patch('zkutils.ensemble._cmd_get_zookeeper_configuration')
+    @patch('zkutils.ensemble._cmd_reconfig')
+    @patch('zkutils.aws.get_log_streams')
+    def test_changes_are_made_on_a_fresh_listing(self,
+                                                 mock_get_log_streams,
+                                                 mock_cmd_reconfig,
+                                                 mock_cmd_get_configuration,
+                                                 mock_get_running_ips,
+                                                 mock_get_desired_members):
+        # The cached listing misses instance 3, which AWS lists again
+        cached = dict(self.members[0])
+        del cached['3']
+        self.cache.write('members', (cached, {}))
+        mock_get_desired_members.return_value = self.members
+        mock_get_running_ips.side_effect = lambda ips: list(ips)
+        mock_cmd_get_configuration.return_value = \
+            self.actual.serialize() + '\nversion=100000003'
+        mock_get_log_streams.return_value = []
+        plan = reconcile.reconcile('eu-west-1', 'myAutoscalingGroup',
+                                   'localhost', 'test-log-group', 3,
+                                   self.cache)
+        nt.assert_true(plan.is_empty())
+        nt.assert_equals(mock_get_desired_members.call_count, 1)
+        nt.assert_equals(mock_cmd_reconfig.call_count, 0)
+
+
+class TestAdminClient(object):
+    ''' Tests the JSON client of the AdminServer '''
+
+    def setup(self):
+        self.client = admin.AdminClient()
+        self.srvr = {
+            'version': '3.5.3-beta',
+            'server_stats': {
+                'server_state': 'follower',
+                'last_processed_zxid': 0x100000005,
+                'min_latency': 0,
+                'avg_latency': 1,
+                'max_latency': 12,
+                'outstanding_requests': 2,
+                'num_alive_client_connections': 7
+            },
+            'node_count': 42,
+            'command': 'server_stats',
+            'error': None
+        }
+
+    def _response(self, data, status_code=200):
+        return Mock(status_code=status_code, json=Mock(return_value=data))
+
+    def test_status_is_parsed(self):
+        with patch.object(self.client.session, 'get') as mock_get:
+            mock_get.return_value = self._response(self.srvr)
+            status = self.client.get_status('10.0.0.1')
+        mock_get.assert_called_once_with(
+            'http://10.0.0.1:8080/commands/srvr', timeout=admin.TIMEOUT)
+        nt.assert_equals(status, {
+            'mode': 'follower', 'zxid': 0x100000005, 'latency_min': 0.0,
+            'latency_avg': 1.0, 'latency_max': 12.0, 'outstanding': 2,
+            'connections': 7, 'node_count': 42
+        })
+
+    def test_connections_are_pooled(self):
+        adapter = self.client.session.get_adapter('http://10.0.0.1:8080')
+        nt.assert_equals(adapter._pool_maxsize, admin.POOL_SIZE)
+        nt.assert_true(
+            self.client.session.get_adapter('http://10.0.0.2:8080')
+                is adapter)
+
+    def test_not_serving_is_an_error(self):
+        with patch.object(self.client.session, 'get') as mock_get:
+            mock_get.return_value = self._response({
+                'command': 'server_stats',
+                'error': 'This ZooKeeper instance is not currently serving'
+            })
+            statuses = self.client.get_statuses(['10.0.0.1'])
+        nt.assert_equals(statuses, {'10.0.0.1': None})
+
+    @patch('zkutils.monitor.get_status')
+    def test_unreachable_admin_server_falls_back(self, mock_get_status):
+        mock_get_status.return_value = {'mode': 'leader', 'zxid': 1}
+        with patch.object(self.client.session, 'get') as mock_get:
+            mock_get.side_effect = \
+                requests.exceptions.ConnectionError('refused')
+            nt.assert_equals(self.client.get_status('10.0.0.1')['mode'],
+                             'leader')
+            nt.assert_equals(self.client.get_status('10.0.0.1')['mode'],
+                             'leader')
+        nt.assert_equals(mock_get.call_count, 1)
+        nt.assert_equals(mock_get_status.call_count, 2)
+        nt.assert_false(self.client.is_available('10.0.0.1'))
+
+
+class TestZkStatus(object):
+    ''' Tests the status of the members of the ensemble '''
+
+    def setup(self):
+        self.servers = [
+            config.Server(1, '10.0.0.1', role=None),
+            config.Server(2, '10.0.0.2', role=None)
+        ]
+        self.conf = config.DynamicConfig.parse('\n'.join([
+            'server.1=10.0.0.1:2888:3888:participant;2181',
+            'server.2=10.0.0.2:2888:3888:observer;2181',
+            'version=100000003'
+        ]))
+
+    @patch('zkutils.monitor.get_conf')
+    def test_members_are_queried(self, mock_get_conf):
+        mock_get_conf.return_value = self.conf
+        client = Mock()
+        client.get_status.side_effect = lambda ip: {
+            'mode': 'leader' if ip == '10.0.0.1' else 'observer',
+            'zxid': 0x100000005, 'latency_min': 0.0, 'latency_avg': 1.5,
+            'latency_max': 12.0, 'outstanding': 0, 'connections': 3
+        }
+        client.get_mntr.return_value = {'znode_count': 42}
+        client.timeout = status.TIMEOUT
+        statuses = status.get_statuses(self.servers, client)
+        mock_get_conf.assert_any_call('10.0.0.2', status.TIMEOUT)
+        nt.assert_equals([s['role'] for s in statuses],
+                         ['participant', 'observer'])
+        nt.assert_equals([s['mode'] for s in statuses], ['leader', 'observer'])
+        nt.assert_equals(statuses[1]['version'], '100000003')
+        nt.assert_equals(statuses[1]['znode_count'], 42)
+        lines = status.format_table(statuses).splitlines()
+        nt.assert_equals(lines[0].split()[:4], ['ID', 'IP', 'ROLE', 'MODE'])
+        nt.assert_equals(lines[1].split(), [
+            '1', '10.0.0.1', 'participant', 'leader', '0x100000005',
+            '0/1.5/12', '0', '3', '42', '100000003'
+        ])
+
+    @patch('zkutils.monitor.get_conf')
+    def test_member_not_serving_has_an_error(self, mock_get_conf):
+        mock_get_conf.return_value = self.conf
+        client = Mock()
+        client.get_status.side_effect = monitor.MonitorError('refused')
+        statuses = status.get_statuses(self.servers[:1], client)
+        nt.assert_equals(statuses[0]['error'], 'refused')
+        nt.assert_equals(
+            status.format_table(statuses).splitlines()[1].split(),
+            ['1', '10.0.0.1'] + ['-'] * 8 + ['refused']
+        )
+
+
+class TestZkDrift(object):
+    ''' Tests the drifts between the records of the membership '''
+
+    def setup(self):
+        self.members = [
+            {'id': '1', 'ip': '10.0.0.1', 'instance_id': 'i-1'},
+            {'id': '2', 'ip': '10.0.0.2', 'instance_id': 'i-2'}
+        ]
+        self.live = config.DynamicConfig.parse('\n'.join([
+            'server.1=10.0.0.1:2888:3888:participant;2181',
+            'server.2=10.0.0.2:2888:3888:participant;2181',
+            'server.3=10.0.0.3:2888:3888:participant;2181',
+            'version=100000003'
+        ]))
+        self.streams = [
+            {'logStreamName': '1', 'creationTime': 0},
+            {'logStreamName': '3', 'creationTime': 0},
+            {'logStreamName': '4', 'creationTime': 0}
+        ]
+
+    def _records(self, nodes=None):
+        if nodes is None:
+            nodes = {'1': self.live, '2': self.live.copy()}
+        return drift.Records(self.members, self.streams, self.live, nodes)
+
+    def test_drifts_are_found(self):
+        stale = config.DynamicConfig.parse(
+            'server.1=10.0.0.1:2888:3888:participant;2181\nversion=100000001')
+        drifts = drift.compute_drifts(
+            self._records({'1': self.live, '2': stale}), now=10000)
+        nt.assert_equals([(d.kind, d.server_id) for d in drifts], [
+            (drift.GHOST_VOTER, '3'),
+            (drift.MISSING_STREAM, '2'),
+            (drift.STALE_STREAM, '4'),
+            (drift.STALE_NODE_CONFIG, '2')
+        ])
+        lines = drift.report(self._records(), drifts)
+        nt.assert_equals(lines[-1],
+                         'quorum=2 of voters=3, without ghosts quorum=2')
+
+    def test_duplicates_are_found(self):
+        self.members.append(
+            {'id': '2', 'ip': '10.0.0.3', 'instance_id': 'i-3'})
+        self.live.add(config.Server(3, '10.0.0.2'))
+        drifts = drift.compute_drifts(self._records(), now=10000)
+        nt.assert_equals([(d.kind, d.server_id) for d in drifts
+                          if d.kind.startswith('duplicate')], [
+            (drift.DUPLICATE_ID, '2'),
+            (drift.DUPLICATE_IP, '2')
+        ])
+
+    @patch('zkutils.aws.create_log_stream')
+    @patch('zkutils.reconcile.reconcile')
+    def test_fix(self, mock_reconcile, mock_create_log_stream):
+        drifts = [
+            drift.Drift(drift.GHOST_VOTER, 3, 'ip=10.0.0.3'),
+            drift.Drift(drift.MISSING_STREAM, 2, 'claimable by others'),
+            drift.Drift(drift.MISSING_STREAM, 3, 'claimable by others'),
+            drift.Drift(drift.STALE_NODE_CONFIG, 2, 'version=1')
+        ]
+        fixed = drift.fix('us-east-1', 'zk', 'zk-logs', 'localhost', drifts)
+        nt.assert_equals(fixed, [drift.GHOST_VOTER, drift.MISSING_STREAM])
+        mock_reconcile.assert_called_once_with(
+            'us-east-1', 'zk', 'localhost', 'zk-logs', ANY)
+        mock_create_log_stream.assert_called_once_with(
+            'us-east-1', 'zk-logs', '2')
+
+    @patch('zkutils.monitor.get_conf')
+    @patch('zkutils.ensemble.get_zookeeper_configuration')
+    @patch('zkutils.aws.get_log_streams')
+    @patch('zkutils.drift.get_tagged_members')
+    def test_records_are_gathered(self, mock_members, mock_streams,
+                                  mock_live, mock_get_conf):
+        mock_members.return_value = self.members
+        mock_streams.return_value = self.streams
+        mock_live.return_value = self.live
+        mock_get_conf.side_effect = [self.live, monitor.MonitorError('down')]
+        records = drift.gather('us-east-1', 'zk', 'zk-logs', 'localhost')
+        mock_get_conf.assert_any_call('10.0.0.2', drift.CONF_TIMEOUT)
+        nt.assert_equals(records.live, self.live)
+        nt.assert_equals(sorted(records.nodes), ['1', '2'])
+        nt.assert_equals(
+            len([n for n in records.nodes.values() if n is None]), 1)
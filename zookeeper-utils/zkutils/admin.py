@@ -0,0 +1,166 @@
+import time
+import logging
+import threading
+
+import requests
+import requests.adapters
+
+import config, metrics, monitor
+
+
+log = logging.getLogger(__name__)
+
+TIMEOUT = 5 # seconds
+POOL_SIZE = 10 # connections per server
+# After a connection error, the AdminServer of the server is not tried
+# again for this long and the 4 letter words are used instead
+UNAVAILABLE_PERIOD = 60 # seconds
+
+
+class AdminError(monitor.MonitorError):
+   pass
+
+
+class AdminUnavailable(AdminError):
+   pass
+
+
+def parse_stat(data):
+   ''' Returns the server status of the `srvr` or `stat` command, with
+   the keys of `monitor.parse_srvr`. '''
+   stats = data.get('server_stats') or {}
+   if not stats.get('server_state'):
+      raise AdminError('Server is not serving: %s' % data.get('error'))
+   return {
+      'mode': stats['server_state'],
+      'zxid': int(stats.get('last_processed_zxid', 0)),
+      'latency_min': float(stats.get('min_latency', 0)),
+      'latency_avg': float(stats.get('avg_latency', 0)),
+      'latency_max': float(stats.get('max_latency', 0)),
+      'outstanding': int(stats.get('outstanding_requests', 0)),
+      'connections': int(stats.get('num_alive_client_connections', 0)),
+      'node_count': int(data.get('node_count', 0))
+   }
+
+
+class AdminClient(object):
+   ''' Client of the JSON commands of the AdminServer, e.g. `monitor`,
+   `srvr`, `conf` and `connections`, see
+   https://zookeeper.apache.org/doc/r3.5.3-beta/zookeeperAdmin.html
+
+   The HTTP connections to each server are kept alive in a pool, so
+   polling the servers does not open a connection per command. With
+   `fallback`, a server whose AdminServer cannot be reached, e.g. because
+   it is disabled, is queried with the 4 letter words instead, with the
+   same timeout.
+   '''
+
+   def __init__(self, port=config.ADMIN_PORT, timeout=TIMEOUT,
+                pool_size=POOL_SIZE, fallback=True):
+      self.port = port
+      self.timeout = timeout
+      self.fallback = fallback
+      self.session = requests.Session()
+      adapter = requests.adapters.HTTPAdapter(
+         pool_connections=pool_size,
+         pool_maxsize=pool_size,
+         max_retries=0
+      )
+      self.session.mount('http://', adapter)
+      self._lock = threading.Lock()
+      self._unavailable = {}
+
+   def url(self, ip, command):
+      return 'http://%s:%s/commands/%s' % (ip, self.port, command)
+
+   def is_available(self, ip):
+      with self._lock:
+         since = self._unavailable.get(ip)
+      return since is None or time.time() - since > UNAVAILABLE_PERIOD
+
+   def command(self, ip, command):
+      ''' Runs the command and returns its JSON response. '''
+      start = time.time()
+      try:
+         resp = self.session.get(self.url(ip, command), timeout=self.timeout)
+      except requests.exceptions.RequestException as ex:
+         with self._lock:
+            self._unavailable[ip] = time.time()
+         raise AdminUnavailable(
+            'Failed to connect to %s:%s, %s' % (ip, self.port, ex)
+         )
+      finally:
+         metrics.METRICS.observe(
+            'admin.%s.latency' % command,
+            time.time() - start
+         )
+      with self._lock:
+         self._unavailable.pop(ip, None)
+      if resp.status_code == 404:
+         raise AdminUnavailable('No command=%s on %s' % (command, ip))
+      try:
+         data = resp.json()
+      except ValueError as ex:
+         raise AdminError('Invalid response of %s to %s, %s' % (
+            ip, command, ex
+         ))
+      if resp.status_code != 200:
+         raise AdminError('Failed to run %s on %s, status=%s, error=%s' % (
+            command, ip, resp.status_code, data.get('error')
+         ))
+      return data
+
+   def get_status(self, ip):
+      ''' Returns the status of the server, see `parse_stat`. '''
+      if self.fallback and not self.is_available(ip):
+         return monitor.get_status(ip, self.timeout)
+      try:
+         return parse_stat(self.command(ip, 'srvr'))
+      except AdminUnavailable as ex:
+         if not self.fallback:
+            raise
+         log.info('Using the 4 letter words, %s' % ex)
+         return monitor.get_status(ip, self.timeout)
+
+   def get_monitor(self, ip):
+      ''' Returns the values of the `monitor` command, as `mntr` does. '''
+      data = self.command(ip, 'monitor')
+      if not data.get('server_state'):
+         raise AdminError('Server is not serving: %s' % data.get('error'))
+      return dict(
+         (k, v) for k, v in data.items() if k not in ('command', 'error')
+      )
+
+   def get_mntr(self, ip):
+      ''' Returns the `monitor` values of the server without the `zk_`
+      prefix of `mntr`, which is used if the AdminServer cannot be
+      reached. '''
+      if not self.fallback or self.is_available(ip):
+         try:
+            return self.get_monitor(ip)
+         except AdminUnavailable as ex:
+            if not self.fallback:
+               raise
+            log.info('Using the 4 letter words, %s' % ex)
+      return dict(
+         (k[len('zk_'):] if k.startswith('zk_') else k, v)
+            for k, v in monitor.get_mntr(ip, self.timeout).items()
+      )
+
+   def get_conf(self, ip):
+      ''' Returns the configuration of the server. '''
+      data = self.command(ip, 'conf')
+      return dict(
+         (k, v) for k, v in data.items() if k not in ('command', 'error')
+      )
+
+   def get_connections(self, ip):
+      ''' Returns the client connections of the server. '''
+      return self.command(ip, 'connections').get('connections', [])
+
+   def get_statuses(self, ips):
+      ''' Returns {ip: status} of the servers, see `monitor.get_statuses`. '''
+      return monitor.get_statuses(ips, self)
+
+   def close(self):
+      self.session.close()
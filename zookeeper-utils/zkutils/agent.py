@@ -0,0 +1,46 @@
+import time
+import logging
+
+
+log = logging.getLogger(__name__)
+
+ERROR_DELAY = 60 # seconds
+
+
+class Agent(object):
+   ''' Runs the periodic zkutils tasks of a Zookeeper instance.
+
+   A task is a function that returns the number of seconds to wait
+   before it should run again. A failing task is retried after
+   ERROR_DELAY seconds.
+   '''
+
+   def __init__(self):
+      self._tasks = {}
+
+   def add_task(self, name, func, delay=0):
+      ''' Schedules the task to first run after `delay` seconds. '''
+      self._tasks[name] = [time.time() + delay, func]
+
+   def run_pending(self):
+      ''' Runs the tasks that are due and returns the number of seconds
+      until the next task is due. '''
+      for name, task in sorted(self._tasks.items()):
+         next_run, func = task
+         if next_run > time.time():
+            continue
+         try:
+            delay = func()
+         except Exception as ex:
+            log.exception('Task failed, name=%s, error=%s' % (name, ex))
+            delay = ERROR_DELAY
+         task[0] = time.time() + delay
+      if not self._tasks:
+         return ERROR_DELAY
+      next_run = min(task[0] for task in self._tasks.values())
+      return max(next_run - time.time(), 0)
+
+   def run_forever(self):
+      log.info('Running agent with tasks=%s' % sorted(self._tasks))
+      while True:
+         time.sleep(self.run_pending())
@@ -1,12 +1,181 @@
+import time
+import atexit
 import logging
+import functools
+import threading
 
 import boto3
 import botocore
+import botocore.config
 import requests
 
+import metrics, retry
+
 
 log = logging.getLogger(__name__)
 
+# Backoff of the waits on SSM commands, see `run_shell_command`
+COMMAND_BACKOFF = retry.Backoff(2, 30)
+STACK_NAME_TAG = 'aws:cloudformation:stack-name'
+LOGICAL_ID_TAG = 'aws:cloudformation:logical-id'
+# Calls per second and burst of each instance to a service, see
+# `TokenBucket`. A whole group booting at once stays below the account
+# limits, e.g. 5 DescribeLogStreams per second for the account.
+RATE_LIMITS = {
+   'autoscaling': (1, 3),
+   'ec2': (2, 5),
+   'logs': (0.5, 2)
+}
+DEFAULT_RATE_LIMIT = (2, 5)
+# Throttled calls are retried with a backoff and the adaptive mode also
+# slows the client down to the rate the service accepts
+CLIENT_CONFIG = botocore.config.Config(
+   retries={'mode': 'adaptive', 'max_attempts': 10}
+)
+THROTTLE_CODES = set([
+   'Throttling',
+   'ThrottlingException',
+   'ThrottledException',
+   'RequestThrottled',
+   'RequestThrottledException',
+   'RequestLimitExceeded',
+   'TooManyRequestsException',
+   'SlowDown'
+])
+# Key of the start time of a call in its botocore request context
+CALL_START = 'zkutils_call_start'
+
+
+class TokenBucket(object):
+   ''' Allows `rate` calls per second on average, in bursts of up to
+   `burst` calls. '''
+
+   def __init__(self, rate, burst, clock=time.time):
+      self.rate = rate
+      self.burst = burst
+      self.tokens = float(burst)
+      self.clock = clock
+      self.updated = clock()
+      self._lock = threading.Lock()
+
+   def take(self):
+      ''' Takes a token if there is one and returns 0, otherwise returns
+      the seconds until there is one. '''
+      with self._lock:
+         now = self.clock()
+         self.tokens = min(
+            self.burst,
+            self.tokens + (now - self.updated) * self.rate
+         )
+         self.updated = now
+         if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+         return (1 - self.tokens) / self.rate
+
+   def acquire(self):
+      ''' Waits for a token and returns the seconds waited. '''
+      waited = 0
+      delay = self.take()
+      while delay:
+         time.sleep(delay)
+         waited += delay
+         delay = self.take()
+      return waited
+
+
+_lock = threading.RLock()
+_buckets = {}
+_clients = {}
+
+
+def get_bucket(service):
+   ''' Returns the token bucket of the service, shared by the process. '''
+   with _lock:
+      if service not in _buckets:
+         rate, burst = RATE_LIMITS.get(service, DEFAULT_RATE_LIMIT)
+         _buckets[service] = TokenBucket(rate, burst)
+      return _buckets[service]
+
+
+def _on_call(service, event_name, context, **kwargs):
+   ''' Counts a call and records when it started. '''
+   operation = event_name.split('.')[-1]
+   context[CALL_START] = time.time()
+   metrics.METRICS.incr('aws.%s.%s.calls' % (service, operation))
+
+
+def _on_call_done(service, event_name, context, parsed=None,
+                  http_response=None, exception=None, **kwargs):
+   ''' Records the latency of a call, retries and rate limit waits
+   included, along with its retries and errors. '''
+   operation = event_name.split('.')[-1]
+   name = 'aws.%s.%s' % (service, operation)
+   start = context.pop(CALL_START, None)
+   if start is not None:
+      metrics.METRICS.observe('%s.latency' % name, time.time() - start)
+   retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts')
+   if retries:
+      metrics.METRICS.incr('%s.retries' % name, retries)
+   if exception is not None or \
+         (http_response is not None and http_response.status_code >= 300):
+      metrics.METRICS.incr('%s.errors' % name)
+
+
+def _on_send(service, bucket, event_name, **kwargs):
+   ''' Waits for the bucket before each attempt of a call. '''
+   operation = event_name.split('.')[-1]
+   waited = bucket.acquire()
+   metrics.METRICS.incr('aws.%s.%s.attempts' % (service, operation))
+   if waited:
+      metrics.METRICS.observe('aws.%s.rate_limited' % service, waited)
+
+
+def _on_retry(service, event_name, response=None, attempts=None, **kwargs):
+   ''' Counts the throttled attempts of a call. '''
+   if not response:
+      return
+   code = response[1].get('Error', {}).get('Code')
+   if code in THROTTLE_CODES:
+      operation = event_name.split('.')[-1]
+      metrics.METRICS.incr('aws.%s.%s.throttled' % (service, operation))
+      log.info('Throttled call=%s.%s, attempt=%s, code=%s' % (
+         service, operation, attempts, code
+      ))
+
+
+def instrument(client, service):
+   ''' Hooks the events of the client to rate limit its calls and to
+   record their count, latency, retries, throttles and errors in
+   `metrics.METRICS`, under `aws.<service>.<operation>`. '''
+   events = client.meta.events
+   events.register('before-call', functools.partial(_on_call, service))
+   events.register('after-call', functools.partial(_on_call_done, service))
+   events.register(
+      'after-call-error',
+      functools.partial(_on_call_done, service)
+   )
+   events.register(
+      'before-send',
+      functools.partial(_on_send, service, get_bucket(service))
+   )
+   events.register('needs-retry', functools.partial(_on_retry, service))
+
+
+def get_client(service, region):
+   ''' Returns the client of the service, shared by the process so that
+   the adaptive retries learn the rate the service accepts, see
+   `instrument`. The AWS metrics are summarized in the log at exit. '''
+   key = (service, region)
+   with _lock:
+      if not _clients:
+         atexit.register(metrics.METRICS.log_summary, 'aws.')
+      if key not in _clients:
+         client = boto3.client(service, region, config=CLIENT_CONFIG)
+         instrument(client, service)
+         _clients[key] = client
+      return _clients[key]
+
 
 def get_instance_id():
    ''' Returns the current EC2's instance id. '''
@@ -15,10 +184,32 @@ def get_instance_id():
    return instance_id
 
 
+def get_availability_zone():
+   ''' Returns the availability zone of the current EC2 instance. '''
+   resp = requests.get(
+      'http://169.254.169.254/latest/meta-data/placement/availability-zone',
+      timeout=2
+   )
+   return resp.text
+
+
+def get_target_lifecycle_state():
+   ''' Returns the lifecycle state the autoscaling group is moving the
+   current EC2 instance to, e.g. InService or Terminated. '''
+   resp = requests.get(
+      'http://169.254.169.254/latest/meta-data/autoscaling/'
+      'target-lifecycle-state',
+      timeout=2
+   )
+   if resp.status_code != 200:
+      return None
+   return resp.text
+
+
 def get_tag(region, instance_id, tag_key):
    ''' Gets the current EC2 tag for an EC2 instance
    if there is any tag set. '''
-   ec2 = boto3.client('ec2', region)
+   ec2 = get_client('ec2', region)
    response = ec2.describe_instances(InstanceIds=[instance_id])
    instance = response['Reservations'][0]['Instances'][0]
    tags = instance['Tags']
@@ -31,20 +222,20 @@ def get_tag(region, instance_id, tag_key):
 
 def set_tag(region, instance_id, tag_key, tag_value):
    ''' Sets the EC2 tag on the current instance. '''
-   ec2 = boto3.resource('ec2', region)
-   tag = ec2.create_tags(
-            Resources=[instance_id],
-            Tags=[
-               {
-                  'Key': tag_key,
-                  'Value': tag_value
-               }
-            ]
-         )
+   ec2 = get_client('ec2', region)
+   ec2.create_tags(
+      Resources=[instance_id],
+      Tags=[
+         {
+            'Key': tag_key,
+            'Value': tag_value
+         }
+      ]
+   )
 
 
 def create_log_stream(region, group_name, stream_name):
-   cwlogs = boto3.client('logs', region)
+   cwlogs = get_client('logs', region)
    try:
       cwlogs.create_log_stream(
          logGroupName=group_name,
@@ -60,7 +251,7 @@ def create_log_stream(region, group_name, stream_name):
 
 
 def get_log_streams(region, group_name):
-   cwlogs = boto3.client('logs', region)
+   cwlogs = get_client('logs', region)
    response = cwlogs.describe_log_streams(logGroupName=group_name)
    streams = response['logStreams']
    return streams
@@ -68,7 +259,7 @@ def get_log_streams(region, group_name):
 
 def delete_log_streams(region, log_group, stream_names):
    ''' Deletes log streams. '''
-   cwlogs = boto3.client('logs', region)
+   cwlogs = get_client('logs', region)
    for name in stream_names:
       try:
          cwlogs.delete_log_stream(
@@ -83,7 +274,7 @@ def delete_log_streams(region, log_group, stream_names):
 
 def get_running_instances(region, tag_value_pairs):
    ''' Returns running EC2 instances that have the desired tags. '''
-   ec2 = boto3.client('ec2', region)
+   ec2 = get_client('ec2', region)
    filters = [
       {
          'Name': 'tag:%s' % key,
@@ -104,7 +295,7 @@ def get_running_instances(region, tag_value_pairs):
 
 def get_autoscaling_group(region, autoscaling_tag, instance_id):
    ''' Returns the autoscaling group of the current EC2 instance '''
-   ec2 = boto3.client('ec2', region)
+   ec2 = get_client('ec2', region)
    response = ec2.describe_instances(InstanceIds=[instance_id])
    instance = response['Reservations'][0]['Instances'][0]
    tags = instance['Tags']
@@ -114,9 +305,125 @@ def get_autoscaling_group(region, autoscaling_tag, instance_id):
          asgroup_name = tag["Value"]
          break
 
-   autoscaling = boto3.client('autoscaling', region)
+   autoscaling = get_client('autoscaling', region)
    response = autoscaling.describe_auto_scaling_groups(
       AutoScalingGroupNames=[asgroup_name]
    )
    asgroup = response['AutoScalingGroups'][0]
    return asgroup
+
+
+def describe_autoscaling_group(region, asgroup_name):
+   ''' Returns the autoscaling group with the given name. '''
+   autoscaling = get_client('autoscaling', region)
+   response = autoscaling.describe_auto_scaling_groups(
+      AutoScalingGroupNames=[asgroup_name]
+   )
+   return response['AutoScalingGroups'][0]
+
+
+def terminate_instance(region, instance_id):
+   ''' Terminates an instance of an autoscaling group without decrementing
+   its desired capacity, so that the group launches a replacement. '''
+   autoscaling = get_client('autoscaling', region)
+   autoscaling.terminate_instance_in_auto_scaling_group(
+      InstanceId=instance_id,
+      ShouldDecrementDesiredCapacity=False
+   )
+   log.info('Terminated instance_id=%s' % instance_id)
+
+
+def complete_lifecycle_action(region, asgroup_name, hook_name, instance_id,
+                              result='CONTINUE'):
+   ''' Completes the lifecycle action of the instance so that the
+   autoscaling group carries on with it. '''
+   autoscaling = get_client('autoscaling', region)
+   try:
+      autoscaling.complete_lifecycle_action(
+         AutoScalingGroupName=asgroup_name,
+         LifecycleHookName=hook_name,
+         InstanceId=instance_id,
+         LifecycleActionResult=result
+      )
+   except botocore.exceptions.ClientError as ex:
+      if ex.response['Error']['Code'] != 'ValidationError':
+         raise
+      log.info('No lifecycle action to complete, %s' % ex)
+      return False
+   log.info('Completed lifecycle action, hook=%s, result=%s' % (
+      hook_name, result
+   ))
+   return True
+
+
+def run_shell_command(region, instance_id, command, timeout=600):
+   ''' Runs a shell command on an instance with SSM and waits for it.
+   Returns the output of the command. '''
+   ssm = get_client('ssm', region)
+   response = ssm.send_command(
+      InstanceIds=[instance_id],
+      DocumentName='AWS-RunShellScript',
+      Parameters={'commands': [command]},
+      TimeoutSeconds=timeout
+   )
+   command_id = response['Command']['CommandId']
+   log.info('Sent command_id=%s to instance_id=%s' % (command_id, instance_id))
+
+   def get_output():
+      try:
+         invocation = ssm.get_command_invocation(
+            CommandId=command_id,
+            InstanceId=instance_id
+         )
+      except botocore.exceptions.ClientError as ex:
+         if ex.response['Error']['Code'] == 'InvocationDoesNotExist':
+            return None
+         raise
+      status = invocation['Status']
+      if status == 'Success':
+         # The output may be empty
+         return [invocation['StandardOutputContent']]
+      if status not in ('Pending', 'InProgress', 'Delayed'):
+         raise Exception('Command failed on %s, status=%s, stderr=%s' % (
+            instance_id, status, invocation['StandardErrorContent']
+         ))
+      return None
+
+   try:
+      return retry.poll(
+         get_output,
+         COMMAND_BACKOFF,
+         retry.Deadline(timeout)
+      )[0]
+   except retry.DeadlineExceeded:
+      raise Exception('Command timed out on %s' % instance_id)
+
+
+def signal_resource(region, instance_id, success):
+   ''' Sends the CloudFormation resource signal of the instance. The stack
+   and resource are read from the tags CloudFormation sets on the instance.
+   Returns False if there is no such stack or the signal is not expected.
+   '''
+   stack_name = get_tag(region, instance_id, STACK_NAME_TAG)
+   logical_id = get_tag(region, instance_id, LOGICAL_ID_TAG)
+   if not stack_name or not logical_id:
+      log.info('Not launched by CloudFormation, skipping signal')
+      return False
+   cloudformation = get_client('cloudformation', region)
+   status = 'SUCCESS' if success else 'FAILURE'
+   try:
+      cloudformation.signal_resource(
+         StackName=stack_name,
+         LogicalResourceId=logical_id,
+         UniqueId=instance_id,
+         Status=status
+      )
+   except botocore.exceptions.ClientError as ex:
+      if ex.response['Error']['Code'] != 'ValidationError':
+         raise
+      log.info('Signal not expected, %s' % ex)
+      return False
+   log.info('Signaled stack=%s, resource=%s, status=%s' % (
+      stack_name, logical_id, status
+   ))
+   return True
@@ -0,0 +1,131 @@
+import os
+import time
+import logging
+import threading
+
+import aws, ensemble, state
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = '/var/cache/zkutils'
+INSTANCE_NAMESPACE = 'instance'
+KEY_INSTANCE_ID = 'instance_id'
+KEY_ASGROUP = 'asgroup'
+KEY_MEMBERS = 'members'
+KEY_STREAMS = 'streams'
+# Entries that a change of the ensemble membership invalidates
+MEMBERSHIP_KEYS = [KEY_MEMBERS, KEY_STREAMS]
+INSTANCE_ID_TTL = 7 * 86400 # seconds
+ASGROUP_TTL = 3600 # seconds
+ASGROUP_STALE_TTL = 86400 # seconds
+# The details of the autoscaling group that are cached
+ASGROUP_KEYS = ['AutoScalingGroupName', 'DesiredCapacity']
+
+
+class Cache(object):
+   ''' A cache of JSON values on disk, shared by the runs of the zkutils
+   scripts and of the agent. Each namespace, e.g. the name of an
+   autoscaling group, is a directory with one file per key.
+
+   The cache is best effort: if the directory cannot be written, values
+   are loaded on every read.
+   '''
+
+   def __init__(self, namespace, directory=DEFAULT_CACHE_DIR):
+      self.directory = os.path.join(directory, namespace)
+      self._lock = threading.Lock()
+      self._revalidating = set()
+
+   def path(self, key):
+      return os.path.join(self.directory, '%s.json' % key)
+
+   def read(self, key):
+      ''' Returns the (value, age in seconds) of the entry, (None, None)
+      if there is none. '''
+      entry = None
+      if os.path.exists(self.path(key)):
+         entry = state.load(self.path(key))
+      if not entry:
+         return None, None
+      return entry['value'], max(0, time.time() - entry['stored'])
+
+   def write(self, key, value):
+      try:
+         if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+         state.save(self.path(key), {'stored': time.time(), 'value': value})
+      except (IOError, OSError) as ex:
+         log.warn('Not cached, key=%s, %s' % (key, ex))
+
+   def invalidate(self, *keys):
+      for key in keys:
+         if os.path.exists(self.path(key)):
+            state.clear(self.path(key))
+            log.info('Invalidated key=%s in dir=%s' % (key, self.directory))
+
+   def get(self, key, load, ttl, stale_ttl=0):
+      ''' Returns the value of the entry while it is younger than `ttl`.
+
+      Up to `stale_ttl` seconds later, the stale value is returned right
+      away and `load` is called in the background to refresh the entry.
+      Otherwise `load` is called and its value cached and returned.
+      '''
+      value, age = self.read(key)
+      if age is not None and age < ttl:
+         return value
+      if age is not None and age < ttl + stale_ttl:
+         self.revalidate(key, load)
+         return value
+      value = load()
+      self.write(key, value)
+      return value
+
+   def revalidate(self, key, load):
+      ''' Refreshes the entry in a thread. The process waits for it on
+      exit, so a short lived script still refreshes the cache. '''
+      with self._lock:
+         if key in self._revalidating:
+            return None
+         self._revalidating.add(key)
+
+      def refresh():
+         try:
+            self.write(key, load())
+            log.info('Revalidated key=%s in dir=%s' % (key, self.directory))
+         except Exception as ex:
+            log.error('Failed to revalidate key=%s, %s' % (key, ex))
+         finally:
+            with self._lock:
+               self._revalidating.discard(key)
+
+      thread = threading.Thread(target=refresh, name='revalidate-%s' % key)
+      thread.start()
+      return thread
+
+
+def get_instance_id(directory=DEFAULT_CACHE_DIR):
+   ''' Returns the id of the current EC2 instance, which never changes. '''
+   return Cache(INSTANCE_NAMESPACE, directory).get(
+      KEY_INSTANCE_ID,
+      aws.get_instance_id,
+      INSTANCE_ID_TTL
+   )
+
+
+def get_autoscaling_group(region, instance_id, directory=DEFAULT_CACHE_DIR):
+   ''' Returns the ASGROUP_KEYS of the autoscaling group of the instance,
+   refreshed in the background once they are an hour old. '''
+   def load():
+      asgroup = aws.get_autoscaling_group(
+         region,
+         ensemble.ASGROUP_TAG,
+         instance_id
+      )
+      return dict((k, asgroup[k]) for k in ASGROUP_KEYS)
+   return Cache(INSTANCE_NAMESPACE, directory).get(
+      KEY_ASGROUP,
+      load,
+      ASGROUP_TTL,
+      ASGROUP_STALE_TTL
+   )
@@ -0,0 +1,90 @@
+import logging
+import contextlib
+
+from kazoo.client import KazooClient
+from kazoo.exceptions import KazooException
+from kazoo.handlers.threading import KazooTimeoutError
+
+import config, monitor
+
+
+log = logging.getLogger(__name__)
+
+TIMEOUT = 10 # seconds
+CONFIG_PATH = '/zookeeper/config'
+# Errors of a session, including failing to connect
+ERRORS = (KazooException, KazooTimeoutError)
+LEADER_INTERVAL = 2 # seconds
+IDLE_INTERVAL = 10 # seconds
+
+
+def connect(ip='localhost', port=config.CLIENT_PORT, timeout=TIMEOUT):
+   ''' Returns a started Zookeeper client session to the server. '''
+   client = KazooClient(hosts='%s:%s' % (ip, port), timeout=timeout)
+   client.start(timeout=timeout)
+   return client
+
+
+@contextlib.contextmanager
+def session(ip='localhost', port=config.CLIENT_PORT, timeout=TIMEOUT):
+   ''' Yields a client session that is closed on exit. '''
+   client = connect(ip, port, timeout)
+   try:
+      yield client
+   finally:
+      client.stop()
+      client.close()
+
+
+def get_configuration(client):
+   ''' Returns the live dynamic configuration through the session. '''
+   data, _ = client.get(CONFIG_PATH)
+   return config.DynamicConfig.parse(data.decode('utf-8'))
+
+
+def reconfig(zk_client, plan):
+   ''' Applies the plan as one reconfig conditional on its version.
+   Raises BadVersionError if the config changed in the meantime. '''
+   if plan.is_empty():
+      return False
+   zk_client.reconfig(
+      joining=','.join(str(s) for s in plan.joining) or None,
+      leaving=','.join(plan.leaving) or None,
+      new_members=None,
+      from_config=int(plan.version, 16) if plan.version else -1
+   )
+   return True
+
+
+def leader_task(func, ip='localhost', interval=LEADER_INTERVAL,
+                idle_interval=IDLE_INTERVAL):
+   ''' Returns an agent task that calls `func` with a client session
+   every `interval` seconds while the server is the leader. The session
+   is kept open between calls and closed once the server is not the
+   leader anymore or the session failed.
+   '''
+   sessions = []
+
+   def close():
+      while sessions:
+         zk_client = sessions.pop()
+         zk_client.stop()
+         zk_client.close()
+
+   def task():
+      try:
+         mode = monitor.get_status(ip)['mode']
+      except monitor.MonitorError:
+         mode = None
+      if mode != monitor.MODE_LEADER:
+         close()
+         return idle_interval
+      if not sessions:
+         sessions.append(connect(ip))
+      try:
+         func(sessions[0])
+      except ERRORS:
+         close()
+         raise
+      return interval
+   return task
@@ -0,0 +1,249 @@
+import logging
+
+import utils
+
+
+log = logging.getLogger(__name__)
+
+QUORUM_PORT = 2888
+ELECTION_PORT = 3888
+CLIENT_PORT = 2181
+# Port of the AdminServer, admin.serverPort in zoo.cfg
+ADMIN_PORT = 8080
+ROLE_PARTICIPANT = 'participant'
+ROLE_OBSERVER = 'observer'
+SERVER_PREFIX = 'server.'
+VERSION_KEY = 'version'
+
+
+class ConfigError(Exception):
+   pass
+
+
+class StaticConfig(object):
+   ''' The static Zookeeper configuration (zoo.cfg).
+
+   The lines are kept in order together with comments and blank lines
+   so that serializing an unchanged config gives back the same content.
+   '''
+
+   def __init__(self, lines=None):
+      # Each line is either a (key, value) pair or a raw string
+      self._lines = list(lines or [])
+
+   @classmethod
+   def parse(cls, content):
+      lines = []
+      for line in content.splitlines():
+         stripped = line.strip()
+         if not stripped or stripped.startswith('#') or '=' not in stripped:
+            lines.append(line)
+            continue
+         key, value = stripped.split('=', 1)
+         lines.append((key.strip(), value.strip()))
+      return cls(lines)
+
+   @classmethod
+   def load(cls, filename):
+      with open(filename, 'r') as fread:
+         return cls.parse(fread.read())
+
+   def items(self):
+      return [line for line in self._lines if isinstance(line, tuple)]
+
+   def get(self, key, default=None):
+      return dict(self.items()).get(key, default)
+
+   def set(self, key, value):
+      value = str(value)
+      for i, line in enumerate(self._lines):
+         if isinstance(line, tuple) and line[0] == key:
+            self._lines[i] = (key, value)
+            return
+      self._lines.append((key, value))
+
+   def update(self, settings):
+      for key, value in sorted(settings.items()):
+         self.set(key, value)
+
+   def remove(self, key):
+      self._lines = [
+         line for line in self._lines
+            if not (isinstance(line, tuple) and line[0] == key)
+      ]
+
+   def diff(self, other):
+      ''' Returns {key: (old value, new value)} of the settings that differ
+      from the other config. A missing setting has a value of None. '''
+      mine = dict(self.items())
+      theirs = dict(other.items())
+      return dict(
+         (key, (mine.get(key), theirs.get(key)))
+            for key in set(mine) | set(theirs)
+               if mine.get(key) != theirs.get(key)
+      )
+
+   def serialize(self):
+      lines = [
+         '%s=%s' % line if isinstance(line, tuple) else line
+            for line in self._lines
+      ]
+      return '\n'.join(lines) + '\n'
+
+   def save(self, filename):
+      ''' Atomically saves the config in a single write. '''
+      return utils.save_to_file(filename, self.serialize())
+
+
+class Server(object):
+   ''' A server line of the dynamic configuration:
+
+      server.<id>=<ip>:<quorum port>:<election port>:<role>;<client port>
+   '''
+
+   def __init__(self, server_id, ip,
+                quorum_port=QUORUM_PORT,
+                election_port=ELECTION_PORT,
+                role=ROLE_PARTICIPANT,
+                client_port=CLIENT_PORT,
+                client_ip=None):
+      self.id = str(server_id)
+      self.ip = ip
+      self.quorum_port = int(quorum_port)
+      self.election_port = int(election_port)
+      self.role = role
+      self.client_port = int(client_port)
+      self.client_ip = client_ip
+
+   @classmethod
+   def parse(cls, line):
+      try:
+         key, value = line.strip().split('=', 1)
+         if not key.startswith(SERVER_PREFIX):
+            raise ValueError(key)
+         server_id = key[len(SERVER_PREFIX):]
+         addresses, _, client = value.partition(';')
+         parts = addresses.split(':')
+         ip, quorum_port, election_port = parts[:3]
+         role = parts[3] if len(parts) > 3 else ROLE_PARTICIPANT
+         client_ip = None
+         client_port = CLIENT_PORT
+         if client:
+            if ':' in client:
+               client_ip, client_port = client.rsplit(':', 1)
+            else:
+               client_port = client
+         return cls(server_id, ip, quorum_port, election_port,
+                    role, client_port, client_ip)
+      except ValueError:
+         raise ConfigError('Invalid server line: %s' % line)
+
+   @property
+   def key(self):
+      return '%s%s' % (SERVER_PREFIX, self.id)
+
+   @property
+   def is_participant(self):
+      return self.role == ROLE_PARTICIPANT
+
+   def with_role(self, role):
+      return Server(self.id, self.ip, self.quorum_port, self.election_port,
+                    role, self.client_port, self.client_ip)
+
+   def __str__(self):
+      client = str(self.client_port)
+      if self.client_ip:
+         client = '%s:%s' % (self.client_ip, client)
+      return '{key}={ip}:{quorum_port}:{election_port}:{role};{client}'\
+         .format(
+            key=self.key,
+            ip=self.ip,
+            quorum_port=self.quorum_port,
+            election_port=self.election_port,
+            role=self.role,
+            client=client
+         )
+
+   def __repr__(self):
+      return 'Server(%s)' % self
+
+   def __eq__(self, other):
+      return isinstance(other, Server) and str(self) == str(other)
+
+   def __ne__(self, other):
+      return not self == other
+
+   def __hash__(self):
+      return hash(str(self))
+
+
+class DynamicConfig(object):
+   ''' The dynamic Zookeeper configuration, i.e. the content of the
+   dynamic config file or of the /zookeeper/config znode. '''
+
+   def __init__(self, servers=None, version=None):
+      self.servers = dict((s.id, s) for s in servers or [])
+      self.version = version
+
+   @classmethod
+   def parse(cls, content):
+      servers = []
+      version = None
+      for line in content.splitlines():
+         line = line.strip()
+         if line.startswith(SERVER_PREFIX):
+            servers.append(Server.parse(line))
+         elif line.startswith(VERSION_KEY + '='):
+            version = line.split('=', 1)[1]
+      return cls(servers, version)
+
+   @classmethod
+   def load(cls, filename):
+      with open(filename, 'r') as fread:
+         return cls.parse(fread.read())
+
+   def get(self, server_id):
+      return self.servers.get(str(server_id))
+
+   def add(self, server):
+      self.servers[server.id] = server
+
+   def remove(self, server_id):
+      return self.servers.pop(str(server_id), None)
+
+   def ids(self):
+      return sorted(self.servers, key=int)
+
+   def sorted_servers(self):
+      return [self.servers[server_id] for server_id in self.ids()]
+
+   def participants(self):
+      return [s for s in self.sorted_servers() if s.is_participant]
+
+   def observers(self):
+      return [s for s in self.sorted_servers() if not s.is_participant]
+
+   def copy(self):
+      return DynamicConfig(self.sorted_servers(), self.version)
+
+   def diff(self, other):
+      ''' Returns the minimal incremental reconfig that turns this config
+      into the other one as a (joining servers, leaving ids) pair.
+
+      A server whose address or role changed is joining again with its
+      new line, which is how Zookeeper changes a member in place.
+      '''
+      joining = [
+         s for s in other.sorted_servers() if self.get(s.id) != s
+      ]
+      leaving = [
+         server_id for server_id in self.ids()
+            if other.get(server_id) is None
+      ]
+      return joining, leaving
+
+   def serialize(self):
+      return '\n'.join(str(s) for s in self.sorted_servers())
+
+   def save(self, filename):
+      return utils.save_to_file(filename, self.serialize())
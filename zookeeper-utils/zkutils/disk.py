@@ -0,0 +1,161 @@
+import os
+import logging
+
+import tuning, utils
+
+
+log = logging.getLogger(__name__)
+
+ZK_USER = 'zookeeper'
+FILESYSTEM = 'ext4'
+MOUNT_OPTIONS = 'defaults,noatime,nofail'
+FSTAB_FILE = '/etc/fstab'
+# Label of the filesystems this module creates, so that a disk formatted
+# by a bootstrap that failed before mounting it is found again
+LABEL = 'zk-txlog'
+
+# Instance store NVMe disks have the lowest fsync latency,
+# an extra EBS volume comes next.
+DEVICE_PREFERENCE = [tuning.DISK_NVME, tuning.DISK_EBS]
+
+
+def _cmd_list_block_devices():
+   return utils.run_command(
+      """lsblk -pnro NAME,PKNAME,TYPE,FSTYPE,MOUNTPOINT,LABEL"""
+   )
+
+
+def _cmd_format_device(device):
+   return utils.run_command(
+      """mkfs.{fs} -q -F -L {label} {device}""".format(
+         fs=FILESYSTEM,
+         label=LABEL,
+         device=device
+      )
+   )
+
+
+def _cmd_get_uuid(device):
+   return utils.run_command(
+      """blkid -s UUID -o value {device}""".format(device=device)
+   )
+
+
+def _cmd_mount(directory):
+   return utils.run_command(
+      """mount {directory}""".format(directory=directory)
+   )
+
+
+def _cmd_set_owner(directory):
+   return utils.run_command(
+      """chown -R {user}:{user} {directory}""".format(
+         user=ZK_USER,
+         directory=directory
+      )
+   )
+
+
+def list_block_devices():
+   ''' Returns the (name, parent, type, fstype, mountpoint, label) of the
+   block devices, with empty strings for the missing values. '''
+   return [
+      tuple((line.split(' ') + [''] * 6)[:6])
+         for line in _cmd_list_block_devices().splitlines()
+   ]
+
+
+def get_unused_disks():
+   ''' Returns the disks that have no filesystem, no partitions
+   and are not mounted. '''
+   disks = []
+   parents = set()
+   for name, parent, device_type, fstype, mountpoint, _ in \
+         list_block_devices():
+      if parent:
+         parents.add(parent)
+      if device_type == 'disk' and not fstype and not mountpoint:
+         disks.append(name)
+   return [d for d in disks if d not in parents]
+
+
+def find_formatted_device():
+   ''' Returns the device that was formatted for the transaction log but
+   is not mounted, e.g. because the bootstrap failed in between, or None
+   if there is no such device. '''
+   for name, _, _, fstype, mountpoint, label in list_block_devices():
+      if label == LABEL and fstype == FILESYSTEM and not mountpoint:
+         return name
+   return None
+
+
+def find_data_log_device():
+   ''' Returns the best unused disk for the transaction log,
+   or None if there is no such disk. '''
+   candidates = []
+   for device in get_unused_disks():
+      sysfs_path = '/sys/block/%s' % os.path.basename(device)
+      try:
+         device_type = tuning.get_device_type(sysfs_path)
+      except (IOError, OSError) as ex:
+         log.warn('Skipping device=%s, error=%s' % (device, ex))
+         continue
+      if device_type in DEVICE_PREFERENCE:
+         candidates.append((DEVICE_PREFERENCE.index(device_type), device))
+   if not candidates:
+      return None
+   return sorted(candidates)[0][1]
+
+
+def add_to_fstab(device, directory):
+   ''' Adds the device to fstab so that it is mounted again on reboot. '''
+   uuid = _cmd_get_uuid(device)
+   with open(FSTAB_FILE, 'r') as fread:
+      content = fread.read()
+   entry = 'UUID={uuid} {directory} {fs} {options} 0 2'.format(
+      uuid=uuid,
+      directory=directory,
+      fs=FILESYSTEM,
+      options=MOUNT_OPTIONS
+   )
+   lines = [
+      line for line in content.splitlines()
+         if line.split()[1:2] != [directory]
+   ]
+   lines.append(entry)
+   utils.save_to_file(FSTAB_FILE, '\n'.join(lines) + '\n')
+
+
+def prepare_data_log_dir(data_log_dir):
+   ''' Prepares a dedicated transaction log directory.
+
+   If the directory is not already a mountpoint, the best unused local
+   NVMe or extra EBS disk is formatted and mounted on it. Without such
+   a disk the directory stays on the root volume.
+
+   A disk formatted by an earlier run that failed before mounting it, i.e.
+   with the LABEL filesystem but not mounted, is mounted without being
+   formatted again.
+   '''
+   if not os.path.isdir(data_log_dir):
+      os.makedirs(data_log_dir)
+   if os.path.ismount(data_log_dir):
+      log.info('Data log dir already mounted, dir=%s' % data_log_dir)
+      _cmd_set_owner(data_log_dir)
+      return
+   device = find_formatted_device()
+   if device:
+      log.info('Mounting formatted device=%s on dir=%s' % (
+         device, data_log_dir
+      ))
+   else:
+      device = find_data_log_device()
+      if device:
+         log.info('Formatting device=%s for dir=%s' % (device, data_log_dir))
+         _cmd_format_device(device)
+   if device:
+      add_to_fstab(device, data_log_dir)
+      _cmd_mount(data_log_dir)
+   else:
+      log.warn('No dedicated disk found for dir=%s' % data_log_dir)
+   _cmd_set_owner(data_log_dir)
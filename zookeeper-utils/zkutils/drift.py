@@ -0,0 +1,290 @@
+import time
+import logging
+from multiprocessing.pool import ThreadPool
+
+import aws, config, ensemble, monitor, reconcile, roles
+
+
+log = logging.getLogger(__name__)
+
+# Timeouts of reading the config of a member, from `conf` or with SSM
+CONF_TIMEOUT = 2 # seconds
+NODE_TIMEOUT = 30 # seconds
+# The listings and the config of each member are read at once
+GATHER_THREADS = 3 + ensemble.MAX_INSTANCES
+# Kinds of drift between the records of the membership
+GHOST_VOTER = 'ghost-voter'
+GHOST_OBSERVER = 'ghost-observer'
+MOVED_MEMBER = 'moved-member'
+MISSING_MEMBER = 'missing-member'
+DUPLICATE_ID = 'duplicate-id'
+DUPLICATE_IP = 'duplicate-ip'
+MISSING_STREAM = 'missing-stream'
+STALE_STREAM = 'stale-stream'
+STALE_NODE_CONFIG = 'stale-node-config'
+UNREACHABLE_NODE = 'unreachable-node'
+# Drifts that `fix` repairs with a reconcile of the membership
+RECONCILED_KINDS = [GHOST_VOTER, GHOST_OBSERVER, MOVED_MEMBER, MISSING_MEMBER,
+                    STALE_STREAM]
+
+
+class Drift(object):
+   ''' A disagreement between the records of the membership about the
+   server with the id. '''
+
+   def __init__(self, kind, server_id, detail):
+      self.kind = kind
+      self.server_id = str(server_id)
+      self.detail = detail
+
+   def __repr__(self):
+      return 'Drift(%s, id=%s, %s)' % (self.kind, self.server_id, self.detail)
+
+   def __eq__(self, other):
+      return isinstance(other, Drift) and repr(self) == repr(other)
+
+   def __ne__(self, other):
+      return not self == other
+
+
+class Records(object):
+   ''' The four records of the membership:
+
+   - `members`: the running instances of the group with a `zookeeper_id`
+     tag, as [{'id', 'ip', 'instance_id'}].
+   - `streams`: the log streams of the log group, which claim the ids.
+   - `live`: the dynamic config of /zookeeper/config.
+   - `nodes`: {id: dynamic config} of the dynamic config each member runs
+     with or has on disk, None if it could not be read.
+   '''
+
+   def __init__(self, members, streams, live, nodes):
+      self.members = members
+      self.streams = streams
+      self.live = live
+      self.nodes = nodes
+
+
+def get_tagged_members(region, asgroup_name):
+   ''' Returns the members of the running instances of the group, see
+   `Records`. Unlike `reconcile.get_desired_members`, instances tagged with
+   the same id are all kept. '''
+   instances = aws.get_running_instances(region, [
+      (ensemble.ASGROUP_TAG, [asgroup_name]),
+      (ensemble.ZK_ID_TAG, ensemble.CLAIMABLE_ZK_IDS)
+   ])
+   members = []
+   for i in instances:
+      tags = [t for t in i['Tags'] if t['Key']==ensemble.ZK_ID_TAG]
+      members.append({
+         'id': tags[0]['Value'],
+         'ip': i['NetworkInterfaces'][0]['PrivateIpAddress'],
+         'instance_id': i['InstanceId']
+      })
+   return sorted(members, key=lambda m: (int(m['id']), m['ip']))
+
+
+def get_node_config(region, member, dynamic_file=None):
+   ''' Returns the dynamic config the member runs with, from `conf`. With
+   `dynamic_file`, returns the content of that file on the instance
+   instead, read with SSM. None if it cannot be read within the timeout
+   of CONF_TIMEOUT, or NODE_TIMEOUT with SSM. '''
+   try:
+      if dynamic_file:
+         return config.DynamicConfig.parse(aws.run_shell_command(
+            region,
+            member['instance_id'],
+            'cat %s' % dynamic_file,
+            NODE_TIMEOUT
+         ))
+      return monitor.get_conf(member['ip'], CONF_TIMEOUT)
+   except Exception as ex:
+      log.warn('Failed to read the config of id=%s, ip=%s, %s' % (
+         member['id'], member['ip'], ex
+      ))
+      return None
+
+
+def gather(region, asgroup_name, log_group, ensemble_ip, dynamic_file=None):
+   ''' Returns the records of the membership, see `Records`. The
+   instances, the log streams and the live config are read at once, and
+   the config of each member is queued as soon as the instances are
+   listed, while the other two are still being read. '''
+   pool = ThreadPool(GATHER_THREADS)
+   node_results = []
+
+   def read_nodes(members):
+      for member in members:
+         node_results.append((member, pool.apply_async(
+            get_node_config,
+            (region, member, dynamic_file)
+         )))
+
+   try:
+      members = pool.apply_async(
+         get_tagged_members,
+         (region, asgroup_name),
+         callback=read_nodes
+      )
+      streams = pool.apply_async(aws.get_log_streams, (region, log_group))
+      live = pool.apply_async(
+         ensemble.get_zookeeper_configuration,
+         (ensemble_ip,)
+      )
+      members = members.get()
+      streams = streams.get()
+      live = live.get()
+      nodes = {}
+      for member, result in node_results:
+         nodes.setdefault(member['id'], result.get())
+      return Records(members, streams, live, nodes)
+   finally:
+      pool.close()
+
+
+def _servers(dynamic_config):
+   return set(str(s) for s in dynamic_config.sorted_servers())
+
+
+def compute_drifts(records, now=None):
+   ''' Returns the drifts between the records, by id and by ip:
+
+   - A member of the live config without a running instance tagged with
+     its id is a ghost. A ghost voter still counts in the quorum, so it
+     raises the quorum size and the write latency, and it is one failure
+     closer to losing the quorum.
+   - A member whose instance runs at another ip has moved, and a tagged
+     instance missing from the live config has not joined.
+   - Ids tagged on several instances and ips of several members are
+     duplicates, which no reconcile can repair.
+   - The id of a member without a log stream could be claimed by a new
+     instance, and the stream of an id without a member is stale once past
+     the grace period of `reconcile`.
+   - A member whose config has other servers, or another version, than
+     the live config is stale.
+   '''
+   drifts = []
+   tagged = {}
+   for member in records.members:
+      tagged.setdefault(member['id'], []).append(member)
+   for server_id in sorted(tagged, key=int):
+      if len(tagged[server_id]) > 1:
+         drifts.append(Drift(DUPLICATE_ID, server_id, 'instances=%s' % [
+            m['instance_id'] for m in tagged[server_id]
+         ]))
+
+   live = records.live
+   ips = {}
+   for server in live.sorted_servers():
+      ips.setdefault(server.ip, []).append(server.id)
+      members = tagged.get(server.id)
+      if not members:
+         kind = GHOST_VOTER if server.is_participant else GHOST_OBSERVER
+         drifts.append(Drift(kind, server.id, 'ip=%s' % server.ip))
+      elif server.ip not in [m['ip'] for m in members]:
+         drifts.append(Drift(MOVED_MEMBER, server.id, 'ip=%s, tagged ip=%s'
+                             % (server.ip, members[0]['ip'])))
+   for ip in sorted(ips):
+      if len(ips[ip]) > 1:
+         drifts.append(Drift(DUPLICATE_IP, ips[ip][0], 'ip=%s, ids=%s' % (
+            ip, ips[ip]
+         )))
+   for server_id in sorted(tagged, key=int):
+      if live.get(server_id) is None:
+         drifts.append(Drift(MISSING_MEMBER, server_id, 'ip=%s' % (
+            tagged[server_id][0]['ip']
+         )))
+
+   ids = set(tagged) | set(live.ids())
+   stream_names = set(s['logStreamName'] for s in records.streams)
+   for server_id in sorted(ids - stream_names, key=int):
+      drifts.append(Drift(MISSING_STREAM, server_id, 'claimable by others'))
+   for name in sorted(reconcile.filter_stale_log_streams(
+         records.streams, ids, now), key=int):
+      drifts.append(Drift(STALE_STREAM, name, 'no member'))
+
+   for server_id in sorted(records.nodes, key=int):
+      node_config = records.nodes[server_id]
+      if node_config is None:
+         drifts.append(Drift(UNREACHABLE_NODE, server_id, 'config unknown'))
+      elif _servers(node_config) != _servers(live) or (
+            node_config.version and node_config.version != live.version):
+         drifts.append(Drift(STALE_NODE_CONFIG, server_id,
+                             'version=%s, live version=%s' % (
+            node_config.version, live.version
+         )))
+   return drifts
+
+
+def get_quorum(live):
+   ''' Returns the number of voters a write waits for. '''
+   return len(live.participants()) // 2 + 1
+
+
+def report(records, drifts):
+   ''' Logs the drifts and what the ghost voters cost the quorum. Returns
+   the lines of the report. '''
+   lines = ['%s id=%s %s' % (d.kind, d.server_id, d.detail) for d in drifts]
+   ghosts = [d for d in drifts if d.kind == GHOST_VOTER]
+   if ghosts:
+      voters = len(records.live.participants())
+      lines.append('quorum=%s of voters=%s, without ghosts quorum=%s' % (
+         get_quorum(records.live),
+         voters,
+         (voters - len(ghosts)) // 2 + 1
+      ))
+   for line in lines:
+      log.warn(line)
+   return lines
+
+
+def fix(region, asgroup_name, log_group, ensemble_ip, drifts,
+        max_voters=roles.DEFAULT_MAX_VOTERS):
+   ''' Repairs the drifts that can be repaired safely. Returns the kinds
+   of the drifts it acted on.
+
+   The ghosts, moved and missing members and the stale streams are left to
+   `reconcile.reconcile`, which lists the group again and applies a single
+   versioned reconfig. The log stream of a running member without one is
+   created, so that its id is not claimed twice. Duplicates and stale or
+   unknown configs of the members are only reported.
+   '''
+   kinds = set(d.kind for d in drifts)
+   ghost_ids = set(
+      d.server_id for d in drifts if d.kind in (GHOST_VOTER, GHOST_OBSERVER)
+   )
+   fixed = set()
+   if kinds & set(RECONCILED_KINDS):
+      plan = reconcile.reconcile(
+         region,
+         asgroup_name,
+         ensemble_ip,
+         log_group,
+         max_voters
+      )
+      log.info('Reconciled, plan=%s' % plan)
+      fixed |= kinds & set(RECONCILED_KINDS)
+   for d in drifts:
+      # The ghosts are removed, so their ids are free to claim again
+      if d.kind == MISSING_STREAM and d.server_id not in ghost_ids:
+         aws.create_log_stream(region, log_group, d.server_id)
+         fixed.add(MISSING_STREAM)
+   return sorted(fixed)
+
+
+def check(region, asgroup_name, log_group, ensemble_ip, dynamic_file=None,
+          fix_drifts=False, max_voters=roles.DEFAULT_MAX_VOTERS):
+   ''' Gathers the records, reports their drifts and, with `fix_drifts`,
+   repairs them and gathers the records again. Returns the drifts left. '''
+   records = gather(region, asgroup_name, log_group, ensemble_ip,
+                    dynamic_file)
+   drifts = compute_drifts(records, time.time())
+   report(records, drifts)
+   if drifts and fix_drifts:
+      if fix(region, asgroup_name, log_group, ensemble_ip, drifts,
+             max_voters):
+         records = gather(region, asgroup_name, log_group, ensemble_ip,
+                          dynamic_file)
+         drifts = compute_drifts(records, time.time())
+         report(records, drifts)
+   return drifts
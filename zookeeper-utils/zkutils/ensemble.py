@@ -0,0 +1,57 @@
+import config, utils
+
+
+# Tags of the instances of the ensemble. The members, the reconcile and the
+# caches read them without the bootstrap of `zk`, so they live here.
+ZK_ID_TAG = 'zookeeper_id'
+ASGROUP_TAG = 'aws:autoscaling:groupName'
+MAX_INSTANCES = 10
+CLAIMABLE_ZK_IDS = [str(num) for num in range(1, MAX_INSTANCES)]
+
+
+def _cmd_get_zookeeper_configuration(ensemble_ip):
+   return utils.run_command(
+      """zkCli.sh -server {ip}:{port} get /zookeeper/config \
+            |grep -E '^(server|version)'
+      """.format(ip=ensemble_ip, port=config.CLIENT_PORT)
+   )
+
+
+def _cmd_reconfig(ensemble_ip, joining, leaving, version=None):
+   options = []
+   if version:
+      options.append('-v {version}'.format(version=version))
+   if joining:
+      options.append('-add "{servers}"'.format(
+         servers=','.join(str(s) for s in joining)
+      ))
+   if leaving:
+      options.append('-remove {ids}'.format(ids=','.join(leaving)))
+   return utils.run_command(
+      """zkCli.sh \
+            -server {ensemble_ip}:{port} \
+            reconfig {options}
+      """.format(
+         ensemble_ip=ensemble_ip,
+         port=config.CLIENT_PORT,
+         options=' '.join(options)
+      )
+   )
+
+
+def get_zookeeper_configuration(ensemble_ip):
+   ''' Returns the live dynamic configuration of the ensemble. '''
+   return config.DynamicConfig.parse(
+      _cmd_get_zookeeper_configuration(ensemble_ip)
+   )
+
+
+def get_zookeeper_azs(instances):
+   ''' Returns {zookeeper_id: availability zone} of the instances. '''
+   azs = {}
+   for i in instances:
+      tags = [t for t in i['Tags'] if t['Key']==ZK_ID_TAG]
+      az = i.get('Placement', {}).get('AvailabilityZone')
+      if tags and az:
+         azs[tags[0]['Value']] = az
+   return azs
@@ -0,0 +1,173 @@
+import json
+import time
+import logging
+
+from kazoo.exceptions import BadVersionError, NodeExistsError, NoNodeError
+
+import client, config, reconcile, retry, roles
+
+
+log = logging.getLogger(__name__)
+
+JOIN_PATH = '/zkutils/joins'
+# Joins requested within this window are applied in the same reconfig
+COALESCE_WINDOW = 5 # seconds
+JOIN_TIMEOUT = 120 # seconds
+POLL_INTERVAL = 2 # seconds
+WAIT_BACKOFF = retry.Backoff(1, POLL_INTERVAL * 3)
+
+
+class JoinRequest(object):
+   ''' A request of a new server to join the ensemble, along with the ids
+   of terminated servers it found that should leave it. '''
+
+   def __init__(self, server, leaving=None,
+                max_voters=roles.DEFAULT_MAX_VOTERS, created=None):
+      self.server = server
+      self.leaving = leaving or []
+      self.max_voters = max_voters
+      self.created = created
+
+   @classmethod
+   def parse(cls, data, created=None):
+      values = json.loads(data)
+      return cls(
+         config.Server.parse(values['server']),
+         values.get('leaving'),
+         values.get('max_voters', roles.DEFAULT_MAX_VOTERS),
+         created
+      )
+
+   def serialize(self):
+      return json.dumps({
+         'server': str(self.server),
+         'leaving': self.leaving,
+         'max_voters': self.max_voters
+      })
+
+   def __repr__(self):
+      return 'JoinRequest(server=%s, leaving=%s)' % (
+         self.server, self.leaving
+      )
+
+
+def request_join(zk_client, request):
+   ''' Queues the join request. The request is an ephemeral znode, so it
+   is dropped if the server gives up on it. '''
+   path = '%s/%s' % (JOIN_PATH, request.server.id)
+   zk_client.ensure_path(JOIN_PATH)
+   try:
+      zk_client.create(path, request.serialize(), ephemeral=True)
+   except NodeExistsError:
+      zk_client.set(path, request.serialize())
+   log.info('Requested %s' % request)
+
+
+def get_join_requests(zk_client):
+   ''' Returns the queued join requests. '''
+   try:
+      children = zk_client.get_children(JOIN_PATH)
+   except NoNodeError:
+      return []
+   requests = []
+   for child in sorted(children):
+      try:
+         data, stat = zk_client.get('%s/%s' % (JOIN_PATH, child))
+      except NoNodeError:
+         continue
+      requests.append(JoinRequest.parse(data, stat.ctime / 1000.0))
+   return requests
+
+
+def clear_join_requests(zk_client, requests):
+   for request in requests:
+      try:
+         zk_client.delete('%s/%s' % (JOIN_PATH, request.server.id))
+      except NoNodeError:
+         pass
+
+
+def is_due(requests, window=COALESCE_WINDOW, now=None):
+   ''' Returns True once the oldest request waited for `window` seconds,
+   giving the servers launched at the same time a chance to queue. '''
+   now = now or time.time()
+   return bool(requests) and \
+      min(r.created for r in requests) + window <= now
+
+
+def compute_batch(actual, requests):
+   ''' Returns the plan that adds all requesting servers and removes
+   the terminated ones in a single reconfig. '''
+   target = actual.copy()
+   joining_ids = set(r.server.id for r in requests)
+   max_voters = min(r.max_voters for r in requests)
+   for request in requests:
+      for server_id in request.leaving:
+         if server_id not in joining_ids:
+            target.remove(server_id)
+   for request in sorted(requests, key=lambda r: int(r.server.id)):
+      target.remove(request.server.id)
+      role = roles.get_join_role(target, max_voters)
+      target.add(request.server.with_role(role))
+   joining, leaving = actual.diff(target)
+   return reconcile.Plan(joining, leaving, actual.version)
+
+
+def process_joins(zk_client, window=COALESCE_WINDOW, now=None):
+   ''' Applies the queued join requests once they are due and returns
+   the requests that were processed.
+
+   If the config changed since it was read, nothing is applied and the
+   requests are processed again on the next call.
+   '''
+   requests = get_join_requests(zk_client)
+   if not is_due(requests, window, now):
+      return []
+   plan = compute_batch(client.get_configuration(zk_client), requests)
+   try:
+      log.info('Applying joins %s' % plan)
+      client.reconfig(zk_client, plan)
+   except BadVersionError:
+      log.info('Config changed, version=%s, retrying' % plan.version)
+      return []
+   clear_join_requests(zk_client, requests)
+   return requests
+
+
+def join_task(ip='localhost', window=COALESCE_WINDOW):
+   ''' Returns the agent task that coalesces the join requests,
+   which only does so on the leader. '''
+   return client.leader_task(
+      lambda zk_client: process_joins(zk_client, window),
+      ip,
+      POLL_INTERVAL
+   )
+
+
+def wait_for_join(zk_client, server, timeout=JOIN_TIMEOUT):
+   ''' Waits until the server is a member of the ensemble. '''
+   def is_member():
+      member = client.get_configuration(zk_client).get(server.id)
+      if member and member.ip == server.ip:
+         log.info('Joined the ensemble as %s' % member)
+         return True
+      return False
+
+   try:
+      return retry.poll(is_member, WAIT_BACKOFF, retry.Deadline(timeout))
+   except retry.DeadlineExceeded:
+      return False
+
+
+def join(ensemble_ip, server, leaving=None,
+         max_voters=roles.DEFAULT_MAX_VOTERS, timeout=JOIN_TIMEOUT):
+   ''' Asks the leader to add the server to the ensemble in its next batch
+   of joins, see `process_joins`, and waits for it. Returns False if the
+   server did not join, e.g. when the leader does not run the agent. '''
+   try:
+      with client.session(ensemble_ip) as zk_client:
+         request_join(zk_client, JoinRequest(server, leaving, max_voters))
+         return wait_for_join(zk_client, server, timeout)
+   except client.ERRORS as ex:
+      log.error('Failed to join through the queue, %s' % ex)
+      return False
@@ -0,0 +1,119 @@
+import os
+import logging
+
+import requests
+
+import aws, ensemble, monitor, retry, roles, zk
+
+
+log = logging.getLogger(__name__)
+
+STATE_TERMINATED = 'Terminated'
+DEFAULT_HOOK_NAME = 'zookeeper-terminating'
+POLL_INTERVAL = 5 # seconds
+HANDOFF_TIMEOUT = 60 # seconds
+HANDOFF_BACKOFF = retry.Backoff(0.5, 5)
+DONE_INTERVAL = 3600 # seconds
+
+
+def get_target_state(state_file=None):
+   ''' Returns the lifecycle state the autoscaling group is moving this
+   instance to. If it exists, the state file stands in for the instance
+   metadata, which is how a termination is simulated outside of AWS. '''
+   if state_file and os.path.exists(state_file):
+      with open(state_file, 'r') as fread:
+         return fread.read().strip()
+   try:
+      return aws.get_target_lifecycle_state()
+   except requests.exceptions.RequestException as ex:
+      log.info('No target lifecycle state, %s' % ex)
+      return None
+
+
+def get_serving_ip(ips):
+   ''' Returns the first ip of a server that serves requests, if any. '''
+   statuses = monitor.get_statuses(ips)
+   for ip in ips:
+      if statuses[ip]:
+         return ip
+   return None
+
+
+def wait_for_leader(ips, timeout=HANDOFF_TIMEOUT):
+   ''' Waits until one of the servers is the leader. '''
+   def has_leader():
+      if monitor.get_leader_status(monitor.get_statuses(ips)):
+         return True
+      log.info('Waiting for the leadership handoff ...')
+      return False
+
+   try:
+      return retry.poll(has_leader, HANDOFF_BACKOFF, retry.Deadline(timeout))
+   except retry.DeadlineExceeded:
+      log.error('No leader after %s seconds' % timeout)
+      return False
+
+
+def leave(server_id, ip='localhost', max_voters=roles.DEFAULT_MAX_VOTERS):
+   ''' Removes the server from the ensemble ahead of its termination and
+   waits until the remaining members have a leader.
+
+   The reconfig goes through another member, so it does not depend on
+   the connection to the leaving server. If the leaving server is the
+   leader, Zookeeper hands the leadership over to a voter of the new
+   config, which is much faster than the election that follows a leader
+   that just disappears.
+   '''
+   dynamic_config = ensemble.get_zookeeper_configuration(ip)
+   other_ips = [
+      s.ip for s in dynamic_config.sorted_servers() if s.id != server_id
+   ]
+   ensemble_ip = get_serving_ip(other_ips) or ip
+   plan = zk.leave_ensemble(ensemble_ip, server_id, max_voters)
+   if plan:
+      wait_for_leader(other_ips)
+   return plan
+
+
+def handle_termination(region, instance_id, server_id, asgroup_name,
+                       hook_name=DEFAULT_HOOK_NAME, ip='localhost',
+                       max_voters=roles.DEFAULT_MAX_VOTERS, log_group=None):
+   ''' Leaves the ensemble and completes the termination lifecycle action.
+   The action is completed even if leaving failed, the next run of
+   zk-remove-terminated removes the server then. '''
+   log.info('Instance is terminating, leaving the ensemble, id=%s'
+            % server_id)
+   try:
+      leave(server_id, ip, max_voters)
+      if log_group:
+         aws.delete_log_streams(region, log_group, [server_id])
+   except Exception as ex:
+      log.exception('Failed to leave the ensemble, %s' % ex)
+   aws.complete_lifecycle_action(region, asgroup_name, hook_name, instance_id)
+
+
+def lifecycle_task(region, instance_id, server_id, asgroup_name,
+                   hook_name=DEFAULT_HOOK_NAME, state_file=None,
+                   max_voters=roles.DEFAULT_MAX_VOTERS, log_group=None):
+   ''' Returns the agent task that handles the termination of this
+   instance, see `handle_termination`. '''
+   handled = []
+
+   def task():
+      if handled:
+         return DONE_INTERVAL
+      if get_target_state(state_file) != STATE_TERMINATED:
+         return POLL_INTERVAL
+      handle_termination(
+         region,
+         instance_id,
+         server_id,
+         asgroup_name,
+         hook_name,
+         'localhost',
+         max_voters,
+         log_group
+      )
+      handled.append(True)
+      return DONE_INTERVAL
+   return task
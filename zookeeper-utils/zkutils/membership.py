@@ -0,0 +1,90 @@
+import time
+import logging
+import threading
+
+from kazoo.recipe.watchers import DataWatch
+
+import cache, client, config
+
+
+log = logging.getLogger(__name__)
+
+CHECK_INTERVAL = 30 # seconds
+
+
+class MembershipView(object):
+   ''' The latest dynamic config of the ensemble known to this process,
+   shared by its components so that they read the membership without a
+   round trip to Zookeeper or AWS. '''
+
+   def __init__(self):
+      self._lock = threading.Lock()
+      self._config = None
+      self.updated = None
+
+   def update(self, dynamic_config):
+      with self._lock:
+         self._config = dynamic_config.copy()
+         self.updated = time.time()
+
+   def get(self):
+      ''' Returns a copy of the dynamic config, None if not known yet. '''
+      with self._lock:
+         return self._config.copy() if self._config else None
+
+
+VIEW = MembershipView()
+
+
+def sync(data, dynamic_file, view=VIEW, group_cache=None):
+   ''' Updates the view and the dynamic file with the content of the
+   /zookeeper/config znode. The file is only written if it changed,
+   atomically, see `utils.save_to_file`. A change also invalidates the
+   membership listings in the cache of the group, if one is given. '''
+   dynamic_config = config.DynamicConfig.parse(data.decode('utf-8'))
+   if not dynamic_config.servers:
+      log.warn('Ignoring config without servers, data=%s' % data)
+      return None
+   view.update(dynamic_config)
+   if dynamic_config.save(dynamic_file):
+      log.info('Updated file=%s to version=%s' % (
+         dynamic_file, dynamic_config.version
+      ))
+      if group_cache:
+         group_cache.invalidate(*cache.MEMBERSHIP_KEYS)
+   return dynamic_config
+
+
+def get_configuration(zk_client, view=VIEW):
+   ''' Returns the dynamic config of the view, or reads it through the
+   session while the view is not known yet. '''
+   return view.get() or client.get_configuration(zk_client)
+
+
+def watch(zk_client, dynamic_file, view=VIEW, group_cache=None):
+   ''' Keeps a watch on /zookeeper/config through the session and syncs
+   the view and the dynamic file on each change. The watch is set again
+   by the client after a reconnect. '''
+   def on_change(data, stat):
+      if data is None:
+         return
+      try:
+         sync(data, dynamic_file, view, group_cache)
+      except Exception as ex:
+         log.exception('Failed to sync the dynamic file, %s' % ex)
+   return DataWatch(zk_client, client.CONFIG_PATH, on_change)
+
+
+def watch_task(dynamic_file, ip='localhost', view=VIEW, group_cache=None):
+   ''' Returns the agent task that opens the persistent session watching
+   the config, once the server accepts connections. '''
+   sessions = []
+
+   def task():
+      if not sessions:
+         zk_client = client.connect(ip)
+         sessions.append(zk_client)
+         watch(zk_client, dynamic_file, view, group_cache)
+         log.info('Watching %s' % client.CONFIG_PATH)
+      return CHECK_INTERVAL
+   return task
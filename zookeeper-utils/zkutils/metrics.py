@@ -0,0 +1,116 @@
+import logging
+import threading
+
+
+log = logging.getLogger(__name__)
+
+SUMMARY_INTERVAL = 3600 # seconds
+# Upper bounds of the buckets of the histograms, in seconds
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf')]
+
+
+class Metrics(object):
+   ''' In-process counters and timings, keyed by dotted names such as
+   `aws.ec2.DescribeInstances.calls`. They are shared by the threads of
+   the process and summarized in the log, see `log_summary`. '''
+
+   def __init__(self, buckets=BUCKETS):
+      self._lock = threading.Lock()
+      self.buckets = buckets
+      self.counters = {}
+      self.timings = {}
+      self.histograms = {}
+
+   def incr(self, name, value=1):
+      with self._lock:
+         self.counters[name] = self.counters.get(name, 0) + value
+
+   def observe(self, name, seconds):
+      ''' Records a duration, kept as its count, total and maximum and in
+      the histogram of the name. '''
+      with self._lock:
+         count, total, maximum = self.timings.get(name, (0, 0.0, 0.0))
+         self.timings[name] = (
+            count + 1,
+            total + seconds,
+            max(maximum, seconds)
+         )
+         histogram = self.histograms.setdefault(name, [0] * len(self.buckets))
+         for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+               histogram[i] += 1
+               break
+
+   def get(self, name):
+      ''' Returns the value of the counter, 0 if it was never set. '''
+      with self._lock:
+         return self.counters.get(name, 0)
+
+   def get_timing(self, name):
+      ''' Returns the (count, total, maximum) of the timing. '''
+      with self._lock:
+         return self.timings.get(name, (0, 0.0, 0.0))
+
+   def get_histogram(self, name):
+      ''' Returns the [(upper bound, count)] of the histogram. '''
+      with self._lock:
+         histogram = self.histograms.get(name, [0] * len(self.buckets))
+         return list(zip(self.buckets, histogram))
+
+   def get_percentile(self, name, percentile):
+      ''' Returns the upper bound of the bucket of the percentile, e.g. 99,
+      None if nothing was recorded. '''
+      histogram = self.get_histogram(name)
+      total = sum(count for _, count in histogram)
+      if not total:
+         return None
+      seen = 0
+      for bound, count in histogram:
+         seen += count
+         if seen * 100.0 >= total * percentile:
+            return bound
+
+   def snapshot(self, prefix=''):
+      ''' Returns a copy of the counters and timings whose names start
+      with `prefix`. '''
+      with self._lock:
+         return (
+            dict(
+               (k, v) for k, v in self.counters.items()
+                  if k.startswith(prefix)
+            ),
+            dict(
+               (k, v) for k, v in self.timings.items()
+                  if k.startswith(prefix)
+            )
+         )
+
+   def reset(self):
+      with self._lock:
+         self.counters = {}
+         self.timings = {}
+         self.histograms = {}
+
+   def log_summary(self, prefix=''):
+      counters, timings = self.snapshot(prefix)
+      for name in sorted(counters):
+         log.info('%s=%s' % (name, counters[name]))
+      for name in sorted(timings):
+         count, total, maximum = timings[name]
+         log.info('%s count=%s total=%.3fs max=%.3fs p50<=%ss p99<=%ss' % (
+            name, count, total, maximum,
+            self.get_percentile(name, 50),
+            self.get_percentile(name, 99)
+         ))
+
+
+METRICS = Metrics()
+
+
+def summary_task(prefix='', interval=SUMMARY_INTERVAL):
+   ''' Returns the agent task that logs the summary of the metrics, for
+   long running processes that do not exit. '''
+   def task():
+      METRICS.log_summary(prefix)
+      return interval
+   return task
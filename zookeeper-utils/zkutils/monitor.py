@@ -0,0 +1,143 @@
+import socket
+import logging
+
+import config
+
+
+log = logging.getLogger(__name__)
+
+TIMEOUT = 5 # seconds
+RECV_SIZE = 4096
+MODE_LEADER = 'leader'
+MODE_FOLLOWER = 'follower'
+MODE_OBSERVER = 'observer'
+SERVING_MODES = [MODE_LEADER, MODE_FOLLOWER, MODE_OBSERVER]
+
+
+class MonitorError(Exception):
+   pass
+
+
+def send_command(ip, command, port=config.CLIENT_PORT, timeout=TIMEOUT):
+   ''' Sends a 4 letter word command and returns the response. '''
+   try:
+      sock = socket.create_connection((ip, port), timeout)
+   except socket.error as ex:
+      raise MonitorError('Failed to connect to %s:%s, %s' % (ip, port, ex))
+   try:
+      sock.sendall(command.encode('ascii'))
+      chunks = []
+      while True:
+         chunk = sock.recv(RECV_SIZE)
+         if not chunk:
+            break
+         chunks.append(chunk)
+   except socket.error as ex:
+      raise MonitorError('Failed to run %s on %s, %s' % (command, ip, ex))
+   finally:
+      sock.close()
+   return b''.join(chunks).decode('utf-8', 'replace')
+
+
+def is_running(ip):
+   ''' Returns True if a Zookeeper server runs on the ip, whether it
+   serves requests or not. '''
+   try:
+      return send_command(ip, 'ruok').strip() == 'imok'
+   except MonitorError:
+      return False
+
+
+def parse_mntr(output):
+   ''' Returns {key: value} of the `mntr` output, numbers as ints. '''
+   values = {}
+   for line in output.splitlines():
+      key, _, value = line.partition('\t')
+      if not key:
+         continue
+      try:
+         values[key] = int(value)
+      except ValueError:
+         values[key] = value.strip()
+   return values
+
+
+def parse_srvr(output):
+   ''' Returns the server status of the `srvr` output with the keys
+   mode, zxid, latency_min, latency_avg, latency_max, outstanding,
+   connections and node_count. '''
+   fields = {}
+   for line in output.splitlines():
+      key, sep, value = line.partition(':')
+      if sep:
+         fields[key.strip()] = value.strip()
+   if 'Mode' not in fields:
+      raise MonitorError('Server is not serving: %s' % output.strip())
+   latency = fields.get('Latency min/avg/max', '0/0/0').split('/')
+   return {
+      'mode': fields['Mode'],
+      'zxid': int(fields.get('Zxid', '0x0'), 16),
+      'latency_min': float(latency[0]),
+      'latency_avg': float(latency[1]),
+      'latency_max': float(latency[2]),
+      'outstanding': int(fields.get('Outstanding', 0)),
+      'connections': int(fields.get('Connections', 0)),
+      'node_count': int(fields.get('Node count', 0))
+   }
+
+
+def get_mntr(ip, timeout=TIMEOUT):
+   return parse_mntr(send_command(ip, 'mntr', timeout=timeout))
+
+
+def get_conf(ip, timeout=TIMEOUT):
+   ''' Returns the dynamic config the server runs with, as `conf` shows
+   it, including its version. '''
+   return config.DynamicConfig.parse(
+      send_command(ip, 'conf', timeout=timeout)
+   )
+
+
+def get_status(ip, timeout=TIMEOUT):
+   ''' Returns the `srvr` status of the server. '''
+   return parse_srvr(send_command(ip, 'srvr', timeout=timeout))
+
+
+def get_lag(status, leader_status):
+   ''' Returns the number of transactions the server is behind the leader.
+   A server of an older epoch is behind by any number of transactions. '''
+   epoch, counter = status['zxid'] >> 32, status['zxid'] & 0xffffffff
+   leader_epoch = leader_status['zxid'] >> 32
+   leader_counter = leader_status['zxid'] & 0xffffffff
+   if epoch != leader_epoch:
+      return float('inf')
+   return max(leader_counter - counter, 0)
+
+
+def is_synced(status, leader_status, max_lag):
+   ''' Returns True if the server serves requests and is no more than
+   `max_lag` transactions behind the leader. '''
+   return status['mode'] in SERVING_MODES and \
+      get_lag(status, leader_status) <= max_lag
+
+
+def get_statuses(ips, client=None):
+   ''' Returns {ip: srvr status} of the servers, None if not serving.
+   The statuses are read with the `get_status` of the client if given,
+   e.g. an `admin.AdminClient`. '''
+   statuses = {}
+   for ip in ips:
+      try:
+         statuses[ip] = client.get_status(ip) if client else get_status(ip)
+      except MonitorError as ex:
+         log.info('No status for ip=%s, %s' % (ip, ex))
+         statuses[ip] = None
+   return statuses
+
+
+def get_leader_status(statuses):
+   ''' Returns the status of the leader among the statuses, if any. '''
+   for status in statuses.values():
+      if status and status['mode'] == MODE_LEADER:
+         return status
+   return None
@@ -0,0 +1,119 @@
+import time
+import errno
+import socket
+import logging
+
+import config
+
+
+log = logging.getLogger(__name__)
+
+# Ports probed to measure the round trip time to a peer. A refused
+# connection is answered within one round trip as well, so the peer
+# does not need to run Zookeeper yet.
+PROBE_PORTS = [config.ELECTION_PORT, config.CLIENT_PORT]
+PROBE_SAMPLES = 3
+PROBE_TIMEOUT = 1 # seconds
+UNREACHABLE = float('inf')
+
+
+def _probe(ip, port, timeout):
+   ''' Returns the time in seconds it takes to get an answer
+   to a TCP connection attempt, or None on timeout. '''
+   sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+   sock.settimeout(timeout)
+   start = time.time()
+   try:
+      sock.connect((ip, port))
+   except socket.timeout:
+      return None
+   except socket.error as ex:
+      if ex.errno != errno.ECONNREFUSED:
+         return None
+   finally:
+      sock.close()
+   return time.time() - start
+
+
+def measure_rtt(ip, ports=PROBE_PORTS, samples=PROBE_SAMPLES,
+                timeout=PROBE_TIMEOUT):
+   ''' Returns the lowest round trip time in seconds to the peer
+   on its quorum ports, or UNREACHABLE. '''
+   rtts = []
+   for port in ports:
+      for _ in range(samples):
+         rtt = _probe(ip, port, timeout)
+         if rtt is not None:
+            rtts.append(rtt)
+   return min(rtts) if rtts else UNREACHABLE
+
+
+def measure_rtts(servers):
+   ''' Returns {server id: round trip time} for the servers. '''
+   rtts = dict((s.id, measure_rtt(s.ip)) for s in servers)
+   log.info('Measured rtts=%s' % dict(
+      (k, '%.2fms' % (v * 1000)) for k, v in rtts.items()
+   ))
+   return rtts
+
+
+def choose_voters(servers, max_voters, azs, rtts=None, preferred=None):
+   ''' Returns the ids of the voters chosen among the servers.
+
+   The voters are spread across the availability zones so that no zone
+   holds more than its share of them. Zones and servers within a zone are
+   picked by lowest round trip time. Preferred servers, i.e. the current
+   voters, are kept first so that membership changes stay minimal.
+   '''
+   rtts = rtts or {}
+   preferred = set(preferred or [])
+   by_az = {}
+   for server in servers:
+      by_az.setdefault(azs.get(server.id), []).append(server)
+
+   def server_key(server):
+      return (
+         server.id not in preferred,
+         rtts.get(server.id, UNREACHABLE),
+         int(server.id)
+      )
+
+   for az_servers in by_az.values():
+      az_servers.sort(key=server_key)
+
+   def az_key(az):
+      az_servers = by_az[az]
+      return (
+         -len([s for s in az_servers if s.id in preferred]),
+         server_key(az_servers[0])[1:],
+         str(az)
+      )
+
+   # Round robin over the zones spreads the voters evenly
+   ordered_azs = sorted(by_az, key=az_key)
+   voters = []
+   while len(voters) < max_voters and any(by_az.values()):
+      for az in ordered_azs:
+         if by_az[az] and len(voters) < max_voters:
+            voters.append(by_az[az].pop(0).id)
+   return voters
+
+
+def get_placement_changes(dynamic_config, max_voters, azs, rtts=None):
+   ''' Returns the servers whose role has to change so that the voters
+   are spread across the availability zones. '''
+   servers = dynamic_config.sorted_servers()
+   voters = choose_voters(
+      servers,
+      max_voters,
+      azs,
+      rtts,
+      preferred=[s.id for s in dynamic_config.participants()]
+   )
+   changes = []
+   for server in servers:
+      role = config.ROLE_PARTICIPANT if server.id in voters \
+         else config.ROLE_OBSERVER
+      if server.role != role:
+         changes.append(server.with_role(role))
+   return changes
@@ -0,0 +1,161 @@
+import os
+import time
+import logging
+
+import utils
+
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_PREFIX = 'snapshot'
+LOG_PREFIX = 'log'
+VERSION_DIR = 'version-2'
+
+# Zookeeper refuses to purge below 3 snapshots, we do the same.
+MIN_RETAIN_COUNT = 3
+DEFAULT_RETAIN_COUNT = 10
+DEFAULT_INTERVAL = 3600 # seconds
+
+# Disk pressure levels as (free space ratio, retain count, interval).
+# The first level whose free space ratio is above the actual free space
+# is applied, otherwise the defaults are used.
+PRESSURE_LEVELS = [
+   (0.10, MIN_RETAIN_COUNT, 60),
+   (0.25, 5, 600)
+]
+
+# Pause between two deletes so that the purge does not burst the
+# journal of the device that also holds the transaction logs.
+DELETE_PAUSE = 0.05 # seconds
+
+
+def _cmd_set_idle_io_priority(pid):
+   return utils.run_command(
+      """ionice -c 3 -p {pid}""".format(pid=pid)
+   )
+
+
+def _zxid(filename, prefix):
+   ''' Returns the zxid encoded in a snapshot or log filename
+   or None if the filename is not one of them.
+   '''
+   name, sep, zxid = filename.partition('.')
+   if name != prefix or not sep:
+      return None
+   try:
+      return int(zxid, 16)
+   except ValueError:
+      return None
+
+
+def list_files(directory, prefix):
+   ''' Returns (zxid, path) pairs of the snapshot or log files
+   in a Zookeeper data directory sorted by zxid.
+   '''
+   version_dir = os.path.join(directory, VERSION_DIR)
+   if not os.path.isdir(version_dir):
+      return []
+   files = []
+   for filename in os.listdir(version_dir):
+      zxid = _zxid(filename, prefix)
+      if zxid is not None:
+         files.append((zxid, os.path.join(version_dir, filename)))
+   return sorted(files)
+
+
+def get_purgeable_files(snapshots, logs, retain_count):
+   ''' Returns the snapshots and logs that can be deleted while keeping
+   the `retain_count` most recent snapshots and the logs needed to
+   replay them.
+
+   Same as Zookeeper's PurgeTxnLog, the log whose zxid is the highest
+   one below the oldest retained snapshot is kept as well because it
+   may hold transactions that came after that snapshot.
+   '''
+   retain_count = max(retain_count, MIN_RETAIN_COUNT)
+   if len(snapshots) <= retain_count:
+      return []
+   retained = snapshots[-retain_count:]
+   least_zxid = retained[0][0]
+
+   purgeable = [path for zxid, path in snapshots[:-retain_count]]
+   older_logs = [(zxid, path) for zxid, path in logs if zxid < least_zxid]
+   purgeable += [path for zxid, path in older_logs[:-1]]
+   return purgeable
+
+
+def get_free_ratio(directory):
+   ''' Returns the ratio of free space of the filesystem
+   that holds the directory. '''
+   stat = os.statvfs(directory)
+   if not stat.f_blocks:
+      return 1.0
+   return float(stat.f_bavail) / stat.f_blocks
+
+
+def get_schedule(free_ratio, retain_count, interval):
+   ''' Returns the (retain count, interval) to use for the
+   given free space ratio. '''
+   for level_ratio, level_retain_count, level_interval in PRESSURE_LEVELS:
+      if free_ratio < level_ratio:
+         return (
+            min(retain_count, level_retain_count),
+            min(interval, level_interval)
+         )
+   return (retain_count, interval)
+
+
+def set_idle_io_priority():
+   ''' Lowers the IO priority of this process so that deletes do not
+   compete with the transaction log fsyncs. The CPU priority is left to
+   the `Nice=` of the zk-agent service, so that it is set in one place. '''
+   try:
+      _cmd_set_idle_io_priority(os.getpid())
+   except utils.CommandError as ex:
+      log.warn('Could not lower IO priority, error=%s' % ex)
+
+
+def purge(data_dir, data_log_dir, retain_count):
+   ''' Deletes snapshots and transaction logs that are no longer
+   needed. Returns the deleted paths. '''
+   snapshots = list_files(data_dir, SNAPSHOT_PREFIX)
+   logs = list_files(data_log_dir, LOG_PREFIX)
+   purgeable = get_purgeable_files(snapshots, logs, retain_count)
+   deleted = []
+   for path in purgeable:
+      try:
+         os.remove(path)
+         deleted.append(path)
+      except OSError as ex:
+         log.error('Failed to delete file=%s, error=%s' % (path, ex))
+      time.sleep(DELETE_PAUSE)
+   log.info('Purged count=%s, snapshots=%s, logs=%s' % (
+      len(deleted), len(snapshots), len(logs)
+   ))
+   return deleted
+
+
+def purge_task(data_dir,
+               data_log_dir=None,
+               retain_count=DEFAULT_RETAIN_COUNT,
+               interval=DEFAULT_INTERVAL):
+   ''' Returns a task for the zkutils agent that purges old snapshots and
+   logs. The task runs more often and keeps less snapshots when any of the
+   data directories runs low on free space.
+   '''
+   data_log_dir = data_log_dir or data_dir
+
+   def run():
+      free_ratio = min(get_free_ratio(data_dir), get_free_ratio(data_log_dir))
+      task_retain_count, task_interval = get_schedule(
+         free_ratio,
+         retain_count,
+         interval
+      )
+      log.info('Purging, free_ratio=%.2f, retain_count=%s' % (
+         free_ratio, task_retain_count
+      ))
+      purge(data_dir, data_log_dir, task_retain_count)
+      return task_interval
+
+   return run
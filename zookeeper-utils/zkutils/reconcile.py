@@ -0,0 +1,229 @@
+import time
+import logging
+
+import aws, cache, config, ensemble, monitor, placement, retry, roles, utils
+
+
+log = logging.getLogger(__name__)
+
+RECONCILE_ATTEMPTS = 3
+RECONCILE_BACKOFF = retry.Backoff(1, 10, attempts=RECONCILE_ATTEMPTS)
+# A new instance creates the log stream of its id before it tags itself,
+# so recent streams are not deleted while their instance is starting.
+STREAM_GRACE_PERIOD = 900 # seconds
+# Lifetimes of the listings cached between runs, see `cache.Cache`
+MEMBERS_TTL = 300 # seconds
+MEMBERS_STALE_TTL = 3600 # seconds
+STREAMS_TTL = 3600 # seconds
+
+
+class ReconcileError(Exception):
+   pass
+
+
+class Plan(object):
+   ''' The incremental reconfig that turns the actual membership into
+   the desired one, applied as a single versioned reconfig. '''
+
+   def __init__(self, joining=None, leaving=None, version=None):
+      self.joining = joining or []
+      self.leaving = leaving or []
+      self.version = version
+
+   def is_empty(self):
+      return not self.joining and not self.leaving
+
+   def __repr__(self):
+      return 'Plan(joining=%s, leaving=%s, version=%s)' % (
+         [str(s) for s in self.joining], self.leaving, self.version
+      )
+
+
+def get_desired_members(region, asgroup_name):
+   ''' Returns the ({id: ip}, {id: availability zone}) of the running
+   instances of the autoscaling group, from a single snapshot. '''
+   instances = aws.get_running_instances(region, [
+      (ensemble.ASGROUP_TAG, [asgroup_name]),
+      (ensemble.ZK_ID_TAG, ensemble.CLAIMABLE_ZK_IDS)
+   ])
+   members = {}
+   for i in instances:
+      tags = [t for t in i['Tags'] if t['Key']==ensemble.ZK_ID_TAG]
+      ip = i['NetworkInterfaces'][0]['PrivateIpAddress']
+      members[tags[0]['Value']] = ip
+   return members, ensemble.get_zookeeper_azs(instances)
+
+
+def load_desired_members(region, asgroup_name, group_cache=None):
+   ''' Returns the desired members, see `get_desired_members`, from the
+   cache of the group if one is given. A stale listing is returned while
+   it is refreshed in the background. '''
+   if group_cache is None:
+      return get_desired_members(region, asgroup_name)
+   desired, azs = group_cache.get(
+      cache.KEY_MEMBERS,
+      lambda: get_desired_members(region, asgroup_name),
+      MEMBERS_TTL,
+      MEMBERS_STALE_TTL
+   )
+   return desired, azs
+
+
+def get_running_ips(ips):
+   ''' Returns the ips on which a Zookeeper server is running. '''
+   return [ip for ip in ips if monitor.is_running(ip)]
+
+
+def compute_plan(actual, desired, running_ips,
+                 max_voters=roles.DEFAULT_MAX_VOTERS, azs=None, rtts=None):
+   ''' Returns the plan that turns the `actual` dynamic config into the
+   desired membership, given as {id: ip}.
+
+   - Servers that are not desired anymore are removed.
+   - A server whose instance was replaced under the same id is moved to
+     the new ip if Zookeeper runs there, otherwise it is removed and the
+     new instance joins on its own once bootstrapped.
+   - Desired servers missing from the config are added once Zookeeper
+     runs on them, with the role `roles.get_join_role` gives them.
+   - Roles are changed last, see `roles.get_role_changes`.
+
+   Members that are not running yet are never waited for, so removals
+   complete in one pass even while the group is below capacity.
+   '''
+   target = actual.copy()
+   for server in actual.sorted_servers():
+      ip = desired.get(server.id)
+      if ip is None:
+         target.remove(server.id)
+      elif ip != server.ip:
+         if ip in running_ips:
+            target.add(config.Server(server.id, ip, role=server.role))
+         else:
+            target.remove(server.id)
+
+   for server_id in sorted(desired, key=int):
+      ip = desired[server_id]
+      if target.get(server_id) is None and ip in running_ips:
+         role = roles.get_join_role(target, max_voters)
+         target.add(config.Server(server_id, ip, role=role))
+
+   for server in roles.get_role_changes(target, max_voters, azs, rtts):
+      target.add(server)
+
+   if not target.participants():
+      raise ReconcileError('Refusing a config without voters, desired=%s'
+                           % desired)
+   joining, leaving = actual.diff(target)
+   return Plan(joining, leaving, actual.version)
+
+
+def compute_removal(actual, server_ids, max_voters=roles.DEFAULT_MAX_VOTERS):
+   ''' Returns the plan that removes the servers and promotes observers
+   in place of the voters among them. '''
+   target = actual.copy()
+   for server_id in server_ids:
+      target.remove(server_id)
+   for server in roles.get_role_changes(target, max_voters):
+      target.add(server)
+   joining, leaving = actual.diff(target)
+   return Plan(joining, leaving, actual.version)
+
+
+def apply_plan(ensemble_ip, plan):
+   ''' Applies the plan as a single reconfig, conditional on the config
+   version the plan was computed from. '''
+   if plan.is_empty():
+      log.info('Membership up to date, version=%s' % plan.version)
+      return False
+   log.info('Applying %s' % plan)
+   ensemble._cmd_reconfig(ensemble_ip, plan.joining, plan.leaving, plan.version)
+   return True
+
+
+def get_stale_log_streams(region, log_group, ids, now=None,
+                          group_cache=None):
+   ''' Returns the names of the id log streams not used by any of the
+   ids, leaving out streams created within the grace period. The streams
+   are listed from the cache of the group if one is given. '''
+   if group_cache is None:
+      streams = aws.get_log_streams(region, log_group)
+   else:
+      streams = group_cache.get(
+         cache.KEY_STREAMS,
+         lambda: aws.get_log_streams(region, log_group),
+         STREAMS_TTL
+      )
+   return filter_stale_log_streams(streams, ids, now)
+
+
+def filter_stale_log_streams(streams, ids, now=None):
+   ''' Returns the names of the id log streams not used by any of the
+   ids and older than the grace period. '''
+   now = now or time.time()
+   stale = []
+   for stream in streams:
+      name = stream['logStreamName']
+      age = now - stream.get('creationTime', 0) / 1000.0
+      if name in ensemble.CLAIMABLE_ZK_IDS and name not in ids and \
+            age > STREAM_GRACE_PERIOD:
+         stale.append(name)
+   return stale
+
+
+def reconcile(region, asgroup_name, ensemble_ip, log_group,
+              max_voters=roles.DEFAULT_MAX_VOTERS, group_cache=None):
+   ''' Reconciles the ensemble membership with the running instances of
+   the autoscaling group. Returns the applied plan.
+
+   The desired membership and the actual one are each read once and the
+   plan is applied as one reconfig conditional on the config version.
+   If another reconfig happened in between, both are read again.
+   Finally the log streams of the ids that left are deleted, so that new
+   instances can claim them.
+
+   With the cache of the group, the instances and log streams are listed
+   from the cache, so a run that finds nothing to change makes no AWS
+   call. Changes are only made after listing them again from AWS.
+   '''
+   def compute(fresh):
+      if fresh:
+         group_cache.invalidate(cache.KEY_MEMBERS)
+      desired, azs = load_desired_members(region, asgroup_name, group_cache)
+      actual = ensemble.get_zookeeper_configuration(ensemble_ip)
+      log.info('Desired members=%s, actual ids=%s, version=%s' % (
+         desired, actual.ids(), actual.version
+      ))
+      running_ips = get_running_ips(desired.values())
+      rtts = None
+      if azs:
+         rtts = placement.measure_rtts([
+            s for s in actual.sorted_servers() if s.ip in running_ips
+         ])
+      plan = compute_plan(actual, desired, running_ips, max_voters, azs, rtts)
+      return desired, actual, plan
+
+   def attempt():
+      desired, actual, plan = compute(False)
+      if group_cache and not plan.is_empty():
+         desired, actual, plan = compute(True)
+      apply_plan(ensemble_ip, plan)
+      return desired, actual, plan
+
+   desired, actual, plan = retry.retry(
+      attempt,
+      RECONCILE_BACKOFF,
+      utils.CommandError
+   )
+   ids = set(desired) | (set(actual.ids()) - set(plan.leaving))
+   stale = get_stale_log_streams(region, log_group, ids,
+                                 group_cache=group_cache)
+   if stale and group_cache:
+      group_cache.invalidate(cache.KEY_STREAMS)
+      stale = get_stale_log_streams(region, log_group, ids,
+                                    group_cache=group_cache)
+   if stale:
+      log.info('Removing log streams=%s' % stale)
+      aws.delete_log_streams(region, log_group, stale)
+      if group_cache:
+         group_cache.invalidate(cache.KEY_STREAMS)
+   return plan
@@ -0,0 +1,232 @@
+import json
+import time
+import logging
+import threading
+
+from kazoo.exceptions import BadVersionError, NodeExistsError
+from kazoo.recipe.watchers import ChildrenWatch
+
+import client, config, membership, monitor, reconcile, roles
+
+
+log = logging.getLogger(__name__)
+
+REGISTRY_PATH = '/zkutils/members'
+REGISTER_INTERVAL = 10 # seconds
+JANITOR_INTERVAL = 2 # seconds
+# A departed member is removed once it has been gone for this long and
+# failed this many checks in a row, so that a reboot or a restart of
+# Zookeeper does not remove it
+DEPARTED_GRACE_PERIOD = 6 * client.TIMEOUT # seconds
+REMOVAL_CHECKS = 3
+# A departed member whose instance was found running is not listed again
+# for this long, so that a member whose Zookeeper stays down does not cost
+# an AWS call on every run of the janitor
+RUNNING_RECHECK_PERIOD = reconcile.MEMBERS_TTL # seconds
+
+
+class Registration(object):
+   ''' The ephemeral registration of a live member. '''
+
+   def __init__(self, server, az=None):
+      self.server = server
+      self.az = az
+
+   @property
+   def path(self):
+      return '%s/%s' % (REGISTRY_PATH, self.server.id)
+
+   @classmethod
+   def parse(cls, data):
+      values = json.loads(data)
+      return cls(config.Server.parse(values['server']), values.get('az'))
+
+   def serialize(self):
+      return json.dumps({
+         'id': self.server.id,
+         'ip': self.server.ip,
+         'role': self.server.role,
+         'server': str(self.server),
+         'az': self.az
+      }, sort_keys=True)
+
+
+def register(zk_client, registration):
+   ''' Registers the member with an ephemeral znode, which goes away with
+   the session of the member. Returns True if the znode was written. '''
+   data = registration.serialize()
+   zk_client.ensure_path(REGISTRY_PATH)
+   stat = zk_client.exists(registration.path)
+   if stat and stat.ephemeralOwner == zk_client.client_id[0]:
+      current, _ = zk_client.get(registration.path)
+      if current == data:
+         return False
+      zk_client.set(registration.path, data)
+      return True
+   if stat:
+      # Left over by a previous session of this member
+      zk_client.delete(registration.path)
+   try:
+      zk_client.create(registration.path, data, ephemeral=True)
+   except NodeExistsError:
+      return False
+   log.info('Registered %s' % registration.path)
+   return True
+
+
+def register_task(id_file, ip='localhost', az=None):
+   ''' Returns the agent task that keeps this member registered, once it
+   is a member of the ensemble. '''
+   sessions = []
+
+   def task():
+      if not sessions:
+         sessions.append(client.connect(ip))
+      zk_client = sessions[0]
+      with open(id_file, 'r') as fread:
+         server_id = fread.read().strip()
+      server = membership.get_configuration(zk_client).get(server_id)
+      if server:
+         register(zk_client, Registration(server, az))
+      return REGISTER_INTERVAL
+   return task
+
+
+class Janitor(object):
+   ''' Removes the members whose registration went away, i.e. whose
+   session expired, from the ensemble. It runs on the leader, see
+   `janitor_task`.
+
+   A reboot, a slow start or a restart of Zookeeper also expires the
+   session, so a departed member is only removed once it has been gone
+   for the grace period, failed the removal checks in a row and its
+   instance is not running in the autoscaling group anymore. A member that
+   registers again in the meantime is left alone.
+   '''
+
+   def __init__(self, region, asgroup_name,
+                max_voters=roles.DEFAULT_MAX_VOTERS, clock=time.time):
+      self.region = region
+      self.asgroup_name = asgroup_name
+      self.max_voters = max_voters
+      self.clock = clock
+      # {id: time of the departure}
+      self.departed = {}
+      # {id: failed checks in a row}
+      self.failures = {}
+      # {id: time its instance was last found running}
+      self.seen_running = {}
+      self._members = None
+      self._client = None
+      self._lock = threading.Lock()
+
+   def on_members(self, children):
+      ''' Called by the watch with the registered ids. '''
+      children = set(children)
+      with self._lock:
+         if self._members is not None:
+            for server_id in self._members - children:
+               self.departed.setdefault(server_id, self.clock())
+         for server_id in children:
+            self.departed.pop(server_id, None)
+            self.failures.pop(server_id, None)
+            self.seen_running.pop(server_id, None)
+         self._members = children
+
+   def watch(self, zk_client):
+      self._client = zk_client
+      self._members = None
+      zk_client.ensure_path(REGISTRY_PATH)
+      ChildrenWatch(zk_client, REGISTRY_PATH, self.on_members)
+
+   def forget(self, server_ids):
+      with self._lock:
+         for server_id in server_ids:
+            self.departed.pop(server_id, None)
+            self.failures.pop(server_id, None)
+            self.seen_running.pop(server_id, None)
+
+   def check(self, server):
+      ''' Returns the failed checks in a row of the departed server. '''
+      try:
+         monitor.get_status(server.ip)
+         log.info('Departed id=%s still serves requests' % server.id)
+         failures = 0
+      except monitor.MonitorError:
+         with self._lock:
+            failures = self.failures.get(server.id, 0) + 1
+      with self._lock:
+         self.failures[server.id] = failures
+      return failures
+
+   def get_removable_ids(self, dynamic_config):
+      ''' Returns the departed ids that are members of the ensemble, have
+      been gone for the grace period, do not serve requests anymore and
+      whose instance is not running. The instances are only listed for
+      the ids not found running within the RUNNING_RECHECK_PERIOD. '''
+      now = self.clock()
+      with self._lock:
+         departed = dict(self.departed)
+      candidates = []
+      for server_id in sorted(departed, key=int):
+         server = dynamic_config.get(server_id)
+         if not server:
+            self.forget([server_id])
+            continue
+         failures = self.check(server)
+         with self._lock:
+            seen_running = self.seen_running.get(server_id)
+         if seen_running is not None and \
+               now - seen_running < RUNNING_RECHECK_PERIOD:
+            continue
+         if failures >= REMOVAL_CHECKS and \
+               now - departed[server_id] >= DEPARTED_GRACE_PERIOD:
+            candidates.append(server)
+      if not candidates:
+         return []
+      running, _ = reconcile.get_desired_members(
+         self.region,
+         self.asgroup_name
+      )
+      removable = []
+      for server in candidates:
+         if running.get(server.id) == server.ip:
+            log.info('Departed id=%s still has a running instance'
+                     % server.id)
+            with self._lock:
+               self.seen_running[server.id] = now
+         else:
+            removable.append(server.id)
+      return removable
+
+   def __call__(self, zk_client):
+      if zk_client is not self._client:
+         self.watch(zk_client)
+      dynamic_config = membership.get_configuration(zk_client)
+      removable = self.get_removable_ids(dynamic_config)
+      if not removable:
+         return None
+      plan = reconcile.compute_removal(
+         dynamic_config,
+         removable,
+         self.max_voters
+      )
+      log.info('Removing departed ids=%s with %s' % (removable, plan))
+      try:
+         client.reconfig(zk_client, plan)
+      except BadVersionError:
+         log.info('Config changed, version=%s, retrying' % plan.version)
+         return None
+      self.forget(removable)
+      return plan
+
+
+def janitor_task(region, asgroup_name, ip='localhost',
+                 max_voters=roles.DEFAULT_MAX_VOTERS):
+   ''' Returns the agent task of the janitor, which only runs on the
+   leader. '''
+   return client.leader_task(
+      Janitor(region, asgroup_name, max_voters),
+      ip,
+      JANITOR_INTERVAL
+   )
@@ -0,0 +1,112 @@
+import time
+import random
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class DeadlineExceeded(Exception):
+   pass
+
+
+class Deadline(object):
+   ''' The time budget of an operation, shared by all the waits it does.
+   Without a budget the deadline never expires. '''
+
+   def __init__(self, budget=None):
+      self.budget = budget
+      self.expires = time.time() + budget if budget is not None else None
+
+   def remaining(self):
+      ''' Returns the seconds left, None if there is no budget. '''
+      if self.expires is None:
+         return None
+      return max(0, self.expires - time.time())
+
+   def expired(self):
+      return self.expires is not None and time.time() >= self.expires
+
+   def check(self):
+      if self.expired():
+         raise DeadlineExceeded(
+            'Deadline exceeded, budget=%s seconds' % self.budget
+         )
+
+   def limit(self, timeout):
+      ''' Returns the timeout, shortened to what is left of the budget. '''
+      remaining = self.remaining()
+      if remaining is None:
+         return timeout
+      return remaining if timeout is None else min(timeout, remaining)
+
+
+class Backoff(object):
+   ''' Exponential backoff with decorrelated jitter: each delay is drawn
+   between `base` and three times the previous delay, capped to `cap`.
+   Instances that start retrying at the same time thus spread out after
+   the first attempts instead of calling in lockstep.
+
+   At most `attempts` calls are made, without limit if None.
+   '''
+
+   def __init__(self, base=1, cap=30, attempts=None):
+      self.base = base
+      self.cap = cap
+      self.attempts = attempts
+
+   def delays(self, rand=random):
+      ''' Yields the delay before each retry. '''
+      delay = self.base
+      count = 1
+      while self.attempts is None or count < self.attempts:
+         delay = min(self.cap, rand.uniform(self.base, delay * 3))
+         yield delay
+         count += 1
+
+   def __repr__(self):
+      return 'Backoff(base=%s, cap=%s, attempts=%s)' % (
+         self.base, self.cap, self.attempts
+      )
+
+
+def _sleep(delay, deadline):
+   remaining = deadline.remaining()
+   if remaining is not None:
+      delay = min(delay, remaining)
+   time.sleep(delay)
+
+
+def retry(func, backoff, retryable=(Exception,), deadline=None):
+   ''' Calls `func` until it does not raise one of the `retryable`
+   exceptions. The last exception is raised once the attempts of the
+   backoff are exhausted, DeadlineExceeded once the deadline passed. '''
+   deadline = deadline or Deadline()
+   delays = backoff.delays()
+   while True:
+      deadline.check()
+      try:
+         return func()
+      except retryable as ex:
+         delay = next(delays, None)
+         if delay is None:
+            raise
+         log.info('Retrying in %.1f seconds, %s' % (delay, ex))
+         _sleep(delay, deadline)
+
+
+def poll(func, backoff, deadline=None):
+   ''' Calls `func` until it returns a true value, which is returned.
+   The last value is returned once the attempts of the backoff are
+   exhausted, DeadlineExceeded is raised once the deadline passed. '''
+   deadline = deadline or Deadline()
+   delays = backoff.delays()
+   while True:
+      deadline.check()
+      result = func()
+      if result:
+         return result
+      delay = next(delays, None)
+      if delay is None:
+         return result
+      _sleep(delay, deadline)
@@ -0,0 +1,81 @@
+import logging
+
+import config, placement
+
+
+log = logging.getLogger(__name__)
+
+# Every voter adds to the latency of a write commit, so the voting
+# members are capped and the other members stay permanent observers
+# that add read and connection capacity.
+DEFAULT_MAX_VOTERS = 5
+
+
+def _sort_key(server):
+   return int(server.id)
+
+
+def assign_roles(servers, max_voters=DEFAULT_MAX_VOTERS, azs=None):
+   ''' Returns the servers of a fresh ensemble with their roles, the
+   `max_voters` lowest ids being participants and the others observers.
+
+   Given the {id: availability zone} of the servers, the participants are
+   spread across the zones instead. Every instance of a fresh bootstrap
+   has to come up with the same config, so round trip times which are
+   measured locally are not taken into account here.
+   '''
+   servers = sorted(servers, key=_sort_key)
+   if azs:
+      voters = placement.choose_voters(servers, max_voters, azs)
+   else:
+      voters = [s.id for s in servers[:max_voters]]
+   return [
+      s.with_role(
+         config.ROLE_PARTICIPANT if s.id in voters else config.ROLE_OBSERVER
+      ) for s in servers
+   ]
+
+
+def get_join_role(dynamic_config, max_voters=DEFAULT_MAX_VOTERS):
+   ''' Returns the role a new server joins the ensemble with. '''
+   if len(dynamic_config.participants()) < max_voters:
+      return config.ROLE_PARTICIPANT
+   return config.ROLE_OBSERVER
+
+
+def get_role_changes(dynamic_config, max_voters=DEFAULT_MAX_VOTERS,
+                     azs=None, rtts=None):
+   ''' Returns the servers whose role has to change to have exactly
+   `max_voters` voters, or as many as there are members.
+
+   Observers are promoted when voters were lost and the highest voter ids
+   are demoted when there are too many voters. Given the availability
+   zones of the servers, voters are also moved so that they are spread
+   across the zones, see `placement.get_placement_changes`.
+   '''
+   if azs:
+      changes = placement.get_placement_changes(
+         dynamic_config,
+         max_voters,
+         azs,
+         rtts
+      )
+      if changes:
+         log.info('Role changes=%s' % changes)
+      return changes
+
+   participants = dynamic_config.participants()
+   observers = dynamic_config.observers()
+   missing = max_voters - len(participants)
+   if missing > 0:
+      changes = [
+         s.with_role(config.ROLE_PARTICIPANT) for s in observers[:missing]
+      ]
+   else:
+      changes = [
+         s.with_role(config.ROLE_OBSERVER)
+            for s in sorted(participants, key=_sort_key)[max_voters:]
+      ]
+   if changes:
+      log.info('Role changes=%s' % changes)
+   return changes
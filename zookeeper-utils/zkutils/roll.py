@@ -0,0 +1,178 @@
+import logging
+
+import aws, ensemble, monitor, retry
+
+
+log = logging.getLogger(__name__)
+
+MODE_RESTART = 'restart'
+MODE_REPLACE = 'replace'
+DEFAULT_MAX_LAG = 10 # transactions
+DEFAULT_TIMEOUT = 1800 # seconds
+DEFAULT_RESTART_COMMAND = 'systemctl restart zk-bootstrap'
+POLL_INTERVAL = 5 # seconds
+POLL_BACKOFF = retry.Backoff(POLL_INTERVAL, 30)
+
+# Members are rolled in this order so that the leader goes last
+# and only one election happens during the whole roll.
+MODE_ORDER = [
+   monitor.MODE_OBSERVER,
+   monitor.MODE_FOLLOWER,
+   monitor.MODE_LEADER
+]
+
+
+class Member(object):
+   ''' A Zookeeper instance of the autoscaling group. '''
+
+   def __init__(self, instance_id, zk_id, ip, launch_config=None):
+      self.instance_id = instance_id
+      self.zk_id = zk_id
+      self.ip = ip
+      self.launch_config = launch_config
+
+   def __repr__(self):
+      return 'Member(id=%s, ip=%s, instance_id=%s)' % (
+         self.zk_id, self.ip, self.instance_id
+      )
+
+
+def get_members(region, asgroup):
+   ''' Returns the members running in the autoscaling group. '''
+   launch_configs = dict(
+      (i['InstanceId'], i.get('LaunchConfigurationName'))
+         for i in asgroup['Instances']
+   )
+   tag_value_pairs = [
+      (ensemble.ASGROUP_TAG, [asgroup['AutoScalingGroupName']]),
+      (ensemble.ZK_ID_TAG, ensemble.CLAIMABLE_ZK_IDS)
+   ]
+   members = []
+   for i in aws.get_running_instances(region, tag_value_pairs):
+      tags = [t for t in i['Tags'] if t['Key']==ensemble.ZK_ID_TAG]
+      members.append(Member(
+         i['InstanceId'],
+         tags[0]['Value'],
+         i['NetworkInterfaces'][0]['PrivateIpAddress'],
+         launch_configs.get(i['InstanceId'])
+      ))
+   return members
+
+
+def get_roll_order(members, statuses):
+   ''' Returns the members in the order to roll them: observers first,
+   then followers and the leader last. '''
+   def key(member):
+      status = statuses.get(member.ip)
+      mode = status['mode'] if status else None
+      rank = MODE_ORDER.index(mode) if mode in MODE_ORDER else -1
+      return (rank, int(member.zk_id))
+   return sorted(members, key=key)
+
+
+def is_healthy(statuses, max_lag):
+   ''' Returns True if there is a leader and every other server is
+   synced with it, which is when it is safe to take one member down. '''
+   leader_status = monitor.get_leader_status(statuses)
+   if not leader_status:
+      return False
+   return all(
+      status and monitor.is_synced(status, leader_status, max_lag)
+         for status in statuses.values()
+   )
+
+
+def wait_until_healthy(ips, max_lag=DEFAULT_MAX_LAG,
+                       timeout=DEFAULT_TIMEOUT):
+   ''' Waits until all servers are synced with the leader. '''
+   def check():
+      if is_healthy(monitor.get_statuses(ips), max_lag):
+         return True
+      log.info('Waiting for the ensemble to be healthy ...')
+      return False
+
+   try:
+      retry.poll(check, POLL_BACKOFF, retry.Deadline(timeout))
+   except retry.DeadlineExceeded:
+      raise Exception('Ensemble not healthy after %s seconds' % timeout)
+   log.info('Ensemble is healthy, ips=%s' % ips)
+
+
+def wait_for_replacement(region, asgroup_name, known_ids,
+                         timeout=DEFAULT_TIMEOUT):
+   ''' Waits for the autoscaling group to launch a new member and
+   returns it. '''
+   def get_new_members():
+      asgroup = aws.describe_autoscaling_group(region, asgroup_name)
+      new_members = [
+         m for m in get_members(region, asgroup)
+            if m.instance_id not in known_ids
+      ]
+      if not new_members:
+         log.info('Waiting for a replacement instance ...')
+      return new_members
+
+   try:
+      new_members = retry.poll(
+         get_new_members,
+         POLL_BACKOFF,
+         retry.Deadline(timeout)
+      )
+   except retry.DeadlineExceeded:
+      raise Exception('No replacement after %s seconds' % timeout)
+   log.info('Replacement launched, member=%s' % new_members[0])
+   return new_members[0]
+
+
+def roll(region, asgroup_name,
+         mode=MODE_RESTART,
+         max_lag=DEFAULT_MAX_LAG,
+         timeout=DEFAULT_TIMEOUT,
+         restart_command=DEFAULT_RESTART_COMMAND,
+         outdated_only=False):
+   ''' Restarts or replaces the members of the ensemble one at a time,
+   followers first and the leader last.
+
+   Before each step the whole ensemble has to be synced with the leader
+   and a member is done only once it serves requests again and is at most
+   `max_lag` transactions behind the leader. The quorum therefore never
+   misses more than one member at a time.
+
+   With `outdated_only`, only members that do not run the current launch
+   configuration of the autoscaling group are rolled, which is how a new
+   AMI is rolled out.
+   '''
+   asgroup = aws.describe_autoscaling_group(region, asgroup_name)
+   members = get_members(region, asgroup)
+   known_ids = set(m.instance_id for m in members)
+   ips = [m.ip for m in members]
+   statuses = monitor.get_statuses(ips)
+   if outdated_only:
+      current = asgroup.get('LaunchConfigurationName')
+      members = [m for m in members if m.launch_config != current]
+   order = get_roll_order(members, statuses)
+   log.info('Rolling mode=%s, order=%s' % (mode, order))
+
+   for member in order:
+      wait_until_healthy(ips, max_lag, timeout)
+      log.info('Rolling member=%s' % member)
+      if mode == MODE_REPLACE:
+         aws.terminate_instance(region, member.instance_id)
+         new_member = wait_for_replacement(
+            region,
+            asgroup_name,
+            known_ids,
+            timeout
+         )
+         known_ids.add(new_member.instance_id)
+         ips = [ip for ip in ips if ip != member.ip] + [new_member.ip]
+      else:
+         aws.run_shell_command(
+            region,
+            member.instance_id,
+            restart_command,
+            timeout
+         )
+   wait_until_healthy(ips, max_lag, timeout)
+   log.info('Roll completed, count=%s' % len(order))
+   return order
@@ -0,0 +1,111 @@
+import logging
+
+from kazoo.exceptions import BadVersionError
+
+import admin, client, config, membership, monitor, reconcile
+
+
+log = logging.getLogger(__name__)
+
+CHECK_INTERVAL = 2 # seconds
+# Consecutive failed checks after which a voter is replaced
+FAILURE_THRESHOLD = 3
+DEFAULT_MAX_LAG = 10 # transactions
+
+
+class HealthTracker(object):
+   ''' Counts the consecutive failed health checks of the voters. '''
+
+   def __init__(self, threshold=FAILURE_THRESHOLD):
+      self.threshold = threshold
+      self.failures = {}
+
+   def update(self, voters, statuses):
+      ''' Records a check of the voters and returns the ids of those
+      that failed `threshold` checks in a row. '''
+      failures = {}
+      for server in voters:
+         status = statuses.get(server.ip)
+         if status and status['mode'] in monitor.SERVING_MODES:
+            continue
+         failures[server.id] = self.failures.get(server.id, 0) + 1
+      self.failures = failures
+      return sorted(
+         (i for i, count in failures.items() if count >= self.threshold),
+         key=int
+      )
+
+
+def choose_standbys(dynamic_config, statuses, count,
+                    max_lag=DEFAULT_MAX_LAG):
+   ''' Returns up to `count` observers that are synced with the leader,
+   the least lagging first. '''
+   leader_status = monitor.get_leader_status(statuses)
+   if not leader_status:
+      return []
+   standbys = []
+   for server in dynamic_config.observers():
+      status = statuses.get(server.ip)
+      if status and monitor.is_synced(status, leader_status, max_lag):
+         lag = monitor.get_lag(status, leader_status)
+         standbys.append((lag, int(server.id), server))
+   return [server for _, _, server in sorted(standbys)[:count]]
+
+
+def compute_failover(dynamic_config, failed_ids, standbys):
+   ''' Returns the plan that swaps the roles of the failed voters and of
+   the standbys in one reconfig. The failed voters stay members as
+   observers, so they rejoin as soon as they are back, and are removed
+   by zk-remove-terminated if their instance is gone. '''
+   target = dynamic_config.copy()
+   for server_id, standby in zip(failed_ids, standbys):
+      target.add(target.get(server_id).with_role(config.ROLE_OBSERVER))
+      target.add(standby.with_role(config.ROLE_PARTICIPANT))
+   joining, leaving = dynamic_config.diff(target)
+   return reconcile.Plan(joining, leaving, dynamic_config.version)
+
+
+def check_voters(zk_client, tracker, max_lag=DEFAULT_MAX_LAG,
+                 admin_client=None):
+   ''' Checks the health of the voters and promotes standby observers in
+   place of the voters that failed too many checks in a row. Returns the
+   applied plan, if any. '''
+   dynamic_config = membership.get_configuration(zk_client)
+   statuses = monitor.get_statuses(
+      [s.ip for s in dynamic_config.sorted_servers()],
+      admin_client
+   )
+   failed_ids = tracker.update(dynamic_config.participants(), statuses)
+   if not failed_ids:
+      return None
+   standbys = choose_standbys(dynamic_config, statuses, len(failed_ids),
+                              max_lag)
+   if not standbys:
+      log.error('No synced standby to replace ids=%s' % failed_ids)
+      return None
+   plan = compute_failover(dynamic_config, failed_ids, standbys)
+   log.info('Replacing failed voters ids=%s with standbys=%s' % (
+      failed_ids, [s.id for s in standbys]
+   ))
+   try:
+      client.reconfig(zk_client, plan)
+   except BadVersionError:
+      log.info('Config changed, version=%s, retrying' % plan.version)
+      return None
+   tracker.failures = {}
+   return plan
+
+
+def standby_task(ip='localhost', threshold=FAILURE_THRESHOLD,
+                 max_lag=DEFAULT_MAX_LAG):
+   ''' Returns the agent task that replaces failed voters with standby
+   observers, which only does so on the leader. The servers are polled
+   over the keep-alive connections of an `admin.AdminClient`. '''
+   tracker = HealthTracker(threshold)
+   admin_client = admin.AdminClient()
+   return client.leader_task(
+      lambda zk_client: check_voters(zk_client, tracker, max_lag,
+                                     admin_client),
+      ip,
+      CHECK_INTERVAL
+   )
@@ -0,0 +1,34 @@
+import os
+import json
+import logging
+
+import utils
+
+
+log = logging.getLogger(__name__)
+
+
+def load(filename):
+   ''' Returns the state saved in the file, None if there is none or it
+   cannot be read. '''
+   try:
+      with open(filename, 'r') as fread:
+         return json.loads(fread.read())
+   except (IOError, OSError, ValueError) as ex:
+      log.info('No state in file=%s, %s' % (filename, ex))
+      return None
+
+
+def save(filename, values):
+   ''' Saves the state atomically, see `utils.save_to_file`. '''
+   return utils.save_to_file(
+      filename,
+      json.dumps(values, indent=2, sort_keys=True),
+      history=0
+   )
+
+
+def clear(filename):
+   ''' Removes the saved state, if any. '''
+   if os.path.exists(filename):
+      os.remove(filename)
@@ -0,0 +1,99 @@
+import logging
+from multiprocessing.pool import ThreadPool
+
+import admin, config, monitor, reconcile
+
+
+log = logging.getLogger(__name__)
+
+TIMEOUT = 2 # seconds
+# Columns of the status table, as (title, key of the member status)
+COLUMNS = [
+   ('ID', 'id'),
+   ('IP', 'ip'),
+   ('ROLE', 'role'),
+   ('MODE', 'mode'),
+   ('ZXID', 'zxid'),
+   ('LATENCY', 'latency'),
+   ('OUTSTANDING', 'outstanding'),
+   ('CONNECTIONS', 'connections'),
+   ('ZNODES', 'znode_count'),
+   ('VERSION', 'version')
+]
+
+
+def get_group_members(region, asgroup_name):
+   ''' Returns the servers of the running instances of the group. Their
+   role is read from the config of each server. '''
+   members, _ = reconcile.get_desired_members(region, asgroup_name)
+   return [
+      config.Server(server_id, ip, role=None)
+         for server_id, ip in sorted(members.items(), key=lambda m: int(m[0]))
+   ]
+
+
+def get_file_members(dynamic_file):
+   ''' Returns the servers of the dynamic config file. '''
+   return config.DynamicConfig.load(dynamic_file).sorted_servers()
+
+
+def get_member_status(server, admin_client):
+   ''' Returns the status of the member from its srvr, mntr and conf.
+   The status of a member that does not serve requests has an error. '''
+   status = {'id': server.id, 'ip': server.ip, 'role': server.role}
+   try:
+      status.update(admin_client.get_status(server.ip))
+      mntr = admin_client.get_mntr(server.ip)
+      status['znode_count'] = mntr.get('znode_count')
+      # The conf of the AdminServer does not have the membership
+      dynamic_config = monitor.get_conf(server.ip, admin_client.timeout)
+      status['version'] = dynamic_config.version
+      member = dynamic_config.get(server.id)
+      if member:
+         status['role'] = member.role
+   except monitor.MonitorError as ex:
+      status['error'] = str(ex)
+   return status
+
+
+def get_statuses(servers, admin_client=None):
+   ''' Returns the status of each member, see `get_member_status`,
+   querying all of them at once. '''
+   if not servers:
+      return []
+   admin_client = admin_client or admin.AdminClient(timeout=TIMEOUT)
+   pool = ThreadPool(len(servers))
+   try:
+      return pool.map(
+         lambda server: get_member_status(server, admin_client),
+         servers
+      )
+   finally:
+      pool.close()
+
+
+def _format_value(status, key):
+   if key == 'zxid' and status.get('zxid') is not None:
+      return hex(status['zxid']).rstrip('L')
+   if key == 'latency' and status.get('latency_avg') is not None:
+      return '%g/%g/%g' % (
+         status['latency_min'], status['latency_avg'], status['latency_max']
+      )
+   value = status.get(key)
+   return '-' if value is None else str(value)
+
+
+def format_table(statuses, columns=COLUMNS):
+   ''' Returns the statuses as a table with a row per member. The error
+   of a member that does not serve requests ends its row. '''
+   rows = [[title for title, _ in columns]]
+   for status in statuses:
+      rows.append([_format_value(status, key) for _, key in columns])
+   widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+   lines = []
+   for row, status in zip(rows, [{}] + list(statuses)):
+      line = '  '.join(v.ljust(w) for v, w in zip(row, widths)).rstrip()
+      if status.get('error'):
+         line = '%s  %s' % (line, status['error'])
+      lines.append(line)
+   return '\n'.join(lines)
@@ -0,0 +1,218 @@
+import os
+import logging
+import multiprocessing
+
+import config, utils
+
+
+log = logging.getLogger(__name__)
+
+JAVA_ENV_FILE = 'java.env'
+DISK_NVME = 'nvme'
+DISK_EBS = 'ebs'
+DISK_SSD = 'ssd'
+DISK_HDD = 'hdd'
+DISK_UNKNOWN = 'unknown'
+GC_SERIAL = 'Serial'
+GC_PARALLEL = 'Parallel'
+GC_G1 = 'G1'
+
+# Prefix of the override settings that are meant for the JVM,
+# i.e. `jvm.heap_mb`, `jvm.gc` and `jvm.flags`. The `profile` setting
+# forces a profile and every other setting goes to zoo.cfg.
+JVM_PREFIX = 'jvm.'
+PROFILE_KEY = 'profile'
+
+# Named profiles as (name, minimum memory in MB, profile) in increasing
+# order of memory. The heap is a ratio of the memory capped to a maximum
+# so that the page cache keeps enough room for the snapshots.
+PROFILES = [
+   ('small', 0, {
+      'heap_ratio': 0.5,
+      'max_heap_mb': 1024,
+      'gc': GC_SERIAL,
+      'settings': {
+         'tickTime': 2000,
+         'initLimit': 10,
+         'syncLimit': 5,
+         'snapCount': 50000,
+         'preAllocSize': 16384,
+         'globalOutstandingLimit': 500,
+         'maxClientCnxns': 60
+      }
+   }),
+   ('medium', 3584, {
+      'heap_ratio': 0.5,
+      'max_heap_mb': 4096,
+      'gc': GC_PARALLEL,
+      'settings': {
+         'tickTime': 2000,
+         'initLimit': 10,
+         'syncLimit': 5,
+         'snapCount': 100000,
+         'preAllocSize': 65536,
+         'globalOutstandingLimit': 1000,
+         'maxClientCnxns': 200
+      }
+   }),
+   ('large', 15360, {
+      'heap_ratio': 0.5,
+      'max_heap_mb': 8192,
+      'gc': GC_G1,
+      'settings': {
+         'tickTime': 2000,
+         'initLimit': 10,
+         'syncLimit': 5,
+         'snapCount': 200000,
+         'preAllocSize': 131072,
+         'globalOutstandingLimit': 2000,
+         'maxClientCnxns': 1000
+      }
+   })
+]
+
+# Slower disks need more time to sync a follower with the leader.
+DISK_SETTINGS = {
+   DISK_HDD: {
+      'initLimit': 20,
+      'syncLimit': 10
+   }
+}
+
+GC_FLAGS = {
+   GC_SERIAL: '-XX:+UseSerialGC',
+   GC_PARALLEL: '-XX:+UseParallelGC',
+   GC_G1: '-XX:+UseG1GC -XX:MaxGCPauseMillis=50'
+}
+
+
+def _get_memory_mb():
+   with open('/proc/meminfo', 'r') as fread:
+      for line in fread:
+         if line.startswith('MemTotal:'):
+            return int(line.split()[1]) // 1024
+   return 0
+
+
+def _get_block_device(directory):
+   ''' Returns the sysfs path of the block device holding the directory. '''
+   stat = os.stat(directory)
+   path = os.path.realpath('/sys/dev/block/%s:%s' % (
+      os.major(stat.st_dev), os.minor(stat.st_dev)
+   ))
+   # Partitions are a sub directory of their disk
+   if os.path.isfile(os.path.join(path, 'partition')):
+      path = os.path.dirname(path)
+   return path
+
+
+def _read(filename):
+   with open(filename, 'r') as fread:
+      return fread.read().strip()
+
+
+def get_device_type(path):
+   ''' Returns the type of a disk given its sysfs path. '''
+   name = os.path.basename(path)
+   if name.startswith('nvme'):
+      model = _read(os.path.join(path, 'device', 'model'))
+      return DISK_EBS if 'Elastic Block Store' in model else DISK_NVME
+   if name.startswith('xvd'):
+      return DISK_EBS
+   rotational = _read(os.path.join(path, 'queue', 'rotational'))
+   return DISK_HDD if rotational == '1' else DISK_SSD
+
+
+def get_disk_type(directory):
+   ''' Returns the type of the disk holding the directory. '''
+   try:
+      return get_device_type(_get_block_device(directory))
+   except (IOError, OSError) as ex:
+      log.warn('Could not detect disk type, error=%s' % ex)
+      return DISK_UNKNOWN
+
+
+def detect_hardware(data_dir):
+   ''' Returns the cpu count, memory and data disk type of the instance. '''
+   hardware = {
+      'cpus': multiprocessing.cpu_count(),
+      'memory_mb': _get_memory_mb(),
+      'disk': get_disk_type(data_dir)
+   }
+   log.info('Detected hardware=%s' % hardware)
+   return hardware
+
+
+def select_profile(hardware):
+   ''' Returns the name of the largest profile that fits the memory. '''
+   selected = PROFILES[0][0]
+   for name, min_memory_mb, _ in PROFILES:
+      if hardware['memory_mb'] >= min_memory_mb:
+         selected = name
+   return selected
+
+
+def load_overrides(filename):
+   ''' Returns the settings of the override file, if there is one. '''
+   if not filename or not os.path.isfile(filename):
+      return {}
+   return dict(config.StaticConfig.load(filename).items())
+
+
+def generate(hardware, overrides=None):
+   ''' Generates the zoo.cfg settings and JVM options for the hardware.
+   Returns a (profile name, settings, jvm) tuple.
+   '''
+   overrides = dict(overrides or {})
+   name = overrides.pop(PROFILE_KEY, None) or select_profile(hardware)
+   profiles = dict((p[0], p[2]) for p in PROFILES)
+   if name not in profiles:
+      raise Exception('Unknown profile=%s' % name)
+   profile = profiles[name]
+
+   settings = dict(profile['settings'])
+   settings.update(DISK_SETTINGS.get(hardware['disk'], {}))
+   heap_mb = min(
+      int(hardware['memory_mb'] * profile['heap_ratio']),
+      profile['max_heap_mb']
+   )
+   jvm = {
+      'heap_mb': heap_mb,
+      'gc': profile['gc'],
+      'flags': ''
+   }
+   # A concurrent collector does not pay off with a single cpu
+   if hardware['cpus'] < 2:
+      jvm['gc'] = GC_SERIAL
+   for key, value in overrides.items():
+      if key.startswith(JVM_PREFIX):
+         jvm[key[len(JVM_PREFIX):]] = value
+      else:
+         settings[key] = value
+   return name, settings, jvm
+
+
+def render_java_env(jvm):
+   ''' Returns the java.env content sourced by the Zookeeper scripts. '''
+   flags = [
+      '-Xms{heap}m -Xmx{heap}m'.format(heap=jvm['heap_mb']),
+      GC_FLAGS.get(jvm['gc'], jvm['gc']),
+      '-XX:+AlwaysPreTouch',
+      jvm.get('flags', '')
+   ]
+   return 'export SERVER_JVMFLAGS="%s"\n' % ' '.join(f for f in flags if f)
+
+
+def apply_profile(conf_dir, data_dir, override_file=None):
+   ''' Writes the java.env for the hardware of this instance and returns
+   the zoo.cfg settings to apply with the rest of the static config. '''
+   hardware = detect_hardware(data_dir)
+   name, settings, jvm = generate(hardware, load_overrides(override_file))
+   log.info('Applying profile=%s, settings=%s, jvm=%s' % (
+      name, settings, jvm
+   ))
+   utils.save_to_file(
+      os.path.join(conf_dir, JAVA_ENV_FILE),
+      render_java_env(jvm)
+   )
+   return settings
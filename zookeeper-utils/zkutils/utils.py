@@ -1,10 +1,16 @@
 import os
+import shutil
+import hashlib
 import logging
+import tempfile
 import subprocess
 
 
 log = logging.getLogger(__name__)
 
+# Number of previous versions kept when saving a file.
+BACKUP_HISTORY = 5
+
 
 # Updating the PATH for the shell commands
 try:
@@ -47,22 +53,82 @@ def run_command(command):
    return stdout
 
 
-def save_to_file(filename, content):
-   ''' Performs backup of existing file and saves the new
-   content to the file.
+def _content_hash(content):
+   return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def _file_hash(filename):
+   with open(filename, 'r') as fread:
+      return _content_hash(fread.read())
+
+
+def _rotate_backups(filename, history):
+   ''' Rotates the backups of a file, `filename.bk.1` being the most recent
+   one, and links the current file as the most recent backup.
+   '''
+   backup = '{filename}.bk.{num}'
+   for num in range(history - 1, 0, -1):
+      src = backup.format(filename=filename, num=num)
+      if os.path.isfile(src):
+         os.rename(src, backup.format(filename=filename, num=num + 1))
+   latest = backup.format(filename=filename, num=1)
+   if os.path.isfile(latest):
+      os.remove(latest)
+   try:
+      os.link(filename, latest)
+   except OSError:
+      shutil.copy2(filename, latest)
+   return latest
+
+
+def _fsync_dir(directory):
+   fd = os.open(directory, os.O_RDONLY)
+   try:
+      os.fsync(fd)
+   finally:
+      os.close(fd)
+
+
+def save_to_file(filename, content, history=BACKUP_HISTORY):
+   ''' Atomically saves the new content to the file and keeps the
+   `history` previous versions of it as backups.
+
+   The content is written and fsynced to a temporary file that is then
+   renamed over the file, so a crash never leaves a torn file behind.
+   Nothing is written if the file already has the same content.
+
+   Returns True if the file was written and False if it was unchanged.
    '''
    content = str(content)
+   if os.path.isfile(filename) and \
+         _file_hash(filename) == _content_hash(content):
+      log.info('Unchanged filename=%s' % filename)
+      return False
 
-   # Backup old content
-   if os.path.isfile(filename):
-      backup_filename = '{filename}.bk'.format(filename=filename)
-      with open(backup_filename, 'w') as fwrite:
-         with open(filename, 'r') as fread:
-            old_content = fread.read()
-         fwrite.write(old_content)
-      log.info('Backed up filename=%s' % backup_filename)
-
-   # Save new content
-   with open(filename, 'w') as fwrite:
-      fwrite.write(content)
+   directory = os.path.dirname(os.path.abspath(filename))
+   fd, tmp_filename = tempfile.mkstemp(
+      prefix='.%s.' % os.path.basename(filename),
+      dir=directory
+   )
+   try:
+      with os.fdopen(fd, 'w') as fwrite:
+         fwrite.write(content)
+         fwrite.flush()
+         os.fsync(fwrite.fileno())
+      if os.path.isfile(filename):
+         stat = os.stat(filename)
+         shutil.copymode(filename, tmp_filename)
+         os.chown(tmp_filename, stat.st_uid, stat.st_gid)
+         if history > 0:
+            backup_filename = _rotate_backups(filename, history)
+            log.info('Backed up filename=%s' % backup_filename)
+      else:
+         os.chmod(tmp_filename, 0o644)
+      os.rename(tmp_filename, filename)
+   except Exception:
+      if os.path.exists(tmp_filename):
+         os.remove(tmp_filename)
+      raise
+   _fsync_dir(directory)
    log.info('Saved filename=%s' % filename)
+   return True
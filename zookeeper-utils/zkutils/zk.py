@@ -1,19 +1,47 @@
+import os
 import time
 import logging
 from datetime import datetime
 
-import aws, utils
+import aws, config, disk, ensemble, joins, monitor, reconcile
+import retry, roles, state, tuning, utils
 
 
 log = logging.getLogger(__name__)
 
-ZK_PORT = 2181
-ZK_ID_TAG = 'zookeeper_id'
-ASGROUP_TAG = 'aws:autoscaling:groupName'
-MAX_INSTANCES = 10
-CLAIMABLE_ZK_IDS = [str(num) for num in range(1, MAX_INSTANCES)]
+ZK_PORT = config.CLIENT_PORT
+STATIC_CONFIG_FILE = 'zoo.cfg'
 BOOTSTRAP_TYPE_FRESH = 'FRESH'
 BOOTSTRAP_TYPE_RECONFIGURED = 'RECONFIGURED'
+BOOTSTRAP_TYPE_REJOINED = 'REJOINED'
+# Phases of the bootstrap, in order, see `do_bootstrap`
+PHASE_PREPARED = 'prepared'
+PHASE_INITIALIZED = 'initialized'
+PHASE_STARTED = 'started'
+PHASE_JOINED = 'joined'
+PHASE_COMPLETED = 'completed'
+PHASES = [
+   PHASE_PREPARED,
+   PHASE_INITIALIZED,
+   PHASE_STARTED,
+   PHASE_JOINED,
+   PHASE_COMPLETED
+]
+# Recorded in the bootstrap state once the CloudFormation signal was sent
+SIGNALED_KEY = 'signaled'
+# Written by Zookeeper once the server took part in an ensemble
+EPOCH_FILE = 'version-2/currentEpoch'
+READY_MAX_LAG = 10 # transactions
+READY_TIMEOUT = 300 # seconds
+RECONFIG_ATTEMPTS = 5
+# Backoffs of the waits and retries, see `retry.Backoff`
+INSTANCES_BACKOFF = retry.Backoff(5, 30)
+ENSEMBLE_CHECK_BACKOFF = retry.Backoff(1, 5, attempts=3)
+READY_BACKOFF = retry.Backoff(1, 10)
+REMOVE_BACKOFF = retry.Backoff(1, 10, attempts=3)
+RECONFIG_BACKOFF = retry.Backoff(0.5, 5, attempts=RECONFIG_ATTEMPTS)
+# Errors of zkCli when the config changed since the version it was given
+VERSION_CONFLICTS = ['BadVersion', 'version No is not valid']
 
 
 def _cmd_start_zookeeper(conf_dir):
@@ -28,23 +56,6 @@ def _cmd_check_ensemble(ip):
    )
 
 
-def _cmd_reset_config(dynamic_file, conf_dir):
-   return utils.run_command(
-      """sed -i'.bk' 's/dynamicConfigFile=.*/dynamicConfigFile={dynamic_file}/' {conf_dir}/zoo.cfg
-      """.format(
-         dynamic_file=dynamic_file.replace("/", "\/"),
-         conf_dir=conf_dir
-      )
-   )
-
-
-def _cmd_get_zookeeper_configuration(ensemble_ip):
-   return utils.run_command(
-      """zkCli.sh -server {ip}:{port} get /zookeeper/config|grep ^server
-      """.format(ip=ensemble_ip, port=ZK_PORT)
-   )
-
-
 def _cmd_delete_old_state(data_dir):
    return utils.run_command(
       """rm -rf {data_dir}/version-2/*""".format(data_dir=data_dir)
@@ -64,27 +75,23 @@ def _cmd_remove_zookeeper_ids(ensemble_ip, terminated_ids):
    )
 
 
-def _cmd_add_zookeeper_id(ensemble_ip, zookeeper_ip, zookeeper_id):
-   return utils.run_command(
-      """zkCli.sh \
-            -server {ensemble_ip}:{port} \
-            reconfig -add "server.{id}={zk_ip}:2888:3888:participant;{port}"
-      """.format(
-         ensemble_ip=ensemble_ip,
-         port=ZK_PORT,
-         zk_ip=zookeeper_ip,
-         id=zookeeper_id
-      )
-   )
+def _reset_static_config(dynamic_file, conf_dir, settings=None):
+   ''' Points the static configuration to the dynamic file and applies
+   the other settings in a single atomic write. '''
+   filename = os.path.join(conf_dir, STATIC_CONFIG_FILE)
+   static_config = config.StaticConfig.load(filename)
+   static_config.set('dynamicConfigFile', dynamic_file)
+   static_config.update(settings or {})
+   return static_config.save(filename)
 
 
 def initialize(region, instance_id, id_file, log_group):
    ''' Initializes the zookeeper instance with a valid zookeeper id '''
    log.info('Initializing instance, instance_id=%s' % instance_id)
-   zk_id = aws.get_tag(region, instance_id, ZK_ID_TAG)
+   zk_id = aws.get_tag(region, instance_id, ensemble.ZK_ID_TAG)
    if not zk_id:
       zk_id = get_zookeeper_id(region, log_group)
-      aws.set_tag(region, instance_id, ZK_ID_TAG, zk_id)
+      aws.set_tag(region, instance_id, ensemble.ZK_ID_TAG, zk_id)
    utils.save_to_file(id_file, zk_id)
    log.info('Initialized with zookeeper_id=%s' % zk_id)
    return zk_id
@@ -95,7 +102,7 @@ def get_zookeeper_id(region, group_name):
    clash with any functional zookeeper id. It guarantees this property
    with the help of CloudWatch Logs.
    '''
-   for zkid in CLAIMABLE_ZK_IDS:
+   for zkid in ensemble.CLAIMABLE_ZK_IDS:
       success = aws.create_log_stream(region, group_name, zkid)
       if success:
          return zkid
@@ -106,10 +113,11 @@ def get_zookeeper_instances(region,
                             asgroup_tag,
                             asgroup_name,
                             zk_id_tag,
-                            capacity):
+                            capacity,
+                            deadline=None):
    ''' Returns running instances of zookeeper.
    This method will continue to loop until we get all running instances
-   in the cluster as set in the autoscaling group.
+   in the cluster as set in the autoscaling group, or until the deadline.
    '''
    # Loop indefinitely until we get a total of capacity
    # as setup in the autoscaling group. This is important because we need
@@ -118,20 +126,19 @@ def get_zookeeper_instances(region,
    # tag should also be set.
    tag_value_pairs = [
       (asgroup_tag, [asgroup_name]),
-      (zk_id_tag, CLAIMABLE_ZK_IDS)
+      (zk_id_tag, ensemble.CLAIMABLE_ZK_IDS)
    ]
 
    log.info('Getting all running zookeeper instances')
-   instances = []
-   while True:
+   def get_instances():
       instances = aws.get_running_instances(region, tag_value_pairs)
       log.info('Found=%s, Actual=%s' % (len(instances), capacity))
       if len(instances) >= capacity:
-         break
-      else:
-         log.info('Waiting for all ZK instances to be up and running ...')
-         time.sleep(30) # seconds
+         return instances
+      log.info('Waiting for all ZK instances to be up and running ...')
+      return None
 
+   instances = retry.poll(get_instances, INSTANCES_BACKOFF, deadline)
    log.info('Got all running, count=%s' % len(instances))
    return instances
 
@@ -160,7 +167,7 @@ def start_zookeeper(conf_dir):
    log.info('Zookeeper started.')
 
 
-def check_ensemble(ips):
+def check_ensemble(ips, deadline=None):
    ''' Checks if there is a zookeeper ensemble up and running
    by using the 4 letter word command.
 
@@ -173,23 +180,21 @@ def check_ensemble(ips):
 
    If there is no quorum, the ensemble will not be functional.
    '''
+   def is_functional(ip):
+      try:
+         stdout = _cmd_check_ensemble(ip)
+         return 'leader' in stdout or 'follower' in stdout
+      except utils.CommandError as ex:
+         log.error('Failed to connect to %s with error %s' % (ip, str(ex)))
+         return False
+
    log.info('Checking for existing ensemble')
    for ip in ips:
       log.info('Trying to connect with %s' % ip)
-      retry_count = 3
-      while retry_count > 0:
-         try:
-            stdout = _cmd_check_ensemble(ip)
-            is_functional = 'leader' in stdout or 'follower' in stdout
-            if is_functional:
-               log.info('Ensemble is functional. Connected to %s' % (ip))
-               return ip
-         except utils.CommandError as ex:
-            log.error('Failed to connect to %s with error %s' % (ip, str(ex)))
-         retry_count -= 1
-         time.sleep(3)
-         if retry_count >= 0:
-            log.info('Retrying connection')
+      if retry.poll(lambda: is_functional(ip), ENSEMBLE_CHECK_BACKOFF,
+                    deadline):
+         log.info('Ensemble is functional. Connected to %s' % (ip))
+         return ip
    log.info('Ensemble is not functional')
 
 
@@ -198,9 +203,82 @@ def is_leader(ip="localhost"):
    return "leader" in _cmd_check_ensemble(ip)
 
 
-def add_zookeeper_node(ensemble_ip, zookeeper_ip, zookeeper_id):
-   ''' Adds a zookeeper node to the ensemble. '''
-   return _cmd_add_zookeeper_id(ensemble_ip, zookeeper_ip, zookeeper_id)
+def is_ready(ip="localhost", max_lag=READY_MAX_LAG):
+   ''' Returns True if the node serves requests as a leader, follower or
+   observer and is at most `max_lag` transactions behind the leader. '''
+   try:
+      status = monitor.get_status(ip)
+      if status['mode'] not in monitor.SERVING_MODES:
+         return False
+      if status['mode'] == monitor.MODE_LEADER:
+         return True
+      live = ensemble.get_zookeeper_configuration(ip)
+      ips = [s.ip for s in live.sorted_servers()]
+      leader_status = monitor.get_leader_status(monitor.get_statuses(ips))
+      return bool(leader_status) and \
+         monitor.is_synced(status, leader_status, max_lag)
+   except (monitor.MonitorError, utils.CommandError) as ex:
+      log.info('Not ready, %s' % ex)
+      return False
+
+
+def wait_until_ready(ip="localhost", max_lag=READY_MAX_LAG,
+                     timeout=READY_TIMEOUT):
+   ''' Waits until the node is ready, see `is_ready`.
+   Returns False if it is still not ready after `timeout` seconds. '''
+   def check():
+      if is_ready(ip, max_lag):
+         return True
+      log.info('Waiting for node to be synced ...')
+      return False
+
+   try:
+      retry.poll(check, READY_BACKOFF, retry.Deadline(timeout))
+   except retry.DeadlineExceeded:
+      log.error('Node not ready after %s seconds' % timeout)
+      return False
+   log.info('Node is ready, ip=%s' % ip)
+   return True
+
+
+def is_signaled(state_file):
+   ''' Returns True if the state file records that the CloudFormation
+   signal of this instance was sent. '''
+   bootstrap_state = state_file and state.load(state_file)
+   return bool(bootstrap_state and bootstrap_state.get(SIGNALED_KEY))
+
+
+def signal_ready(region, instance_id, max_lag=READY_MAX_LAG,
+                 timeout=READY_TIMEOUT, state_file=None, deadline=None):
+   ''' Sends the CloudFormation success signal once the node is a synced
+   member of the ensemble, or a failure signal if it does not get there
+   within `timeout`. This way a rolling update waits for each node before
+   the next one.
+
+   The wait is cut short to what is left of the deadline. A node that is
+   not ready when the deadline cuts it short is not failed: no signal is
+   sent and retry.DeadlineExceeded is raised, so that the restarted
+   bootstrap waits again and signals.
+
+   With a state file, the signal is recorded in it once sent, so that a
+   bootstrap that completed but failed before signaling still signals
+   when it is restarted, see `is_signaled`.
+   '''
+   deadline = deadline or retry.Deadline()
+   wait = deadline.limit(timeout)
+   ready = wait_until_ready("localhost", max_lag, wait)
+   if not ready and wait < timeout:
+      raise retry.DeadlineExceeded(
+         'Node not synced after %.0f of %s seconds, budget spent' % (
+            wait, timeout
+         )
+      )
+   aws.signal_resource(region, instance_id, ready)
+   if state_file:
+      bootstrap_state = state.load(state_file) or {}
+      bootstrap_state[SIGNALED_KEY] = True
+      state.save(state_file, bootstrap_state)
+   return ready
 
 
 def remove_zookeeper_nodes(region, ensemble_ip, running_ids, log_group):
@@ -210,49 +288,122 @@ def remove_zookeeper_nodes(region, ensemble_ip, running_ids, log_group):
    We need to retry this logic due to race conditions from other
    Zookeeper EC2 instances booting up at the same time and running this code.
    '''
-   retry_count = 3
-   while retry_count > 0:
+   def remove():
       terminated_ids = get_terminated_zookeeper_ids(
                            region,
                            running_ids,
                            log_group
                         )
-      if terminated_ids:
-         terminated_ids = ",".join(terminated_ids)
-         try:
-            log.info('Removing ids=%s' % terminated_ids)
-            _cmd_remove_zookeeper_ids(ensemble_ip, terminated_ids)
-            log.info('Removing log streams=%s' % terminated_ids)
-            aws.delete_log_streams(region, log_group, terminated_ids)
-            return terminated_ids
-         except utils.CommandError as ex:
-            log.error('Retrying.. %s' % ex)
-            time.sleep(3)
-      else:
+      if not terminated_ids:
          log.info("No terminations found, terminated_ids=%s" % terminated_ids)
          return terminated_ids
-      retry_count -= 1
-   raise Exception("Terminated zookeeper_ids not removed correctly.")
+      terminated_ids = ",".join(terminated_ids)
+      log.info('Removing ids=%s' % terminated_ids)
+      _cmd_remove_zookeeper_ids(ensemble_ip, terminated_ids)
+      log.info('Removing log streams=%s' % terminated_ids)
+      aws.delete_log_streams(region, log_group, terminated_ids)
+      return terminated_ids
+
+   try:
+      return retry.retry(remove, REMOVE_BACKOFF, utils.CommandError)
+   except utils.CommandError:
+      raise Exception("Terminated zookeeper_ids not removed correctly.")
+
+
+class VersionConflict(Exception):
+   pass
+
+
+def reconfig_conditionally(ensemble_ip, compute_plan, deadline=None):
+   ''' Applies the plan that `compute_plan` returns for the live config
+   as a single reconfig, conditional on the version of that config.
+   On a version conflict the config is read again and the reconfig
+   retried after a jittered backoff, so that the servers that conflicted
+   do not conflict again. Returns the applied plan, None if there was
+   nothing to apply.
+   '''
+   def attempt():
+      plan = compute_plan(ensemble.get_zookeeper_configuration(ensemble_ip))
+      if plan is None or plan.is_empty():
+         return None
+      try:
+         log.info('Reconfiguring with %s' % plan)
+         ensemble._cmd_reconfig(
+            ensemble_ip,
+            plan.joining,
+            plan.leaving,
+            plan.version
+         )
+         return plan
+      except utils.CommandError as ex:
+         if not any(c in str(ex) for c in VERSION_CONFLICTS):
+            raise
+         raise VersionConflict(
+            'Config changed since version=%s' % plan.version
+         )
+
+   try:
+      return retry.retry(attempt, RECONFIG_BACKOFF, VersionConflict, deadline)
+   except VersionConflict:
+      raise Exception('Not reconfigured after %s attempts' % RECONFIG_ATTEMPTS)
+
+
+def join_ensemble(ensemble_ip, server, leaving=None,
+                  max_voters=roles.DEFAULT_MAX_VOTERS, deadline=None):
+   ''' Adds the server to the ensemble and removes the `leaving` ids in a
+   single conditional reconfig, see `reconfig_conditionally`. Returns the
+   applied plan, None if the server is already a member.
+   '''
+   def compute_plan(dynamic_config):
+      member = dynamic_config.get(server.id)
+      if member and member.ip == server.ip:
+         log.info('Already a member as %s' % member)
+         return None
+      return joins.compute_batch(
+         dynamic_config,
+         [joins.JoinRequest(server, leaving, max_voters)]
+      )
+   return reconfig_conditionally(ensemble_ip, compute_plan, deadline)
 
 
-def reconfigure_ensemble(region, zookeeper_id, zookeeper_ip, running_ids,
-                         ensemble_ip, dynamic_file, conf_dir, log_group):
-   ''' Reconfigures the zookeeper ensemble by adding a new server to it. '''
+def leave_ensemble(ensemble_ip, server_id,
+                   max_voters=roles.DEFAULT_MAX_VOTERS):
+   ''' Removes the server from the ensemble and promotes an observer in
+   its place in a single conditional reconfig. Returns the applied plan,
+   None if the server is not a member.
+
+   When the server is the leader, Zookeeper hands the leadership over to
+   a designated voter of the new config instead of running an election.
+   '''
+   def compute_plan(dynamic_config):
+      if dynamic_config.get(server_id) is None:
+         log.info('Not a member, id=%s' % server_id)
+         return None
+      return reconcile.compute_removal(
+         dynamic_config,
+         [server_id],
+         max_voters
+      )
+   return reconfig_conditionally(ensemble_ip, compute_plan)
+
+
+def start_joining_server(zookeeper_id, zookeeper_ip, ensemble_ip,
+                         dynamic_file, conf_dir, settings=None):
+   ''' Starts the new server with the live config of the ensemble plus
+   itself as an observer, ready to be added to the ensemble. '''
 
    # Get and reset the static configuration
    # The static file changes the path of the dynamic file location.
    log.info('Resetting static configuration')
-   _cmd_reset_config(dynamic_file, conf_dir)
+   _reset_static_config(dynamic_file, conf_dir, settings)
 
    # Add host as an observer to the ensemble configuration
    log.info('Resetting dynamic configuration')
-   config = _cmd_get_zookeeper_configuration(ensemble_ip)
-   config += "\nserver.{id}={ip}:2888:3888:observer;{port}".format(
-      id=zookeeper_id,
-      ip=zookeeper_ip,
-      port=ZK_PORT
+   dynamic_config = ensemble.get_zookeeper_configuration(ensemble_ip)
+   dynamic_config.add(
+      config.Server(zookeeper_id, zookeeper_ip, role=config.ROLE_OBSERVER)
    )
-   utils.save_to_file(dynamic_file, config)
+   dynamic_config.save(dynamic_file)
    start_zookeeper(conf_dir)
 
    # Wait a bit for Zookeeper to initialize itself
@@ -260,71 +411,201 @@ def reconfigure_ensemble(region, zookeeper_id, zookeeper_ip, running_ids,
    log.info('Sleeping for a bit')
    time.sleep(30)
 
-   # Remove ids from the ensemble
-   log.info('Reconfiguration by removing')
-   remove_zookeeper_nodes(region, ensemble_ip, running_ids, log_group)
 
-   # Add host as participant to the ensemble with "add" command
-   log.info('Reconfiguration by adding')
-   log.info('Adding id %s' % zookeeper_id)
-   add_zookeeper_node(ensemble_ip, zookeeper_ip, zookeeper_id)
+def add_joining_server(region, zookeeper_id, zookeeper_ip, running_ids,
+                       ensemble_ip, log_group,
+                       max_voters=roles.DEFAULT_MAX_VOTERS, deadline=None):
+   ''' Adds the started server to the ensemble and removes the terminated
+   servers along with it.
+
+   The join is queued for the leader to apply it together with the other
+   servers joining at the same time, see `joins.join`. Without an answer
+   the server is added directly, see `join_ensemble`.
+   '''
+   # Ask the leader to add this host and remove the terminated ids,
+   # batched with the other hosts joining at the same time
+   log.info('Requesting to join the ensemble')
+   terminated_ids = get_terminated_zookeeper_ids(
+      region,
+      running_ids,
+      log_group
+   )
+   server = config.Server(zookeeper_id, zookeeper_ip)
+   deadline = deadline or retry.Deadline()
+   timeout = deadline.limit(joins.JOIN_TIMEOUT)
+   if not joins.join(ensemble_ip, server, terminated_ids, max_voters,
+                     timeout):
+      log.info('Reconfiguration by removing and adding')
+      join_ensemble(ensemble_ip, server, terminated_ids, max_voters,
+                    deadline)
+   if terminated_ids:
+      log.info('Removing log streams=%s' % terminated_ids)
+      aws.delete_log_streams(region, log_group, terminated_ids)
    log.info('Ensemble Reconfigured.')
 
 
-def configure_ensemble(zk_id_ip_pairs, dynamic_file, conf_dir, data_dir):
+def configure_ensemble(zk_id_ip_pairs, dynamic_file, conf_dir, data_dir,
+                       settings=None, max_voters=roles.DEFAULT_MAX_VOTERS,
+                       azs=None):
    '''Configures zookeeper ensemble with zookeeper instances.
    After configuration, it starts the zookeeper server.
+
+   At most `max_voters` instances are participants, the others observers.
+   The participants are spread across the availability zones, if given.
    '''
    log.info('Doing a fresh Zookeeper ensemble configuration')
    log.info('Wiping out old state')
    _cmd_delete_old_state(data_dir)
+   data_log_dir = (settings or {}).get('dataLogDir')
+   if data_log_dir and data_log_dir != data_dir:
+      _cmd_delete_old_state(data_log_dir)
 
    log.info('Resetting static configuration')
-   _cmd_reset_config(dynamic_file, conf_dir)
+   _reset_static_config(dynamic_file, conf_dir, settings)
 
-   # Add hosts as participants to the ensemble configuration
+   # Add hosts as participants or observers to the ensemble configuration
    log.info('Resetting dynamic configuration')
-   configs = []
-   for pair in zk_id_ip_pairs:
-      zk_id = pair[0]
-      zk_ip = pair[1]
-      config = """server.{id}={ip}:2888:3888:participant;{port}""".format(
-         id=zk_id,
-         ip=zk_ip,
-         port=ZK_PORT
-      )
-      configs.append(config)
-
-   ensemble_config = '\n'.join(configs)
-   utils.save_to_file(dynamic_file, ensemble_config)
+   dynamic_config = config.DynamicConfig(roles.assign_roles([
+      config.Server(zk_id, zk_ip) for zk_id, zk_ip in zk_id_ip_pairs
+   ], max_voters, azs))
+   dynamic_config.save(dynamic_file)
    start_zookeeper(conf_dir)
    log.info('Ensemble Configured.')
 
 
-def do_bootstrap(region, id_file, dynamic_file,
-                 conf_dir, data_dir, log_group):
-   ''' Bootstraps the zookeeper cluster if it does not exists
-   otherwise it bootstraps this instance to join the cluster
-   via dynamic reconfiguration.
+def get_local_member(bootstrap_state, id_file, dynamic_config, data_dir):
+   ''' Returns the server of this instance if the local state shows a
+   previous membership, i.e. the myid file, the dynamic file and the data
+   dir are intact and match the saved bootstrap state. '''
+   with open(id_file, 'r') as fread:
+      zookeeper_id = fread.read().strip()
+   if zookeeper_id != bootstrap_state.get('zookeeper_id'):
+      log.info('Id changed since the last bootstrap, id=%s' % zookeeper_id)
+      return None
+   member = dynamic_config.get(zookeeper_id)
+   if not member or member.ip != bootstrap_state.get('zookeeper_ip'):
+      log.info('Not in the dynamic file, id=%s' % zookeeper_id)
+      return None
+   if not os.path.exists(os.path.join(data_dir, EPOCH_FILE)):
+      log.info('No previous data in dir=%s' % data_dir)
+      return None
+   return member
+
+
+def get_present_peers(dynamic_config, member, region=None):
+   ''' Returns the ids of the other servers of the config whose
+   Zookeeper runs, whether it serves requests or not. With a region, the
+   servers whose instance still runs at their ip in the autoscaling group
+   are present too, e.g. while the whole ensemble reboots. '''
+   others = [s for s in dynamic_config.sorted_servers() if s.id != member.id]
+   present = set(s.id for s in others if monitor.is_running(s.ip))
+   if region and len(present) < len(others):
+      instance_id = aws.get_instance_id()
+      asgroup = aws.get_autoscaling_group(
+         region,
+         ensemble.ASGROUP_TAG,
+         instance_id
+      )
+      running, _ = reconcile.get_desired_members(
+         region,
+         asgroup['AutoScalingGroupName']
+      )
+      present |= set(s.id for s in others if running.get(s.id) == s.ip)
+   return present
+
+
+def is_live_member(dynamic_config, member, region=None):
+   ''' Returns False if the live config of the ensemble, read through
+   another member, does not have the member.
+
+   If no other member serves requests, e.g. after the whole ensemble
+   rebooted, the local config is only trusted if enough of its servers
+   are present to form a quorum, see `get_present_peers`. Otherwise its
+   peers are gone, e.g. replaced by a new ensemble, and the member has to
+   bootstrap again.
    '''
-   log.info('Bootstrapping ...')
+   other_ips = [
+      s.ip for s in dynamic_config.sorted_servers() if s.id != member.id
+   ]
+   statuses = monitor.get_statuses(other_ips)
+   for ip in other_ips:
+      if not statuses[ip]:
+         continue
+      try:
+         live_member = ensemble.get_zookeeper_configuration(ip).get(member.id)
+      except utils.CommandError as ex:
+         log.info('No live config from ip=%s, %s' % (ip, ex))
+         continue
+      return bool(live_member) and live_member.ip == member.ip
+   present = get_present_peers(dynamic_config, member, region) | \
+      set([member.id])
+   voters = [s.id for s in dynamic_config.participants()]
+   present_voters = [v for v in voters if v in present]
+   if len(present_voters) * 2 > len(voters):
+      log.info('No member serving, trusting the dynamic file, voters=%s'
+               % present_voters)
+      return True
+   log.info('Voters of the dynamic file are gone, present=%s of voters=%s'
+            % (present_voters, voters))
+   return False
+
+
+def rejoin(state_file, id_file, dynamic_file, conf_dir, data_dir,
+           region=None):
+   ''' Starts Zookeeper right away with the membership of the last
+   bootstrap, if it is still valid. Returns True if it did.
+
+   This is the fast path after a reboot or a restart of the service: no
+   AWS calls and no reconfig are needed while the instance is still a
+   member of the ensemble. If the other members are not serving, the
+   region is used to tell a reboot of the ensemble from peers that are
+   gone, see `is_live_member`.
+   '''
+   bootstrap_state = state.load(state_file)
+   if not bootstrap_state or \
+         not _is_done(bootstrap_state, PHASE_COMPLETED):
+      return False
+   try:
+      dynamic_config = config.DynamicConfig.load(dynamic_file)
+      member = get_local_member(
+         bootstrap_state,
+         id_file,
+         dynamic_config,
+         data_dir
+      )
+   except (IOError, OSError) as ex:
+      log.info('Local state not usable, %s' % ex)
+      return False
+   if not member or not is_live_member(dynamic_config, member, region):
+      return False
+   log.info('Rejoining the ensemble as %s' % member)
+   start_zookeeper(conf_dir)
+   return True
 
-   # Initialize Zookeeper instance
-   instance_id = aws.get_instance_id()
-   zookeeper_id = initialize(region, instance_id, id_file, log_group)
 
+def start_server(region, instance_id, zookeeper_id, dynamic_file, conf_dir,
+                 data_dir, settings=None, max_voters=roles.DEFAULT_MAX_VOTERS,
+                 deadline=None):
+   ''' Configures and starts the server, either with all servers for a
+   fresh ensemble or as a new server of the existing ensemble. Returns
+   the membership details the rest of the bootstrap needs. '''
    # Get the autoscaling group
-   asgroup = aws.get_autoscaling_group(region, ASGROUP_TAG, instance_id)
+   asgroup = aws.get_autoscaling_group(
+      region,
+      ensemble.ASGROUP_TAG,
+      instance_id
+   )
    asgroup_name = asgroup['AutoScalingGroupName']
    capacity = asgroup['DesiredCapacity']
 
    # Get all zookeeper instances in the autoscaling group
    zk_instances = get_zookeeper_instances(
       region,
-      ASGROUP_TAG,
+      ensemble.ASGROUP_TAG,
       asgroup_name,
-      ZK_ID_TAG,
-      capacity
+      ensemble.ZK_ID_TAG,
+      capacity,
+      deadline
    )
 
    # Getting running zookeeper ids and ips to to formulate
@@ -345,7 +626,7 @@ def do_bootstrap(region, id_file, dynamic_file,
       else:
          zk_other_ips.append(ip)
          tags = i['Tags']
-         tags = [t for t in tags if t['Key']==ZK_ID_TAG]
+         tags = [t for t in tags if t['Key']==ensemble.ZK_ID_TAG]
          zk_other_id = tags[0]['Value']
          log.info('Other zookeeper_id=%s zookeeper_ip=%s' % (zk_other_id, ip))
          zk_id_ip_pairs.append((zk_other_id, ip))
@@ -369,18 +650,16 @@ def do_bootstrap(region, id_file, dynamic_file,
 
    # Check for valid ensemble then decide to freshly configure
    # a new ensemble or dynamically reconfigure the existing one
-   valid_ip = check_ensemble(zk_other_ips)
+   valid_ip = check_ensemble(zk_other_ips, deadline)
    if valid_ip:
-      log.info('Reconfiguring ensemble with new server')
-      reconfigure_ensemble(
-         region,
+      log.info('Starting new server of the ensemble')
+      start_joining_server(
          zookeeper_id,
          zk_ip,
-         zk_all_ids,
          valid_ip,
          dynamic_file,
          conf_dir,
-         log_group
+         settings
       )
    else:
       log.info('Configuring ensemble with all servers')
@@ -388,12 +667,142 @@ def do_bootstrap(region, id_file, dynamic_file,
          zk_id_ip_pairs,
          dynamic_file,
          conf_dir,
-         data_dir
+         data_dir,
+         settings,
+         max_voters,
+         ensemble.get_zookeeper_azs(zk_instances)
+      )
+   return {
+      'bootstrap_type': BOOTSTRAP_TYPE_RECONFIGURED if valid_ip \
+         else BOOTSTRAP_TYPE_FRESH,
+      'zookeeper_ip': zk_ip,
+      'ensemble_ip': valid_ip,
+      'other_ips': zk_other_ips,
+      'running_ids': zk_all_ids
+   }
+
+
+def _is_done(bootstrap_state, phase):
+   done = bootstrap_state.get('phase')
+   return done in PHASES and PHASES.index(done) >= PHASES.index(phase)
+
+
+def _checkpoint(state_file, bootstrap_state, phase, **values):
+   ''' Records the completed phase along with the values needed by the
+   next phases, durably if there is a state file. '''
+   bootstrap_state.update(values)
+   bootstrap_state['phase'] = phase
+   if state_file:
+      state.save(state_file, bootstrap_state)
+   log.info('Bootstrap phase completed, phase=%s' % phase)
+
+
+def do_bootstrap(region, id_file, dynamic_file,
+                 conf_dir, data_dir, log_group, profile_file=None,
+                 data_log_dir=None, max_voters=roles.DEFAULT_MAX_VOTERS,
+                 state_file=None, deadline=None):
+   ''' Bootstraps the zookeeper cluster if it does not exists
+   otherwise it bootstraps this instance to join the cluster
+   via dynamic reconfiguration.
+
+   The zoo.cfg tunables and JVM options are generated from the
+   hardware of this instance, see `tuning.apply_profile`.
+
+   With a `data_log_dir` the transaction log is kept apart from the
+   snapshots, on a dedicated disk if one is found.
+
+   At most `max_voters` servers are voting members, the others
+   are permanent observers.
+
+   The bootstrap runs in phases, see PHASES. With a `state_file`, each
+   completed phase is checkpointed so that a bootstrap that failed
+   resumes after the last completed phase when it is run again. In
+   particular, the data dir is never wiped and the server never reset
+   once it was started. Once the bootstrap completed, a later run rejoins
+   with the saved membership if it is still valid, see `rejoin`.
+
+   With a `deadline`, see `retry.Deadline`, the waits and retries of the
+   bootstrap share its budget and retry.DeadlineExceeded is raised once it
+   is spent. The steps that do not wait, e.g. formatting a disk, count
+   against the budget too but are not interrupted.
+   '''
+   deadline = deadline or retry.Deadline()
+   bootstrap_state = (state_file and state.load(state_file)) or {}
+   if _is_done(bootstrap_state, PHASE_COMPLETED):
+      if rejoin(state_file, id_file, dynamic_file, conf_dir, data_dir,
+                region):
+         log.info('Bootstrap completed')
+         return BOOTSTRAP_TYPE_REJOINED
+      bootstrap_state = {}
+   elif bootstrap_state:
+      log.info('Resuming bootstrap after phase=%s' % bootstrap_state['phase'])
+
+   log.info('Bootstrapping ...')
+   if not _is_done(bootstrap_state, PHASE_PREPARED):
+      settings = tuning.apply_profile(conf_dir, data_dir, profile_file)
+      if data_log_dir:
+         disk.prepare_data_log_dir(data_log_dir)
+         settings['dataLogDir'] = data_log_dir
+      _checkpoint(state_file, bootstrap_state, PHASE_PREPARED,
+                  settings=settings)
+   settings = bootstrap_state['settings']
+
+   # Initialize Zookeeper instance
+   if not _is_done(bootstrap_state, PHASE_INITIALIZED):
+      instance_id = aws.get_instance_id()
+      zookeeper_id = initialize(region, instance_id, id_file, log_group)
+      _checkpoint(state_file, bootstrap_state, PHASE_INITIALIZED,
+                  instance_id=instance_id, zookeeper_id=zookeeper_id)
+   instance_id = bootstrap_state['instance_id']
+   zookeeper_id = bootstrap_state['zookeeper_id']
+
+   # Configure and start the server, once only
+   started = _is_done(bootstrap_state, PHASE_STARTED)
+   if not started:
+      membership = start_server(
+         region,
+         instance_id,
+         zookeeper_id,
+         dynamic_file,
+         conf_dir,
+         data_dir,
+         settings,
+         max_voters,
+         deadline
+      )
+      _checkpoint(state_file, bootstrap_state, PHASE_STARTED, **membership)
+   elif not monitor.is_running('localhost'):
+      start_zookeeper(conf_dir)
+   bootstrap_type = bootstrap_state['bootstrap_type']
+   zk_ip = bootstrap_state['zookeeper_ip']
+
+   # Add the server to the existing ensemble
+   if bootstrap_type == BOOTSTRAP_TYPE_RECONFIGURED and \
+         not _is_done(bootstrap_state, PHASE_JOINED):
+      ensemble_ip = bootstrap_state['ensemble_ip']
+      if started:
+         # The ensemble ip may have gone away since
+         ensemble_ip = check_ensemble(
+            bootstrap_state['other_ips'],
+            deadline
+         ) or ensemble_ip
+      add_joining_server(
+         region,
+         zookeeper_id,
+         zk_ip,
+         bootstrap_state['running_ids'],
+         ensemble_ip,
+         log_group,
+         max_voters,
+         deadline
       )
+      _checkpoint(state_file, bootstrap_state, PHASE_JOINED)
 
    # Set bootstrap finished tag
    log.info('Setting `bootstrap_finished_time` tag')
    now = datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ')
    aws.set_tag(region, instance_id, "bootstrap_finished_time", now)
+   _checkpoint(state_file, bootstrap_state, PHASE_COMPLETED,
+               bootstrap_finished_time=now)
    log.info('Bootstrap completed')
-   return BOOTSTRAP_TYPE_RECONFIGURED if valid_ip else BOOTSTRAP_TYPE_FRESH
+   return bootstrap_type